@@ -0,0 +1,24 @@
+from twisted.trial import unittest
+from twisted.internet import defer
+
+from torba.coin.bitcoinsegwit import MainNetLedger as ledger_class
+from torba.wallet import Wallet
+
+
+class AccountTestCase(unittest.TestCase):
+    """ Ledger with an in memory database and one account. """
+
+    use_asyncio = False
+
+    def create_account(self):
+        return self.ledger.account_class.generate(self.ledger, Wallet(), "torba")
+
+    @defer.inlineCallbacks
+    def setUp(self):
+        self.ledger = ledger_class({
+            'db': ledger_class.database_class(':memory:', use_asyncio=self.use_asyncio),
+            'headers': ledger_class.headers_class(':memory:'),
+        })
+        yield self.ledger.db.open()
+        self.addCleanup(self.ledger.db.close)
+        self.account = self.create_account()
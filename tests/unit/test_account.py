@@ -3,9 +3,11 @@ from twisted.trial import unittest
 from twisted.internet import defer
 
 from torba.coin.bitcoinsegwit import MainNetLedger as ledger_class
-from torba.baseaccount import HierarchicalDeterministic, SingleKey
+from torba.baseaccount import HierarchicalDeterministic, SingleKey, SlidingWindow
 from torba.wallet import Wallet
 
+from .helpers import AccountTestCase
+
 
 class TestHierarchicalDeterministicAccount(unittest.TestCase):
 
@@ -72,12 +74,16 @@ class TestHierarchicalDeterministicAccount(unittest.TestCase):
 
         # case #2: only one new addressed needed
         records = yield account.receiving.get_address_records()
-        yield self.ledger.db.set_address_history(records[0]['address'], 'a:1:')
+        yield self.ledger.db.set_address_history(
+            records[0]['address'], [('aa', 1)], self.ledger.get_status_from_history([('aa', 1)])
+        )
         new_keys = yield account.receiving.ensure_address_gap()
         self.assertEqual(len(new_keys), 1)
 
         # case #3: 20 addresses needed
-        yield self.ledger.db.set_address_history(new_keys[0], 'a:1:')
+        yield self.ledger.db.set_address_history(
+            new_keys[0], [('aa', 1)], self.ledger.get_status_from_history([('aa', 1)])
+        )
         new_keys = yield account.receiving.ensure_address_gap()
         self.assertEqual(len(new_keys), 20)
 
@@ -170,6 +176,52 @@ class TestHierarchicalDeterministicAccount(unittest.TestCase):
         self.assertDictEqual(account_data, account.to_dict())
 
 
+class TestSlidingWindowAccount(AccountTestCase):
+
+    def create_account(self):
+        # watch-only, created from the xpub alone
+        return self.ledger.account_class.from_dict(self.ledger, Wallet(), {
+            'public_key':
+                'xpub661MyMwAqRbcFwwe67Bfjd53h5WXmKm6tqfBJZZH3pQLoy8Nb6mKUMJFc7'
+                'UbpVNzmwFPN2evn3YHnig1pkKVYcvCV8owTd2yAcEkJfCX53g',
+            'address_generator': {
+                'name': 'sliding-window',
+                'receiving': {'gap': 5, 'maximum_uses_per_address': 1, 'window': 8},
+                'change': {'gap': 2, 'maximum_uses_per_address': 1, 'window': 3}
+            }
+        })
+
+    @defer.inlineCallbacks
+    def test_subscription_window(self):
+        account = self.account
+        self.assertIsInstance(account.receiving, SlidingWindow)
+        self.assertFalse(account.private_key)
+        self.assertEqual(account.to_dict()['address_generator']['receiving']['window'], 8)
+
+        yield account.ensure_address_gap()
+        starts = yield account.get_subscription_starts()
+        self.assertEqual(starts, {0: 0, 1: 0})
+
+        yield account.receiving.generate_keys(5, 11)
+        starts = yield account.get_subscription_starts()
+        self.assertEqual(starts, {0: 4, 1: 0})
+
+    @defer.inlineCallbacks
+    def test_filter_matches_derived_keys(self):
+        account = self.account
+        yield account.ensure_address_gap()
+        derived = self.ledger.address_to_hash160(account.receiving.public_key.child(3).address)
+        not_derived = self.ledger.address_to_hash160(account.receiving.public_key.child(30).address)
+        self.assertTrue(account.receiving.might_own(derived))
+        self.assertFalse(account.receiving.might_own(not_derived))
+
+        # filter is rebuilt from the database when the account is loaded
+        account.receiving.hash160_filter = None
+        yield account.load()
+        self.assertTrue(account.receiving.might_own(derived))
+        self.assertFalse(account.change.might_own(derived))
+
+
 class TestSingleKeyAccount(unittest.TestCase):
 
     @defer.inlineCallbacks
@@ -232,7 +284,9 @@ class TestSingleKeyAccount(unittest.TestCase):
 
         # case #2: after use, still no new address needed
         records = yield account.receiving.get_address_records()
-        yield self.ledger.db.set_address_history(records[0]['address'], 'a:1:')
+        yield self.ledger.db.set_address_history(
+            records[0]['address'], [('aa', 1)], self.ledger.get_status_from_history([('aa', 1)])
+        )
         empty = yield account.receiving.ensure_address_gap()
         self.assertEqual(len(empty), 0)
 
@@ -246,7 +300,9 @@ class TestSingleKeyAccount(unittest.TestCase):
         address1 = yield account.receiving.get_or_create_usable_address()
         self.assertIsNotNone(address1)
 
-        yield self.ledger.db.set_address_history(address1, 'a:1:b:2:c:3:')
+        yield self.ledger.db.set_address_history(
+            address1, [('aa', 1), ('bb', 2), ('cc', 3)], self.ledger.get_status_from_history([('aa', 1), ('bb', 2), ('cc', 3)])
+        )
         records = yield account.receiving.get_address_records()
         self.assertEqual(records[0]['used_times'], 3)
 
@@ -1,5 +1,59 @@
+import os
+import time
+import shutil
+import sqlite3
+import asyncio
+import tempfile
 from unittest import TestCase
-from torba.basedatabase import constraints_to_sql
+
+from twisted.trial import unittest
+from twisted.internet import defer
+
+from torba.asyncdb import AsyncSQLiteConnection
+from torba.basedatabase import (
+    BaseDatabase, SQLiteMixin, MigrationProgressEvent, UnsupportedSchemaVersion,
+    constraints_to_sql, txid_to_bytes, history_to_status
+)
+from torba.coin.bitcoinsegwit import MainNetLedger as ledger_class
+from torba.constants import CENT
+from torba.wallet import Wallet
+
+from .helpers import AccountTestCase
+from .test_transaction import get_output, get_input, get_transaction
+
+
+# tables of the torba versions which came before versioned migrations
+BASELINE_SCHEMA = """
+    create table if not exists tx (
+        txid text primary key,
+        raw blob not null,
+        height integer not null,
+        is_verified boolean not null default 0
+    );
+    create table if not exists pubkey_address (
+        address text primary key,
+        account text not null,
+        chain integer not null,
+        position integer not null,
+        pubkey blob not null,
+        history text,
+        used_times integer not null default 0
+    );
+    create table if not exists txo (
+        txid text references tx,
+        txoid text primary key,
+        address text references pubkey_address,
+        position integer not null,
+        amount integer not null,
+        script blob not null,
+        is_reserved boolean not null default 0
+    );
+    create table if not exists txi (
+        txid text references tx,
+        txoid text references txo,
+        address text references pubkey_address
+    );
+"""
 
 
 class TestConstraintBuilder(TestCase):
@@ -12,12 +66,714 @@ class TestConstraintBuilder(TestCase):
             }
         }
         self.assertEqual(
-            constraints_to_sql(constraints, prepend_sql=''),
-            '(age > :ages__any_age__gt OR age < :ages__any_age__lt)'
+            constraints_to_sql(constraints, prepend_sql=''), (
+                '(age > :ages__any_age__gt OR age < :ages__any_age__lt)', {
+                    'ages__any_age__gt': 18,
+                    'ages__any_age__lt': 38
+                }
+            )
+        )
+        # caller's constraints are not modified
+        self.assertEqual(constraints, {'ages__any': {'age__gt': 18, 'age__lt': 38}})
+
+    def test_same_shape_reuses_compiled_sql(self):
+        sql1, values1 = constraints_to_sql({'height__lte': 10, 'is_reserved': 0})
+        sql2, values2 = constraints_to_sql({'is_reserved': 1, 'height__lte': 20})
+        self.assertIs(sql1, sql2)
+        self.assertEqual(sql1, ' AND height <= :height__lte AND is_reserved = :is_reserved')
+        self.assertEqual(values1, {'height__lte': 10, 'is_reserved': 0})
+        self.assertEqual(values2, {'height__lte': 20, 'is_reserved': 1})
+        self.assertEqual(constraints_to_sql({}), ('', {}))
+
+
+class TestReadersAndWriter(unittest.TestCase):
+
+    def setUp(self):
+        self.path = tempfile.mkdtemp()
+        self.db = BaseDatabase(os.path.join(self.path, 'blockchain.db'), readers=2)
+        return self.db.open()
+
+    @defer.inlineCallbacks
+    def tearDown(self):
+        # asyncio connections are closed by their own threads
+        yield self.db.close()
+        shutil.rmtree(self.path)
+
+    @defer.inlineCallbacks
+    def test_queries_do_not_wait_for_writes(self):
+        journal_mode = yield self.db.query_one_value("PRAGMA journal_mode", ())
+        self.assertEqual(journal_mode, 'wal')
+
+        finished = []
+
+        def slow_write(t):
+            t.execute("INSERT INTO tx (txid, raw, height) VALUES ('abcd', x'00', 1)")
+            time.sleep(0.2)
+            finished.append('write')
+
+        writing = self.db.db.runInteraction(slow_write)
+        count = yield self.db.query_one_value("SELECT COUNT(*) FROM tx", (), 0)
+        finished.append('query')
+        # query didn't queue behind the write and doesn't see it before it's committed
+        self.assertEqual(count, 0)
+        yield writing
+        self.assertEqual(finished, ['query', 'write'])
+        count = yield self.db.query_one_value("SELECT COUNT(*) FROM tx", (), 0)
+        self.assertEqual(count, 1)
+
+    @defer.inlineCallbacks
+    def test_readers_cannot_write(self):
+        with self.assertRaises(sqlite3.OperationalError):
+            yield self.db.run_query("DELETE FROM tx", ())
+
+
+class TestAsyncioReadersAndWriter(TestReadersAndWriter):
+
+    def setUp(self):
+        self.path = tempfile.mkdtemp()
+        self.db = BaseDatabase(os.path.join(self.path, 'blockchain.db'), use_asyncio=True)
+        return self.db.open()
+
+    @defer.inlineCallbacks
+    def test_interaction_is_rolled_back_on_error(self):
+        def insert_twice(t):
+            t.execute("INSERT INTO tx (txid, raw, height) VALUES (x'01', x'00', 1)")
+            t.execute("INSERT INTO tx (txid, raw, height) VALUES (x'01', x'00', 1)")
+        with self.assertRaises(sqlite3.IntegrityError):
+            yield self.db.db.runInteraction(insert_twice)
+        count = yield self.db.query_one_value("SELECT COUNT(*) FROM tx", (), 0)
+        self.assertEqual(count, 0)
+
+
+class TestAsyncSQLiteConnection(TestCase):
+
+    def setUp(self):
+        self.loop = asyncio.new_event_loop()
+        self.addCleanup(self.loop.close)
+        self.connection = AsyncSQLiteConnection(':memory:')
+        self.addCleanup(lambda: self.loop.run_until_complete(self.connection.aclose()))
+
+    def test_coroutines(self):
+        async def steps():
+            await self.connection.execute("CREATE TABLE item (id INTEGER PRIMARY KEY)")
+            await self.connection.run(lambda t: t.executemany("INSERT INTO item VALUES (?)", [(1,), (2,)]))
+            self.assertEqual(await self.connection.fetchall("SELECT id FROM item ORDER BY id"), [(1,), (2,)])
+            with self.assertRaises(sqlite3.IntegrityError):
+                await self.connection.execute("INSERT INTO item VALUES (1)")
+        self.loop.run_until_complete(steps())
+
+    def test_queued_queries_run_in_one_batch(self):
+        async def steps():
+            busy = self.connection.run(lambda t: time.sleep(0.1))
+            queries = [self.connection.fetchall("SELECT ?", (i,)) for i in range(100)]
+            return await asyncio.gather(busy, *queries)
+        results = self.loop.run_until_complete(steps())
+        self.assertEqual(results[1:], [[(i,)] for i in range(100)])
+        # the queries queued up while the connection was busy with the first job
+        self.assertLessEqual(self.connection.batches, 3)
+
+    def test_jobs_fail_when_connection_cant_be_opened(self):
+        connection = AsyncSQLiteConnection(os.path.join(tempfile.mkdtemp(), 'missing', 'blockchain.db'))
+
+        async def steps():
+            with self.assertRaises(sqlite3.OperationalError):
+                await connection.fetchall("SELECT 1")
+            with self.assertRaises(sqlite3.OperationalError):
+                await connection.execute("SELECT 1")
+            await connection.aclose()
+        self.loop.run_until_complete(asyncio.wait_for(steps(), 5))
+
+    def test_close_waits_for_queued_jobs(self):
+        async def steps():
+            busy = asyncio.ensure_future(self.connection.run(lambda t: time.sleep(0.1)))
+            query = asyncio.ensure_future(self.connection.fetchall("SELECT 1"))
+            await asyncio.sleep(0)
+            await self.connection.aclose()
+            await busy
+            self.assertEqual(await query, [(1,)])
+            with self.assertRaises(sqlite3.ProgrammingError):
+                await self.connection.fetchall("SELECT 1")
+        self.loop.run_until_complete(steps())
+
+
+class TestSQLiteMixinCoroutines(unittest.TestCase):
+
+    def setUp(self):
+        self.loop = asyncio.new_event_loop()
+        self.addCleanup(self.loop.close)
+        self.path = tempfile.mkdtemp()
+        self.db = BaseDatabase(os.path.join(self.path, 'blockchain.db'), use_asyncio=True)
+        return self.db.open()
+
+    def tearDown(self):
+        shutil.rmtree(self.path)
+        return self.db.close()
+
+    def test_coroutines(self):
+        async def steps():
+            await self.db.run_operation_async(
+                "INSERT INTO tx (txid, raw, height) VALUES (x'01', x'00', 5)", ()
+            )
+            await self.db.run_interaction_async(
+                lambda t: t.execute("INSERT INTO tx (txid, raw, height) VALUES (x'02', x'00', 7)")
+            )
+            return await self.db.query_one_value_async("SELECT SUM(height) FROM tx", ())
+        self.assertEqual(self.loop.run_until_complete(steps()), 12)
+
+    @defer.inlineCallbacks
+    def test_coroutines_need_asyncio(self):
+        db = BaseDatabase(':memory:')
+        yield db.open()
+        self.addCleanup(db.close)
+        with self.assertRaises(RuntimeError):
+            self.loop.run_until_complete(db.run_query_async("SELECT 1", ()))
+
+
+class TestBulkInsert(unittest.TestCase):
+
+    def setUp(self):
+        self.db = BaseDatabase(':memory:')
+        return self.db.open()
+
+    def tearDown(self):
+        return self.db.close()
+
+    @defer.inlineCallbacks
+    def test_insert_many_in_chunks(self):
+        rows = (('{:064x}'.format(i), sqlite3.Binary(b'\x00'), i) for i in range(25000))
+        yield self.db.insert_many('tx', ('txid', 'raw', 'height'), rows, chunk_size=1000)
+        count = yield self.db.query_one_value("SELECT COUNT(*) FROM tx", ())
+        self.assertEqual(count, 25000)
+
+    @defer.inlineCallbacks
+    def test_insert_many_is_one_transaction(self):
+        rows = [('{:064x}'.format(i), sqlite3.Binary(b'\x00'), i) for i in range(2500)]
+        rows.append(rows[0])  # primary key violation in the last chunk
+        with self.assertRaises(sqlite3.IntegrityError):
+            yield self.db.insert_many('tx', ('txid', 'raw', 'height'), rows, chunk_size=1000)
+        count = yield self.db.query_one_value("SELECT COUNT(*) FROM tx", (), 0)
+        self.assertEqual(count, 0)
+
+
+class TestQueryPlans(AccountTestCase):
+
+    @defer.inlineCallbacks
+    def setUp(self):
+        yield super().setUp()
+        self.plans = []
+        run_query = self.ledger.db.run_query
+
+        def explain(sql, values):
+            d = run_query("EXPLAIN QUERY PLAN " + sql, values)
+            d.addCallback(lambda plan: self.plans.append([row[-1] for row in plan]) or [])
+            return d
+        self.ledger.db.run_query = explain
+
+    def assertUsesIndexes(self):
+        self.assertTrue(self.plans)
+        for plan in self.plans:
+            for step in plan:
+                self.assertFalse(step.startswith('SCAN'), "full table scan in: {}".format(plan))
+        self.plans.clear()
+
+    @defer.inlineCallbacks
+    def test_balance_and_utxos_use_indexes(self):
+        yield self.ledger.db.get_balance_for_account(self.account)
+        self.assertIn('SEARCH txo USING INDEX txo_unspent_idx (address=?)', self.plans[0])
+        self.assertUsesIndexes()
+        yield self.ledger.db.get_balance_for_account(self.account, height__lte=10, height__not=-2)
+        self.assertUsesIndexes()
+        yield self.ledger.db.get_utxos_for_account(self.account)
+        self.assertIn('SEARCH txo USING INDEX txo_unspent_idx (address=?)', self.plans[0])
+        self.assertUsesIndexes()
+
+    @defer.inlineCallbacks
+    def test_pages_use_indexes(self):
+        yield self.ledger.db.get_utxos_page_for_account(self.account, after=(0, 5, 10), limit=10)
+        self.assertIn(
+            'SEARCH pubkey_address USING INDEX pubkey_address_account_idx '
+            '(account=? AND (chain,position)>(?,?))', self.plans[0]
         )
+        self.assertUsesIndexes()
+        yield self.ledger.db.get_addresses_page(self.account, after=(0, 5), limit=10)
+        self.assertUsesIndexes()
+
+    @defer.inlineCallbacks
+    def test_address_queries_use_indexes(self):
+        yield self.ledger.db.get_addresses(self.account, 0, max_used_times=1, order_by='used_times ASC, position ASC')
+        self.assertUsesIndexes()
+        yield self.ledger.db.get_address_statuses(self.account, {0: 10})
+        self.assertUsesIndexes()
+
+
+class TestSpentOutputs(AccountTestCase):
+
+    @defer.inlineCallbacks
+    def test_spending_marks_output_spent(self):
+        address = (yield self.account.ensure_address_gap())[0]
+        hash160 = self.ledger.address_to_hash160(address)
+        funding = self.ledger.transaction_class() \
+            .add_inputs([get_input()]) \
+            .add_outputs([get_output(CENT, hash160)])
+        yield self.ledger.db.save_transaction_io('insert', funding, 1, True, address, hash160, 0, [], None)
+        self.assertEqual((yield self.ledger.db.get_balance_for_account(self.account)), CENT)
+        self.assertEqual(len((yield self.ledger.db.get_utxos_for_account(self.account))), 1)
+
+        spending = self.ledger.transaction_class() \
+            .add_inputs([self.ledger.transaction_class.input_class.spend(funding.outputs[0])]) \
+            .add_outputs([get_output(CENT)])
+        yield self.ledger.db.save_transaction_io('insert', spending, 2, True, address, hash160, 1, [], None)
+        self.assertEqual((yield self.ledger.db.get_balance_for_account(self.account)), 0)
+        self.assertEqual((yield self.ledger.db.get_utxos_for_account(self.account)), [])
+        is_spent = yield self.ledger.db.query_one_value(
+            "SELECT is_spent FROM txo WHERE txid = ? AND position = 0", (funding.hash,)
+        )
+        self.assertEqual(is_spent, 1)
+
+    @defer.inlineCallbacks
+    def test_dropping_orphaned_spend_unspends_outputs(self):
+        db = self.ledger.db
+        address = (yield self.account.ensure_address_gap())[0]
+        hash160 = self.ledger.address_to_hash160(address)
+        funding = self.ledger.transaction_class() \
+            .add_inputs([get_input()]) \
+            .add_outputs([get_output(CENT, hash160), get_output(2*CENT, hash160)])
+        spend = self.ledger.transaction_class.input_class.spend
+        spending = self.ledger.transaction_class() \
+            .add_inputs([spend(funding.outputs[0]), spend(funding.outputs[1])]) \
+            .add_outputs([get_output(3*CENT)])
+        # conflicting spend of the second output, still in the mempool
+        respending = self.ledger.transaction_class() \
+            .add_inputs([spend(funding.outputs[1])]) \
+            .add_outputs([get_output(2*CENT)])
+        yield db.save_transaction_io('insert', funding, 1, True, address, hash160, 0, [(funding.id, 1)], None)
+        yield db.save_transaction_io('insert', spending, 2, True, address, hash160, 1, [(spending.id, 2)], None)
+        yield db.save_transaction_io('insert', respending, 0, False, address, hash160, 2, [(respending.id, 0)], None)
+        self.assertEqual((yield db.get_balance_for_account(self.account)), 0)
+
+        _, orphaned = yield db.rewind_blockchain(1)
+        self.assertEqual(orphaned, [spending.id])
+        # orphaned transactions keep their inputs until they are dropped
+        self.assertEqual((yield db.get_balance_for_account(self.account)), 0)
+        self.assertEqual((yield db.delete_unreferenced_transactions(orphaned)), [spending.id])
+
+        is_spent = yield db.run_query("SELECT position, is_spent FROM txo ORDER BY position", ())
+        self.assertEqual(is_spent, [(0, 0), (1, 1)])
+        self.assertEqual((yield db.get_balance_for_account(self.account)), CENT)
+        self.assertEqual((yield db.get_cached_balance_for_account(self.account)), CENT)
+        utxos = yield db.get_utxos_for_account(self.account)
+        self.assertEqual([(utxo.tx_ref.id, utxo.position) for utxo in utxos], [(funding.id, 0)])
+
+
+class TestSpentOutputsWithAsyncio(TestSpentOutputs):
+    use_asyncio = True
+
+
+class TestMigrations(unittest.TestCase):
+
+    class Database(SQLiteMixin):
+
+        def _add_total(self, t, after):
+            t.execute("ALTER TABLE item ADD COLUMN total integer")
+
+        def _fill_total(self, t, after):
+            rows = t.execute(
+                "SELECT rowid FROM item WHERE rowid > ? ORDER BY rowid LIMIT ?",
+                (after or 0, self.MIGRATION_CHUNK_SIZE)
+            ).fetchall()
+            t.executemany("UPDATE item SET total = rowid * 2 WHERE rowid = ?", rows)
+            if len(rows) < self.MIGRATION_CHUNK_SIZE:
+                return None
+            after = rows[-1][0]
+            return t.execute("SELECT COUNT(*) FROM item WHERE rowid > ?", (after,)).fetchone()[0], after
+
+        MIGRATIONS = (_add_total, _fill_total)
+        MIGRATION_CHUNK_SIZE = 2
+        CREATE_TABLES_QUERY = "create table if not exists item (name text, total integer);"
+
+    def setUp(self):
+        self.path = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.path)
+        self.db_path = os.path.join(self.path, 'items.db')
+
+    @defer.inlineCallbacks
+    def test_new_database_starts_at_latest_version(self):
+        db = self.Database(self.db_path)
+        yield db.open()
+        self.addCleanup(db.close)
+        self.assertEqual((yield db.query_one_value("PRAGMA user_version", ())), 2)
+        self.assertEqual((yield db.run_query("PRAGMA table_info(item)", ()))[1][1], 'total')
+
+    @defer.inlineCallbacks
+    def test_migrations_run_in_chunks_and_report_progress(self):
+        old = sqlite3.connect(self.db_path)
+        old.executescript("""
+            create table item (name text);
+            insert into item values ('a'), ('b'), ('c'), ('d'), ('e');
+        """)
+        old.close()
+        db = self.Database(self.db_path)
+        events = []
+        db.on_migration_progress.listen(events.append)
+        yield db.open()
+        self.addCleanup(db.close)
+        self.assertEqual(events, [
+            MigrationProgressEvent(1, 'add_total', 0, 0),
+            MigrationProgressEvent(2, 'fill_total', 0, 3),
+            MigrationProgressEvent(2, 'fill_total', 2, 3),
+            MigrationProgressEvent(2, 'fill_total', 3, 3),
+        ])
+        self.assertEqual((yield db.query_one_value("PRAGMA user_version", ())), 2)
+        self.assertEqual(
+            (yield db.run_query("SELECT total FROM item ORDER BY rowid", ())), [(2,), (4,), (6,), (8,), (10,)]
+        )
+
+    @defer.inlineCallbacks
+    def test_newer_database_is_not_opened(self):
+        newer = sqlite3.connect(self.db_path)
+        newer.executescript("""
+            create table item (name text, total integer, other integer);
+            pragma user_version = 3;
+        """)
+        newer.close()
+        db = self.Database(self.db_path)
+        self.addCleanup(db.close)
+        with self.assertRaises(UnsupportedSchemaVersion):
+            yield db.open()
+        newer = sqlite3.connect(self.db_path)
+        self.addCleanup(newer.close)
+        self.assertEqual(newer.execute("PRAGMA user_version").fetchone()[0], 3)
+
+    @defer.inlineCallbacks
+    def test_interrupted_migration_resumes(self):
+        old = sqlite3.connect(self.db_path)
+        old.executescript("""
+            create table item (name text, total integer);
+            insert into item values ('a', 2), ('b', null), ('c', null);
+            pragma user_version = 1;
+        """)
+        old.close()
+        db = self.Database(self.db_path)
+        events = []
+        db.on_migration_progress.listen(events.append)
+        yield db.open()
+        self.addCleanup(db.close)
+        self.assertEqual({event.name for event in events}, {'fill_total'})
         self.assertEqual(
-            constraints, {
-                'ages__any_age__gt': 18,
-                'ages__any_age__lt': 38
+            (yield db.run_query("SELECT total FROM item ORDER BY rowid", ())), [(2,), (4,), (6,)]
+        )
+
+
+class TestAccountBalances(AccountTestCase):
+
+    @defer.inlineCallbacks
+    def setUp(self):
+        yield super().setUp()
+        self.address = (yield self.account.ensure_address_gap())[0]
+        self.hash160 = self.ledger.address_to_hash160(self.address)
+
+    @defer.inlineCallbacks
+    def assertBalancesMatch(self, **expected):
+        db = self.ledger.db
+        for max_height, include_reserved, balance in [
+                (None, False, expected['unconfirmed']), (None, True, expected['reserved']),
+                (5, False, expected['confirmed'])]:
+            constraints = {}
+            if max_height is not None:
+                constraints = {'height__lte': max_height, 'height__gt': 0, 'is_verified': 1}
+            full = yield db.get_balance_for_account(self.account, include_reserved, **constraints)
+            cached = yield db.get_cached_balance_for_account(self.account, max_height, include_reserved)
+            self.assertEqual((full, cached), (balance, balance))
+        totals = yield db.run_query("SELECT * FROM account_balance ORDER BY height, is_reserved", ())
+        yield db.recompute_balances()
+        recomputed = yield db.run_query("SELECT * FROM account_balance ORDER BY height, is_reserved", ())
+        self.assertEqual(totals, recomputed)
+
+    @defer.inlineCallbacks
+    def test_balances_follow_every_change(self):
+        db = self.ledger.db
+        funding = self.ledger.transaction_class() \
+            .add_inputs([get_input()]) \
+            .add_outputs([get_output(CENT, self.hash160), get_output(2*CENT, self.hash160)])
+        yield db.save_transaction_io('insert', funding, 0, False, self.address, self.hash160, 0, [], None)
+        yield self.assertBalancesMatch(unconfirmed=3*CENT, reserved=3*CENT, confirmed=0)
+
+        yield db.confirm_transactions([(funding.id, 3, 0, None)])
+        yield self.assertBalancesMatch(unconfirmed=3*CENT, reserved=3*CENT, confirmed=0)
+        yield db.set_verified([(funding.id, 1, None)])
+        yield self.assertBalancesMatch(unconfirmed=3*CENT, reserved=3*CENT, confirmed=3*CENT)
+
+        yield db.reserve_outputs([funding.outputs[0]])
+        yield self.assertBalancesMatch(unconfirmed=2*CENT, reserved=3*CENT, confirmed=2*CENT)
+        yield db.release_outputs([funding.outputs[0]])
+        yield self.assertBalancesMatch(unconfirmed=3*CENT, reserved=3*CENT, confirmed=3*CENT)
+
+        spending = self.ledger.transaction_class() \
+            .add_inputs([self.ledger.transaction_class.input_class.spend(funding.outputs[1])]) \
+            .add_outputs([get_output(CENT, self.hash160)])
+        yield db.save_transaction_io('insert', spending, 4, True, self.address, self.hash160, 1, [], None)
+        yield self.assertBalancesMatch(unconfirmed=2*CENT, reserved=2*CENT, confirmed=2*CENT)
+
+        yield db.rewind_blockchain(3)
+        yield self.assertBalancesMatch(unconfirmed=2*CENT, reserved=2*CENT, confirmed=CENT)
+        yield db.rewind_blockchain(2)
+        yield self.assertBalancesMatch(unconfirmed=2*CENT, reserved=2*CENT, confirmed=0)
+
+    @defer.inlineCallbacks
+    def test_settled_blocks_share_one_bucket(self):
+        db = self.ledger.db
+        db.BALANCE_SETTLED_DEPTH = 2
+        for height in (2, 3, 4):
+            tx = self.ledger.transaction_class() \
+                .add_inputs([get_input(height)]) \
+                .add_outputs([get_output(CENT, self.hash160)])
+            yield db.save_transaction_io('insert', tx, height, True, self.address, self.hash160, 0, [], None)
+        yield db.settle_balances(5)
+        yield db.settle_balances(4)  # the cutoff never moves back
+        totals = yield db.run_query("SELECT height, amount FROM account_balance ORDER BY height", ())
+        self.assertEqual(totals, [(1, 2*CENT), (4, CENT)])
+        for max_height, balance in ((None, 3*CENT), (4, 3*CENT), (3, 2*CENT), (2, CENT), (1, 0)):
+            cached = yield db.get_cached_balance_for_account(self.account, max_height)
+            self.assertEqual(cached, balance)
+        yield self.assertBalancesMatch(unconfirmed=3*CENT, reserved=3*CENT, confirmed=3*CENT)
+        yield db.rewind_blockchain(2)
+        yield self.assertBalancesMatch(unconfirmed=3*CENT, reserved=3*CENT, confirmed=CENT)
+
+    @defer.inlineCallbacks
+    def test_account_balance_reads_totals(self):
+        funding = self.ledger.transaction_class() \
+            .add_inputs([get_input()]) \
+            .add_outputs([get_output(CENT, self.hash160)])
+        yield self.ledger.db.save_transaction_io(
+            'insert', funding, 1, True, self.address, self.hash160, 0, [], None
+        )
+        self.ledger.headers._size = 2  # height 1
+        self.assertEqual((yield self.account.get_balance(0)), CENT)
+        self.assertEqual((yield self.account.get_balance(1)), CENT)
+        self.assertEqual((yield self.account.get_balance(2)), 0)
+        self.assertEqual((yield self.account.get_balance(1, amount__gt=CENT)), 0)
+
+
+class TestPagination(AccountTestCase):
+
+    @defer.inlineCallbacks
+    def setUp(self):
+        yield super().setUp()
+        yield self.account.ensure_address_gap()
+
+    @defer.inlineCallbacks
+    def test_utxo_pages(self):
+        addresses = yield self.account.receiving.get_addresses(3)
+        for address in addresses:
+            hash160 = self.ledger.address_to_hash160(address)
+            funding = self.ledger.transaction_class() \
+                .add_inputs([get_input()]) \
+                .add_outputs([get_output(CENT*i, hash160) for i in range(1, 5)])
+            yield self.ledger.db.save_transaction_io('insert', funding, 1, True, address, hash160, 0, [], None)
+
+        pages = []
+        yield self.ledger.db.iterate_pages(self.account.get_unspent_outputs_page, pages.append, limit=5)
+        self.assertEqual([len(page) for page in pages], [5, 5, 2])
+        streamed = [txo.id for page in pages for txo in page]
+        self.assertEqual(len(set(streamed)), 12)
+        everything = yield self.account.get_unspent_outputs()
+        self.assertEqual(set(streamed), {txo.id for txo in everything})
+
+        pages = []
+        yield self.ledger.db.iterate_pages(
+            self.account.get_unspent_outputs_page, pages.append, limit=5, amount__gt=2*CENT
+        )
+        self.assertEqual([len(page) for page in pages], [5, 1])
+
+    @defer.inlineCallbacks
+    def test_address_pages(self):
+        pages = []
+        yield self.ledger.db.iterate_pages(self.ledger.db.get_addresses_page, pages.append, self.account, limit=7)
+        self.assertEqual([len(page) for page in pages], [7, 7, 7, 5])
+        streamed = [(record['chain'], record['position']) for page in pages for record in page]
+        self.assertEqual(streamed, sorted(streamed))
+        self.assertEqual(streamed, [(0, i) for i in range(20)] + [(1, i) for i in range(6)])
+
+        records, after = yield self.ledger.db.get_addresses_page(self.account, 1, limit=10)
+        self.assertEqual((len(records), after), (6, None))
+
+    @defer.inlineCallbacks
+    def test_dict_value_pages(self):
+        pages = []
+        yield self.ledger.db.iterate_pages(
+            self.ledger.db.query_dict_value_page, pages.append,
+            "SELECT {} FROM pubkey_address WHERE chain = :chain", ('address', 'position'), ('address',),
+            {'chain': 0}, limit=8
+        )
+        self.assertEqual([len(page) for page in pages], [8, 8, 4])
+        streamed = [record['address'] for page in pages for record in page]
+        self.assertEqual(streamed, sorted((yield self.account.receiving.get_addresses())))
+
+
+class BaselineMigrationTestCase(unittest.TestCase):
+
+    use_asyncio = False
+
+    def setUp(self):
+        path = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, path)
+        self.db_path = os.path.join(path, 'blockchain.db')
+        self.ledger = ledger_class({
+            'db': ledger_class.database_class(self.db_path, use_asyncio=self.use_asyncio),
+            'headers': ledger_class.headers_class(':memory:'),
+        })
+        self.ledger.db.MIGRATION_CHUNK_SIZE = 1
+        self.account = self.ledger.account_class.generate(self.ledger, Wallet(), "torba")
+        self.keys = [self.account.public_key.child(0).child(position) for position in range(3)]
+
+    def create_baseline(self, addresses, script=''):
+        """ Creates a database with the baseline schema and the given addresses,
+            a list of (key, history string) tuples, as torba used to save them. """
+        baseline = sqlite3.connect(self.db_path)
+        baseline.executescript(BASELINE_SCHEMA + script)
+        baseline.executemany(
+            "insert into pubkey_address (address, account, chain, position, pubkey, history) "
+            "values (?, ?, 0, ?, ?, ?)", [
+                (key.address, self.account.public_key.address, position, key.pubkey_bytes, history)
+                for position, (key, history) in enumerate(addresses)
+            ]
+        )
+        baseline.commit()
+        baseline.close()
+
+    @defer.inlineCallbacks
+    def open(self):
+        yield self.ledger.db.open()
+        self.addCleanup(self.ledger.db.close)
+
+
+class TestBaselineMigration(BaselineMigrationTestCase):
+
+    @staticmethod
+    def get_schema(db):
+        """ Columns of each table and the tables of each index and trigger. """
+        def _get_schema(t):
+            objects = t.execute("SELECT type, name, tbl_name FROM sqlite_master").fetchall()
+            return {
+                name: t.execute("PRAGMA table_info({})".format(name)).fetchall() if kind == 'table' else table
+                for kind, name, table in objects
             }
+        return db.db.runInteraction(_get_schema)
+
+    @defer.inlineCallbacks
+    def test_baseline_database_is_upgraded_to_current_schema(self):
+        self.create_baseline([(self.keys[0], 'aa'*32+':5:'), (self.keys[1], None)])
+        events = []
+        self.ledger.db.on_migration_progress.listen(events.append)
+        yield self.open()
+        db = self.ledger.db
+        self.assertEqual(
+            sorted({(event.version, event.name) for event in events}),
+            [(version+1, migration.__name__.strip('_')) for version, migration in enumerate(db.MIGRATIONS)]
+        )
+        self.assertEqual((yield db.query_one_value("PRAGMA user_version", ())), len(db.MIGRATIONS))
+
+        new = BaseDatabase(':memory:')
+        yield new.open()
+        self.addCleanup(new.close)
+        self.assertEqual((yield self.get_schema(db)), (yield self.get_schema(new)))
+
+    @defer.inlineCallbacks
+    def test_stored_keys_get_their_scripthash(self):
+        self.create_baseline([(self.keys[0], None), (self.keys[1], None)])
+        yield self.open()
+        scripthashes = yield self.ledger.db.run_query(
+            "SELECT address, scripthash FROM pubkey_address ORDER BY position", ()
+        )
+        self.assertEqual(scripthashes, [
+            (key.address, self.ledger.hash160_to_scripthash(key.identifier())) for key in self.keys[:2]
+        ])
+        # keys can be added again after the migration
+        addresses = yield self.account.receiving.ensure_address_gap()
+        self.assertEqual(len(addresses), self.account.receiving.gap - 2)
+
+    @defer.inlineCallbacks
+    def test_remote_statuses_can_be_stored(self):
+        self.create_baseline([(self.keys[0], None)])
+        yield self.open()
+        yield self.ledger.db.set_remote_statuses([(self.keys[0].address, 'ab'*32)])
+        statuses = yield self.ledger.db.run_query("SELECT remote_status FROM pubkey_address", ())
+        self.assertEqual(statuses, [('ab'*32,)])
+
+    @defer.inlineCallbacks
+    def test_merkle_proofs_can_be_stored(self):
+        self.create_baseline([(self.keys[0], None)])
+        yield self.open()
+        key = self.keys[0]
+        tx = get_transaction(get_output(1, key.identifier()))
+        yield self.ledger.db.save_transaction_io(
+            'insert', tx, 5, True, key.address, key.identifier(), 0, [(tx.id, 5)], None, (b'\x01'*32, 1)
         )
+        proofs = yield self.ledger.db.get_merkle_proofs([tx.id])
+        self.assertEqual(proofs, {tx.id: (b'\x01'*32, 1)})
+        # more txids than SQLite takes as query parameters
+        proofs = yield self.ledger.db.get_merkle_proofs(['{:064x}'.format(i) for i in range(1000)] + [tx.id])
+        self.assertEqual(proofs, {tx.id: (b'\x01'*32, 1)})
+
+
+class TestAddressHistoryMigration(BaselineMigrationTestCase):
+
+    @defer.inlineCallbacks
+    def test_history_strings_become_rows(self):
+        a, b = 'aa'*31+'01', 'bb'*31+'02'
+        self.create_baseline([
+            (self.keys[0], '{}:5:{}:6:'.format(a, b)), (self.keys[1], None), (self.keys[2], '{}:0:'.format(b))
+        ])
+        yield self.open()
+        db = self.ledger.db
+        self.assertEqual((yield db.get_address_history(self.keys[0].address)), [(a, 5), (b, 6)])
+        self.assertEqual((yield db.get_address_history(self.keys[1].address)), [])
+        self.assertEqual((yield db.get_address_history(self.keys[2].address)), [(b, 0)])
+        statuses = yield db.run_query("SELECT address, status FROM pubkey_address ORDER BY position", ())
+        self.assertEqual(statuses, [
+            (self.keys[0].address, history_to_status([(a, 5), (b, 6)])),
+            (self.keys[1].address, None),
+            (self.keys[2].address, history_to_status([(b, 0)])),
+        ])
+        columns = yield db.run_query("PRAGMA table_info(pubkey_address)", ())
+        self.assertNotIn('history', [column[1] for column in columns])
+        tables = yield db.run_query("SELECT name FROM sqlite_master WHERE name = 'new_pubkey_address'", ())
+        self.assertEqual(tables, [])
+
+
+class TestBinaryTxidMigration(BaselineMigrationTestCase):
+
+    @defer.inlineCallbacks
+    def test_text_txids_become_binary(self):
+        a, b = 'aa'*31+'01', 'bb'*31+'02'
+        address = self.keys[0].address
+        self.create_baseline([(self.keys[0], '{}:5:{}:6:'.format(a, b))], """
+            insert into tx (txid, raw, height, is_verified) values
+                ('{a}', x'01', 5, 1), ('{b}', x'02', 6, 1);
+            insert into txo (txid, txoid, address, position, amount, script) values
+                ('{a}', '{a}:0', '{address}', 0, 1, x''), ('{a}', '{a}:1', '{address}', 1, 1, x'');
+            insert into txi values ('{b}', '{a}:1', '{address}');
+        """.format(a=a, b=b, address=address))
+        events = []
+        self.ledger.db.on_migration_progress.listen(events.append)
+        yield self.open()
+        db = self.ledger.db
+        self.assertEqual(
+            [event.done for event in events if event.name == 'store_binary_txids'],
+            list(range(11))
+        )
+        self.assertEqual((yield db.query_one_value("PRAGMA user_version", ())), len(db.MIGRATIONS))
+        self.assertEqual((yield db.get_transaction(a)), (b'\x01', 5, 1))
+        self.assertEqual((yield db.get_address_history(address)), [(a, 5), (b, 6)])
+        txos = yield db.run_query("SELECT txid, position, is_spent FROM txo ORDER BY position", ())
+        self.assertEqual(txos, [(txid_to_bytes(a), 0, 0), (txid_to_bytes(a), 1, 1)])
+        txis = yield db.run_query("SELECT txid, txo_txid, txo_position FROM txi", ())
+        self.assertEqual(txis, [(txid_to_bytes(b), txid_to_bytes(a), 1)])
+        balances = yield db.run_query("SELECT * FROM account_balance", ())
+        self.assertEqual(balances, [(self.account.public_key.address, 5, 1, 0, 1)])
+        tables = yield db.run_query("SELECT name FROM sqlite_master WHERE name LIKE 'old_%'", ())
+        self.assertEqual(tables, [])
+
+
+class TestBinaryTxidMigrationWithAsyncio(TestBinaryTxidMigration):
+    use_asyncio = True
@@ -1,9 +1,10 @@
 import os
 from binascii import hexlify
-from twisted.internet import defer
+from twisted.internet import defer, reactor, task
 
 from torba.coin.bitcoinsegwit import MainNetLedger
 from torba.wallet import Wallet
+from torba.hash import sha256
 
 from .test_transaction import get_transaction, get_output
 from .test_headers import BitcoinHeadersTestCase, block_bytes
@@ -17,15 +18,43 @@ class MockNetwork:
         self.address = None
         self.get_history_called = []
         self.get_transaction_called = []
+        self.subscribe_addresses_called = []
+        self.statuses = {}
+        self.merkle = {}
+        self.get_merkles_called = []
+        self.histories = {}
+        self.get_histories_called = []
 
     def get_history(self, address):
         self.get_history_called.append(address)
         self.address = address
+        return defer.succeed(self.histories.get(address, self.history))
+
+    def get_histories(self, addresses):
+        self.get_histories_called.append(addresses)
+        return defer.succeed([self.histories.get(a, []) for a in addresses])
+
+    def subscribe_addresses(self, addresses):
+        self.subscribe_addresses_called.append(addresses)
+        return defer.succeed([self.statuses.get(a) for a in addresses])
+
+    def get_history_by_scripthash(self, scripthash):
+        self.get_history_called.append(scripthash)
         return defer.succeed(self.history)
 
+    def subscribe_scripthashes(self, scripthashes):
+        self.subscribe_addresses_called.append(scripthashes)
+        return defer.succeed([self.statuses.get(s) for s in scripthashes])
+
     def get_merkle(self, txid, height):
         return {'merkle': ['abcd01'], 'pos': 1}
 
+    def get_merkles(self, txids_and_heights):
+        self.get_merkles_called.append(txids_and_heights)
+        return defer.succeed([
+            self.merkle.get(txid, {'merkle': ['abcd01'], 'pos': 1}) for txid, _ in txids_and_heights
+        ])
+
     def get_transaction(self, tx_hash):
         self.get_transaction_called.append(tx_hash)
         return defer.succeed(self.transaction[tx_hash])
@@ -73,8 +102,8 @@ class TestSynchronization(LedgerTestCase):
     def test_update_history(self):
         account = self.ledger.account_class.generate(self.ledger, Wallet(), "torba")
         address = yield account.receiving.get_or_create_usable_address()
-        address_details = yield self.ledger.db.get_address(address)
-        self.assertEqual(address_details['history'], None)
+        history = yield self.ledger.db.get_address_history(address)
+        self.assertEqual(history, [])
 
         self.add_header(block_height=0, merkle_root=b'abcd04')
         self.add_header(block_height=1, merkle_root=b'abcd04')
@@ -89,12 +118,19 @@ class TestSynchronization(LedgerTestCase):
             'abcd02': hexlify(get_transaction(get_output(2)).raw),
             'abcd03': hexlify(get_transaction(get_output(3)).raw),
         })
+        progress = []
+        self.ledger.on_sync_progress.listen(progress.append)
         yield self.ledger.update_history(address)
+        self.assertTrue(progress[-1].is_synced)
+        self.assertEqual(
+            (progress[-1].addresses_synced, progress[-1].transactions_fetched, progress[-1].transactions_total),
+            (1, 3, 3)
+        )
         self.assertEqual(self.ledger.network.get_history_called, [address])
         self.assertEqual(self.ledger.network.get_transaction_called, ['abcd01', 'abcd02', 'abcd03'])
 
-        address_details = yield self.ledger.db.get_address(address)
-        self.assertEqual(address_details['history'], 'abcd01:0:abcd02:1:abcd03:2:')
+        history = yield self.ledger.db.get_address_history(address)
+        self.assertEqual(history, [('abcd01', 0), ('abcd02', 1), ('abcd03', 2)])
 
         self.ledger.network.get_history_called = []
         self.ledger.network.get_transaction_called = []
@@ -102,6 +138,14 @@ class TestSynchronization(LedgerTestCase):
         self.assertEqual(self.ledger.network.get_history_called, [address])
         self.assertEqual(self.ledger.network.get_transaction_called, [])
 
+        # synced transactions are cached
+        tx = get_transaction(get_output(2))
+        misses = self.ledger.transaction_cache.misses
+        cached = yield self.ledger.get_transaction(tx.id)
+        self.assertEqual(cached.id, tx.id)
+        self.assertIs((yield self.ledger.get_transaction(tx.id)), cached)
+        self.assertEqual(self.ledger.transaction_cache.misses, misses)
+
         self.ledger.network.history.append({'tx_hash': 'abcd04', 'height': 3})
         self.ledger.network.transaction['abcd04'] = hexlify(get_transaction(get_output(4)).raw)
         self.ledger.network.get_history_called = []
@@ -109,8 +153,525 @@ class TestSynchronization(LedgerTestCase):
         yield self.ledger.update_history(address)
         self.assertEqual(self.ledger.network.get_history_called, [address])
         self.assertEqual(self.ledger.network.get_transaction_called, ['abcd04'])
+        history = yield self.ledger.db.get_address_history(address)
+        self.assertEqual(history, [('abcd01', 0), ('abcd02', 1), ('abcd03', 2), ('abcd04', 3)])
+        status = yield self.ledger.get_local_status(address)
+        self.assertEqual(
+            status, hexlify(sha256(b'abcd01:0:abcd02:1:abcd03:2:abcd04:3:')).decode()
+        )
+
+        # server dropped a transaction, history is rewritten from the first difference
+        del self.ledger.network.history[1]
+        yield self.ledger.update_history(address)
+        history = yield self.ledger.db.get_address_history(address)
+        self.assertEqual(history, [('abcd01', 0), ('abcd03', 2), ('abcd04', 3)])
+        address_details = yield self.ledger.db.get_address(address)
+        self.assertEqual(address_details['used_times'], 3)
+        status = yield self.ledger.get_local_status(address)
+        self.assertEqual(status, hexlify(sha256(b'abcd01:0:abcd03:2:abcd04:3:')).decode())
+        self.assertEqual(address_details['status'], status)
+
+    @defer.inlineCallbacks
+    def test_rewind_blockchain(self):
+        account = self.ledger.account_class.generate(self.ledger, Wallet(), "torba")
+        address = yield account.receiving.get_or_create_usable_address()
+        for height in range(4):
+            self.add_header(block_height=height, merkle_root=b'abcd04')
+        self.ledger.network = MockNetwork([
+            {'tx_hash': 'abcd01', 'height': 1},
+            {'tx_hash': 'abcd02', 'height': 2},
+            {'tx_hash': 'abcd03', 'height': 3},
+        ], {
+            'abcd01': hexlify(get_transaction(get_output(1)).raw),
+            'abcd02': hexlify(get_transaction(get_output(2)).raw),
+            'abcd03': hexlify(get_transaction(get_output(3)).raw),
+        })
+        yield self.ledger.update_history(address)
+        tx1, tx2 = get_transaction(get_output(1)), get_transaction(get_output(2))
+
+        # block 2 got orphaned, its transaction is back in the mempool
+        self.ledger.network.history = [
+            {'tx_hash': 'abcd01', 'height': 1},
+            {'tx_hash': 'abcd03', 'height': 3},
+            {'tx_hash': 'abcd02', 'height': 0},
+        ]
+        synced = self.ledger.on_sync_progress.deferred_where(lambda event: event.is_synced)
+        rewound = yield self.ledger.rewind_blockchain(1)
+        self.assertEqual(rewound, [address])
+
+        _, height, _ = yield self.ledger.db.get_transaction(tx1.id)
+        self.assertEqual(height, 1)
+        _, height, is_verified = yield self.ledger.db.get_transaction(tx2.id)
+        self.assertEqual((height, is_verified), (0, 0))
+
+        # rewound address is synced again
+        yield synced
+        history = yield self.ledger.db.get_address_history(address)
+        self.assertEqual(history, [('abcd01', 1), ('abcd03', 3), ('abcd02', 0)])
+        status = yield self.ledger.get_local_status(address)
+        self.assertEqual(status, hexlify(sha256(b'abcd01:1:abcd03:3:abcd02:0:')).decode())
+
+        # nothing above the tip, nothing to rewind
+        rewound = yield self.ledger.db.rewind_blockchain(3)
+        self.assertEqual(rewound, ([], []))
+
+    @defer.inlineCallbacks
+    def test_orphaned_transaction_not_mined_again_is_deleted(self):
+        account = self.ledger.account_class.generate(self.ledger, Wallet(), "torba")
+        address = yield account.receiving.get_or_create_usable_address()
+        hash160 = self.ledger.address_to_hash160(address)
+        for height in range(4):
+            self.add_header(block_height=height, merkle_root=b'abcd04')
+        tx1, tx2, tx3 = (get_transaction(get_output(amount, hash160)) for amount in (1, 2, 3))
+        self.ledger.network = MockNetwork([
+            {'tx_hash': tx1.id, 'height': 1},
+            {'tx_hash': tx2.id, 'height': 2},
+            {'tx_hash': tx3.id, 'height': 3},
+        ], {tx.id: hexlify(tx.raw) for tx in (tx1, tx2, tx3)})
+        yield self.ledger.update_history(address)
+        self.assertEqual((yield self.ledger.db.get_balance_for_account(account)), 6)
+
+        # block 2 got orphaned, the transaction of block 3 was mined again but not the one of block 2
+        self.ledger.network.history = [
+            {'tx_hash': tx1.id, 'height': 1},
+            {'tx_hash': tx3.id, 'height': 3},
+        ]
+        synced = self.ledger.on_sync_progress.deferred_where(lambda event: event.is_synced)
+        yield self.ledger.rewind_blockchain(1)
+        yield synced
+        while (yield self.ledger.db.get_transaction(tx2.id))[0] is not None:
+            yield task.deferLater(reactor, 0.01, lambda: None)
+
+        history = yield self.ledger.db.get_address_history(address)
+        self.assertEqual(history, [(tx1.id, 1), (tx3.id, 3)])
+        _, height, _ = yield self.ledger.db.get_transaction(tx3.id)
+        self.assertEqual(height, 3)
+        txos = yield self.ledger.db.run_query("SELECT amount FROM txo ORDER BY amount", ())
+        self.assertEqual(txos, [(1,), (3,)])
+        self.assertEqual((yield self.ledger.db.get_balance_for_account(account)), 4)
+        self.assertEqual((yield self.ledger.db.get_cached_balance_for_account(account)), 4)
+
+    @defer.inlineCallbacks
+    def test_unconfirmed_transactions_are_promoted_in_one_batch(self):
+        account = self.ledger.account_class.generate(self.ledger, Wallet(), "torba")
+        address = yield account.receiving.get_or_create_usable_address()
+        for height in range(3):
+            self.add_header(block_height=height, merkle_root=b'abcd04')
+        tx1, tx2 = get_transaction(get_output(1)), get_transaction(get_output(2))
+        self.ledger.network = MockNetwork([
+            {'tx_hash': tx1.id, 'height': 0},
+            {'tx_hash': tx2.id, 'height': 0},
+        ], {
+            tx1.id: hexlify(tx1.raw),
+            tx2.id: hexlify(tx2.raw),
+        })
+        yield self.ledger.update_history(address)
+        self.assertEqual(len(self.ledger.mempool), 2)
+        self.assertIn(tx1.id, self.ledger.mempool)
+
+        events = []
+        self.ledger.on_transaction.listen(events.append)
+        self.ledger.network.history = [
+            {'tx_hash': tx1.id, 'height': 2},
+            {'tx_hash': tx2.id, 'height': 2},
+        ]
+        self.ledger.network.get_transaction_called = []
+        verified = []
+        self.ledger.on_transaction_verified.listen(verified.append)
+        both_verified = self.ledger.on_transaction_verified.deferred_where(lambda _: len(verified) == 2)
+        yield self.ledger.update_history(address)
+        yield both_verified
+
+        self.assertEqual(self.ledger.network.get_transaction_called, [])
+        self.assertEqual(self.ledger.network.get_merkles_called, [[(tx1.id, 2), (tx2.id, 2)]])
+        self.assertEqual([(e.tx.id, e.height) for e in events], [(tx1.id, 2), (tx2.id, 2)])
+        self.assertEqual(len(self.ledger.mempool), 0)
+        _, height, _ = yield self.ledger.db.get_transaction(tx2.id)
+        self.assertEqual(height, 2)
+        history = yield self.ledger.db.get_address_history(address)
+        self.assertEqual(history, [(tx1.id, 2), (tx2.id, 2)])
+        status = yield self.ledger.get_local_status(address)
+        self.assertEqual(status, self.ledger.get_status_from_history(history))
+
+    @defer.inlineCallbacks
+    def test_subscribe_account_syncs_only_mismatched_addresses(self):
+        account = self.ledger.account_class.generate(self.ledger, Wallet(), "torba")
+        yield account.ensure_address_gap()
+        addresses = yield account.get_addresses()
+        synced, stale, changed = addresses[:3]
+        yield self.ledger.db.set_address_history(
+            synced, [('abcd01', 1)], self.ledger.get_status_from_history([('abcd01', 1)])
+        )
+        yield self.ledger.db.set_address_history(
+            stale, [('abcd02', 1)], self.ledger.get_status_from_history([('abcd02', 1)])
+        )
+
+        self.ledger.network = MockNetwork([], {})
+        self.ledger.network.statuses = {
+            synced: self.ledger.get_status_from_history([('abcd01', 1)]),
+            stale: self.ledger.get_status_from_history([('abcd02', 1), ('abcd03', 2)]),
+            changed: self.ledger.get_status_from_history([('abcd04', 2)]),
+        }
+        yield self.ledger.subscribe_account(account)
+        self.assertEqual(len(self.ledger.network.subscribe_addresses_called), 1)
+        self.assertEqual(
+            sorted(self.ledger.network.subscribe_addresses_called[0]), sorted(addresses)
+        )
+        self.assertEqual(sorted(self.ledger.network.get_history_called), sorted([stale, changed]))
+
+        snapshots = {r[0]: r[3] for r in (yield self.ledger.db.get_address_statuses(account))}
+        self.assertEqual(snapshots[synced], self.ledger.network.statuses[synced])
+        self.assertEqual(snapshots[stale], self.ledger.network.statuses[stale])
+        self.assertEqual(snapshots[changed], self.ledger.network.statuses[changed])
+
+    @defer.inlineCallbacks
+    def test_resubscribe_account_syncs_only_changed_statuses(self):
+        account = self.ledger.account_class.generate(self.ledger, Wallet(), "torba")
+        yield account.ensure_address_gap()
+        addresses = yield account.get_addresses()
+        unchanged, changed = addresses[:2]
+        yield self.ledger.db.set_remote_statuses([(unchanged, 'status1'), (changed, 'status2')])
+
+        self.ledger.network = MockNetwork([], {})
+        self.ledger.network.statuses = {unchanged: 'status1', changed: 'status3'}
+        yield self.ledger.resubscribe_account(account)
+        self.assertEqual(self.ledger.network.get_history_called, [changed])
+        snapshots = {r[0]: r[3] for r in (yield self.ledger.db.get_address_statuses(account))}
+        self.assertEqual(snapshots[changed], 'status3')
+
+    @defer.inlineCallbacks
+    def test_update_history_fetches_concurrently_and_saves_in_order(self):
+        account = self.ledger.account_class.generate(self.ledger, Wallet(), "torba")
+        address = yield account.receiving.get_or_create_usable_address()
+        self.ledger.history_sync_window = 2
+
+        tx_ids = ['abcd01', 'abcd02', 'abcd03', 'abcd04']
+        network = self.ledger.network = SlowMockNetwork(
+            [{'tx_hash': tx_id, 'height': 0} for tx_id in tx_ids],
+            {tx_id: hexlify(get_transaction(get_output(i+1)).raw) for i, tx_id in enumerate(tx_ids)},
+            # first transaction is the slowest to download
+            {'abcd01': 0.05, 'abcd02': 0.01, 'abcd03': 0.02, 'abcd04': 0.0}
+        )
+        saved = []
+        self.ledger.on_transaction.listen(lambda e: saved.append(e.tx.id))
+
+        yield self.ledger.update_history(address)
+        self.assertEqual(network.get_transaction_called, tx_ids)
+        self.assertEqual(network.max_in_flight, 2)
+        expected = [get_transaction(get_output(i+1)).id for i in range(4)]
+        self.assertEqual(saved, expected)
+        history = yield self.ledger.db.get_address_history(address)
+        self.assertEqual(history, [(tx_id, 0) for tx_id in tx_ids])
+
+    @defer.inlineCallbacks
+    def test_concurrent_syncs_are_written_in_batches(self):
+        account = self.ledger.account_class.generate(self.ledger, Wallet(), "torba")
+        yield account.ensure_address_gap()
+        address1, address2 = (yield account.get_addresses())[:2]
+        self.ledger.write_batch_size = 3
+
+        tx1, tx2 = get_transaction(get_output(1)), get_transaction(get_output(2))
+        self.ledger.network = MockNetwork([
+            {'tx_hash': tx1.id, 'height': 0},
+            {'tx_hash': tx2.id, 'height': 0},
+        ], {
+            tx1.id: hexlify(tx1.raw),
+            tx2.id: hexlify(tx2.raw),
+        })
+        batches = []
+        save_transactions_io = self.ledger.db.save_transactions_io
+
+        def count_batches(writes):
+            batches.append(len(writes))
+            return save_transactions_io(writes)
+
+        self.ledger.db.save_transactions_io = count_batches
+        saved = []
+        self.ledger.on_transaction.listen(lambda e: saved.append((e.address, e.tx.id)))
+
+        yield defer.gatherResults([self.ledger.update_history(address1), self.ledger.update_history(address2)])
+        # first batch is full, last write waits for the flush interval
+        self.assertEqual(batches, [3, 1])
+        self.assertEqual(len(saved), 4)
+        for address in (address1, address2):
+            self.assertEqual([txid for a, txid in saved if a == address], [tx1.id, tx2.id])
+            history = yield self.ledger.db.get_address_history(address)
+            self.assertEqual(history, [(tx1.id, 0), (tx2.id, 0)])
+            status = yield self.ledger.get_local_status(address)
+            self.assertEqual((yield self.ledger.db.get_address(address))['status'], status)
+
+    @defer.inlineCallbacks
+    def test_update_account_discovers_used_addresses_in_bulk(self):
+        self.ledger.recovery_lookahead = 25
+        account = self.ledger.account_class.generate(self.ledger, Wallet(), "torba")
+        receiving = account.receiving.public_key
+        txs = [get_transaction(get_output(i+1)) for i in range(3)]
+        network = self.ledger.network = MockNetwork([], {tx.id: hexlify(tx.raw) for tx in txs})
+        network.histories = {
+            receiving.child(position).address: [{'tx_hash': tx.id, 'height': 0}]
+            for position, tx in zip((5, 22, 40), txs)
+        }
+        network.statuses = {
+            address: self.ledger.get_status_from_history([(history[0]['tx_hash'], 0)])
+            for address, history in network.histories.items()
+        }
+
+        yield self.ledger.update_account(account)
+        # saved addresses are synced one by one, the rest is checked in windows of 25
+        self.assertEqual(len(network.get_history_called), 20 + 6)
+        self.assertEqual(
+            [(len(window), window[0]) for window in network.get_histories_called],
+            [(25, receiving.child(20).address), (25, receiving.child(45).address)]
+        )
+        # keys past the gap after the last used address were not saved
+        records = yield account.receiving.get_address_records()
+        self.assertEqual(sorted(r['position'] for r in records), list(range(61)))
+        self.assertEqual(sorted(r['position'] for r in records if r['used_times']), [5, 22, 40])
+        history = yield self.ledger.db.get_address_history(receiving.child(40).address)
+        self.assertEqual(history, [(txs[2].id, 0)])
+        self.assertEqual(len((yield account.change.get_address_records())), 6)
+
+
+class SlowMockNetwork(MockNetwork):
+
+    def __init__(self, history, transaction, delays):
+        super().__init__(history, transaction)
+        self.delays = delays
+        self.in_flight = 0
+        self.max_in_flight = 0
+
+    def get_transaction(self, tx_hash):
+        self.get_transaction_called.append(tx_hash)
+        self.in_flight += 1
+        self.max_in_flight = max(self.max_in_flight, self.in_flight)
+
+        def done():
+            self.in_flight -= 1
+            return self.transaction[tx_hash]
+
+        return task.deferLater(reactor, self.delays[tx_hash], done)
+
+
+class TestMerkleVerification(LedgerTestCase):
+
+    @defer.inlineCallbacks
+    def test_stored_merkle_proof_is_verified_without_network(self):
+        account = self.ledger.account_class.generate(self.ledger, Wallet(), "torba")
+        address = yield account.receiving.get_or_create_usable_address()
+        tx1 = get_transaction(get_output(1))
+        tx2 = get_transaction(get_output(2))
+        branch = ['ab'*32, 'cd'*32]
+        self.add_header(block_height=0)
+        self.add_header(block_height=1, merkle_root=self.ledger.get_root_of_merkle_tree(branch, 1, tx1.hash))
+        self.add_header(block_height=2, merkle_root=self.ledger.get_root_of_merkle_tree(branch, 2, tx2.hash))
+
+        network = self.ledger.network = MockNetwork([
+            {'tx_hash': tx1.id, 'height': 1},
+            {'tx_hash': tx2.id, 'height': 2},
+        ], {
+            tx1.id: hexlify(tx1.raw),
+            tx2.id: hexlify(tx2.raw),
+        })
+        network.merkle = {
+            tx1.id: {'merkle': branch, 'pos': 1},
+            tx2.id: {'merkle': branch, 'pos': 2},
+        }
+        verified = []
+        self.ledger.on_transaction_verified.listen(verified.append)
+        both_verified = self.ledger.on_transaction_verified.deferred_where(lambda _: len(verified) == 2)
+        yield self.ledger.update_history(address)
+        # transactions are saved before they get verified
+        for tx in (tx1, tx2):
+            _, _, is_verified = yield self.ledger.db.get_transaction(tx.id)
+            self.assertFalse(is_verified)
+
+        yield both_verified
+        # both proofs were requested in one batch, most recent first
+        self.assertEqual(network.get_merkles_called, [[(tx2.id, 2), (tx1.id, 1)]])
+        self.assertEqual([(e.tx.id, e.height, e.is_verified) for e in verified], [(tx2.id, 2, 1), (tx1.id, 1, 1)])
+        for tx in (tx1, tx2):
+            _, _, is_verified = yield self.ledger.db.get_transaction(tx.id)
+            self.assertTrue(is_verified)
+
+        network.get_merkles_called = []
+        results = yield self.ledger.verify_transactions([(tx1, 1), (tx2, 2), (tx1, 2)])
+        self.assertEqual([r[0] for r in results], [True, True, False])
+        # only the proof which failed offline verification was requested
+        self.assertEqual(network.get_merkles_called, [[(tx1.id, 2)]])
+
+    @defer.inlineCallbacks
+    def test_verification_is_retried_after_network_failure(self):
+        account = self.ledger.account_class.generate(self.ledger, Wallet(), "torba")
+        address = yield account.receiving.get_or_create_usable_address()
+        tx = get_transaction(get_output(1))
+        branch = ['ab'*32, 'cd'*32]
+        self.add_header(block_height=0)
+        self.add_header(block_height=1, merkle_root=self.ledger.get_root_of_merkle_tree(branch, 1, tx.hash))
+        network = self.ledger.network = MockNetwork(
+            [{'tx_hash': tx.id, 'height': 1}], {tx.id: hexlify(tx.raw)}
+        )
+        network.merkle = {tx.id: {'merkle': branch, 'pos': 1}}
+        disconnected = ConnectionError("Attempting to send rpc request when connection is not available.")
+        network.get_merkles = lambda _: defer.fail(disconnected)
+        verified = []
+        self.ledger.on_transaction_verified.listen(verified.append)
+        yield self.ledger.update_history(address)
+        yield task.deferLater(reactor, 0, lambda: None)
+        while self.ledger._verifier_running:
+            yield task.deferLater(reactor, 0.01, lambda: None)
+        # nothing was checked, the transaction waits in the queue
+        self.assertEqual(verified, [])
+        self.assertEqual([item[1] for item in self.ledger._verification_queue], [tx.id])
+        _, _, is_verified = yield self.ledger.db.get_transaction(tx.id)
+        self.assertFalse(is_verified)
+
+        del network.get_merkles
+        retried = self.ledger.on_transaction_verified.first
+        self.ledger._start_verifier()
+        event = yield retried
+        self.assertEqual((event.tx.id, event.is_verified), (tx.id, 1))
+        _, _, is_verified = yield self.ledger.db.get_transaction(tx.id)
+        self.assertTrue(is_verified)
+
+    @defer.inlineCallbacks
+    def test_verification_is_given_up_after_repeated_failures(self):
+        self.ledger.max_verification_failures = 2
+        account = self.ledger.account_class.generate(self.ledger, Wallet(), "torba")
+        address = yield account.receiving.get_or_create_usable_address()
+        tx = get_transaction(get_output(1))
+        self.add_header(block_height=0)
+        self.add_header(block_height=1)
+        network = self.ledger.network = MockNetwork(
+            [{'tx_hash': tx.id, 'height': 1}], {tx.id: hexlify(tx.raw)}
+        )
+        # the proof doesn't match the merkle root of the header
+        network.merkle = {tx.id: {'merkle': ['ab'*32, 'cd'*32], 'pos': 1}}
+        verified = []
+        self.ledger.on_transaction_verified.listen(verified.append)
+        failed = self.ledger.on_transaction_verified.first
+        yield self.ledger.update_history(address)
+        event = yield failed
+        self.assertEqual((event.tx.id, event.is_verified), (tx.id, 0))
+        failed = self.ledger.on_transaction_verified.first
+        self.ledger.queue_verification(tx, 1)
+        yield failed
+        self.assertEqual((yield self.ledger.db.get_verification_failures([tx.id])), {tx.id: 2})
+
+        self.ledger.queue_verification(tx, 1)
+        yield task.deferLater(reactor, 0, lambda: None)
+        while self.ledger._verifier_running:
+            yield task.deferLater(reactor, 0.01, lambda: None)
+        self.assertEqual(len(verified), 2)
+        self.assertEqual(len(network.get_merkles_called), 2)
+        self.assertEqual((yield self.ledger.db.get_unverified_transactions(2)), [])
+        # confirmation in another block starts over
+        yield self.ledger.db.confirm_transactions([(tx.id, 2, 0, None)])
+        unverified = yield self.ledger.db.get_unverified_transactions(2)
+        self.assertEqual([(txid, height) for txid, _, height in unverified], [(tx.id, 2)])
+
+
+class TestScripthashSynchronization(LedgerTestCase):
+
+    def test_hash160_to_scripthash(self):
+        self.assertEqual(
+            self.ledger.hash160_to_scripthash(
+                self.ledger.address_to_hash160('1A1zP1eP5QGefi2DMPTfTL5SLmv7DivfNa')
+            ),
+            '8b01df4e368ea28f8dc0423bcf7a4923e3a12d307c875e47a0cfbf90b5c39161'
+        )
+
+    @defer.inlineCallbacks
+    def test_scripthash_stored_with_keys(self):
+        account = self.ledger.account_class.generate(self.ledger, Wallet(), "torba")
+        address = yield account.receiving.get_or_create_usable_address()
         address_details = yield self.ledger.db.get_address(address)
-        self.assertEqual(address_details['history'], 'abcd01:0:abcd02:1:abcd03:2:abcd04:3:')
+        self.assertEqual(
+            address_details['scripthash'],
+            self.ledger.hash160_to_scripthash(self.ledger.address_to_hash160(address))
+        )
+
+    @defer.inlineCallbacks
+    def test_subscribe_and_receive_status_by_scripthash(self):
+        self.ledger.use_scripthash = True
+        account = self.ledger.account_class.generate(self.ledger, Wallet(), "torba")
+        yield account.ensure_address_gap()
+        address = (yield account.get_addresses())[0]
+        scripthash = (yield self.ledger.db.get_address(address))['scripthash']
+
+        self.ledger.network = MockNetwork([], {})
+        yield self.ledger.subscribe_account(account)
+        self.assertIn(scripthash, self.ledger.network.subscribe_addresses_called[0])
+        self.assertEqual(self.ledger.network.get_history_called, [])
+
+        yield self.ledger.receive_scripthash_status((scripthash, 'abcd'))
+        self.assertEqual(self.ledger.network.get_history_called, [scripthash])
+
+
+class TestSlidingWindowSynchronization(LedgerTestCase):
+
+    @defer.inlineCallbacks
+    def test_only_window_is_subscribed_and_older_addresses_paid_along_are_detected(self):
+        account = self.ledger.account_class.generate(self.ledger, Wallet(), "torba", {
+            'name': 'sliding-window',
+            'receiving': {'gap': 5, 'maximum_uses_per_address': 1, 'window': 8},
+            'change': {'gap': 2, 'maximum_uses_per_address': 1, 'window': 3}
+        })
+        yield account.ensure_address_gap()
+        yield account.receiving.generate_keys(5, 11)
+        receiving = account.receiving.public_key
+        old, recent = receiving.child(1).address, receiving.child(10).address
+        unseen = receiving.child(2).address
+
+        # payment to an address in the window also pays one which fell out of it
+        tx = get_transaction(get_output(1, self.ledger.address_to_hash160(recent))).add_outputs([
+            self.ledger.transaction_class.output_class.pay_pubkey_hash(2, self.ledger.address_to_hash160(old))
+        ])
+        # the server doesn't report payments to addresses outside of the window
+        unseen_tx = get_transaction(get_output(3, self.ledger.address_to_hash160(unseen)))
+        network = self.ledger.network = MockNetwork([], {
+            tx.id: hexlify(tx.raw), unseen_tx.id: hexlify(unseen_tx.raw)
+        })
+        network.histories = {address: [{'tx_hash': tx.id, 'height': 0}] for address in (old, recent)}
+        network.histories[unseen] = [{'tx_hash': unseen_tx.id, 'height': 0}]
+        network.statuses = {recent: self.ledger.get_status_from_history([(tx.id, 0)])}
+        old_synced = self.ledger.on_transaction.deferred_where(lambda e: e.address == old)
+
+        yield self.ledger.subscribe_account(account)
+        change = yield account.change.get_addresses()
+        self.assertEqual(
+            sorted(network.subscribe_addresses_called[0]),
+            sorted([receiving.child(i).address for i in range(4, 12)] + change)
+        )
+        # using an address in the window moves it forward
+        self.assertEqual(network.subscribe_addresses_called[1], [receiving.child(i).address for i in range(12, 16)])
+        self.assertEqual((yield account.get_subscription_starts())[0], 8)
+        self.assertNotIn(receiving.child(4).address, self.ledger._statuses)
+
+        yield old_synced
+        self.assertEqual(network.get_history_called, [recent, old])
+        history = yield self.ledger.db.get_address_history(old)
+        self.assertEqual(history, [(tx.id, 0)])
+        self.assertNotIn(old, self.ledger._statuses)
+
+        # until the addresses outside of the window are scanned
+        history = yield self.ledger.db.get_address_history(unseen)
+        self.assertEqual(history, [])
+        synced = yield self.ledger.scan_retired_addresses(account, batch_size=5)
+        self.assertEqual(synced, [unseen])
+        self.assertEqual(network.get_histories_called, [
+            [receiving.child(i).address for i in range(5)], [receiving.child(i).address for i in range(5, 8)]
+        ])
+        history = yield self.ledger.db.get_address_history(unseen)
+        self.assertEqual(history, [(unseen_tx.id, 0)])
+        self.assertNotIn(unseen, self.ledger._statuses)
+        self.assertEqual((yield self.ledger.scan_retired_addresses(account)), [])
+
+        # addresses stay subscribed on the server after they slide out of the window
+        network.get_history_called = []
+        yield self.ledger.receive_status((old, 'abcd'))
+        self.assertEqual(network.get_history_called, [old])
+        self.assertNotIn(old, self.ledger._statuses)
+        self.assertEqual(len(network.subscribe_addresses_called), 2)
 
 
 class MocHeaderNetwork:
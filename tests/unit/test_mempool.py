@@ -0,0 +1,37 @@
+import unittest
+
+from torba.mempool import MempoolTracker
+
+from .test_transaction import get_transaction, get_output
+
+
+class TestMempoolTracker(unittest.TestCase):
+
+    def test_promotion_waits_for_headers(self):
+        mempool = MempoolTracker()
+        tx1, tx2 = get_transaction(get_output(1)), get_transaction(get_output(2))
+        mempool.add(tx1)
+        mempool.add(tx2)
+        self.assertEqual(len(mempool), 2)
+
+        first = mempool.confirm(tx1.id, 5)
+        second = mempool.confirm(tx1.id, 5)
+        mempool.confirm(tx2.id, 7)
+        self.assertEqual(mempool.pop_confirmed(4), [])
+
+        ready = mempool.pop_confirmed(6)
+        self.assertEqual([(tx.id, height) for tx, height, _ in ready], [(tx1.id, 5)])
+        self.assertEqual(ready[0][2], [first, second])
+        self.assertNotIn(tx1.id, mempool)
+        self.assertIn(tx2.id, mempool)
+
+        self.assertEqual([tx.id for tx, _, _ in mempool.pop_confirmed(7)], [tx2.id])
+        self.assertEqual(len(mempool), 0)
+
+    def test_discard(self):
+        mempool = MempoolTracker()
+        tx = get_transaction(get_output(1))
+        mempool.add(tx)
+        mempool.discard(tx.id)
+        mempool.discard(tx.id)
+        self.assertNotIn(tx.id, mempool)
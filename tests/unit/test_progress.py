@@ -0,0 +1,65 @@
+import unittest
+
+from torba.progress import SyncProgress
+
+
+class FakeClock:
+
+    def __init__(self):
+        self.now = 100.0
+
+    def __call__(self):
+        return self.now
+
+
+class TestSyncProgress(unittest.TestCase):
+
+    def setUp(self):
+        self.clock = FakeClock()
+        self.progress = SyncProgress(self.clock)
+
+    def test_headers_rate_and_eta(self):
+        progress = self.progress
+        progress.set_headers_height(1000)
+        progress.set_headers_target(5000)
+        self.assertIsNone(progress.eta)
+        self.clock.now += 10
+        progress.set_headers_height(3000)
+        self.assertEqual(progress.headers_rate, 200)
+        self.assertEqual(progress.eta, 10)
+        self.assertFalse(progress.get_event().is_synced)
+        self.clock.now += 10
+        progress.set_headers_height(5000)
+        self.assertEqual(progress.eta, 0)
+        self.assertTrue(progress.get_event().is_synced)
+
+    def test_history_eta(self):
+        progress = self.progress
+        for _ in range(4):
+            progress.address_started()
+        progress.transactions_queued(10)
+        self.assertIsNone(progress.eta)
+        self.clock.now += 5
+        for i in range(5):
+            progress.transaction_fetched('tx{}'.format(i), is_verified=i < 3)
+        # verified in the background, along with one fetched before this round
+        for txid in ('tx3', 'tx4', 'older'):
+            progress.transaction_verified(txid)
+        progress.address_finished()
+        # 5 of 10 transactions took 5 seconds, 3 of 4 addresses left took 15 seconds
+        self.assertEqual(progress.eta, 15)
+        event = progress.get_event()
+        self.assertEqual(
+            (event.addresses_synced, event.addresses_total,
+             event.transactions_fetched, event.transactions_verified, event.transactions_total),
+            (1, 4, 5, 5, 10)
+        )
+        for _ in range(3):
+            progress.address_finished()
+        self.assertEqual(progress.eta, 0)
+        self.assertTrue(progress.get_event().is_synced)
+
+        # next round of synchronization starts counting from zero
+        progress.address_started()
+        event = progress.get_event()
+        self.assertEqual((event.addresses_synced, event.addresses_total, event.transactions_total), (0, 1, 0))
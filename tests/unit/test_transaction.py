@@ -219,7 +219,7 @@ class TransactionIOBalancing(unittest.TestCase):
             yield self.ledger.db.save_transaction_io(
                 save_tx, self.funding_tx, 1, True,
                 self.ledger.hash160_to_address(utxo.script.values['pubkey_hash']),
-                utxo.script.values['pubkey_hash'], ''
+                utxo.script.values['pubkey_hash'], 0, [], None
             )
             save_tx = 'update'
 
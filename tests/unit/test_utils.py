@@ -1,6 +1,7 @@
 import unittest
 
-from torba.util import ArithUint256
+from torba.util import ArithUint256, LRUCache, BloomFilter
+from torba.hash import hash160
 
 
 class TestArithUint256(unittest.TestCase):
@@ -58,3 +59,35 @@ class TestArithUint256(unittest.TestCase):
         uint = from_compact(0x20123456)
         eq(uint.value, 0x1234560000000000000000000000000000000000000000000000000000000000)
         eq(uint.compact, 0x20123456)
+
+
+class TestLRUCache(unittest.TestCase):
+
+    def test_eviction_and_stats(self):
+        cache = LRUCache(2)
+        cache.set('a', 1)
+        cache.set('b', 2)
+        self.assertEqual(cache.get('a'), 1)
+        cache.set('c', 3)  # 'b' is least recently used
+        self.assertNotIn('b', cache)
+        self.assertIsNone(cache.get('b'))
+        self.assertEqual(cache.get('c'), 3)
+        self.assertEqual(len(cache), 2)
+        self.assertEqual((cache.hits, cache.misses), (2, 1))
+        self.assertEqual(cache.pop('a'), 1)
+        cache.clear()
+        self.assertEqual(len(cache), 0)
+
+
+class TestBloomFilter(unittest.TestCase):
+
+    def test_membership_and_growth(self):
+        hashes = [hash160(str(i).encode()) for i in range(2000)]
+        bloom = BloomFilter(capacity=500, error_rate=0.001)
+        for h in hashes[:1000]:
+            bloom.add(h)
+        self.assertEqual(len(bloom), 1000)
+        # filled past its capacity without any false negatives
+        self.assertTrue(all(h in bloom for h in hashes[:1000]))
+        false_positives = sum(h in bloom for h in hashes[1000:])
+        self.assertLess(false_positives, 10)
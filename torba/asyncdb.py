@@ -0,0 +1,180 @@
+import queue
+import asyncio
+import logging
+import sqlite3
+import threading
+from typing import Callable, Optional
+
+from twisted.internet import defer, reactor
+from twisted.python.failure import Failure
+
+log = logging.getLogger(__name__)
+
+
+def _interaction(connection, func, *args):
+    cursor = connection.cursor()
+    try:
+        result = func(cursor, *args)
+    except Exception:
+        connection.rollback()
+        raise
+    else:
+        connection.commit()
+        return result
+    finally:
+        cursor.close()
+
+
+def _query(connection, sql, values):
+    return connection.execute(sql, values).fetchall()
+
+
+def _execute(cursor, sql, values):
+    cursor.execute(sql, values)
+
+
+def _operation(connection, sql, values):
+    _interaction(connection, _execute, sql, values)
+
+
+class AsyncSQLiteConnection:
+    """ SQLite connection owned by a dedicated thread, with coroutine APIs for use under asyncio
+        and the subset of `adbapi.ConnectionPool` used by `SQLiteMixin`, which returns Deferreds.
+        Jobs submitted while the thread is busy are run as one batch and their results are
+        delivered with a single call into the event loop, instead of a thread hop each. If the
+        connection can't be opened, or once it's closed, jobs fail instead of being run. """
+
+    def __init__(self, path: str, openfun: Optional[Callable] = None) -> None:
+        self.path = path
+        self.openfun = openfun
+        self.batches = 0
+        self._jobs: queue.Queue = queue.Queue()
+        # jobs are only queued while there is no error, it's set under the lock
+        self._lock = threading.Lock()
+        self._error: Optional[Exception] = None
+        self._thread = threading.Thread(target=self._run, name='sqlite: {}'.format(path), daemon=True)
+        self._thread.start()
+
+    def _run(self):
+        try:
+            connection = sqlite3.connect(self.path)
+            if self.openfun is not None:
+                self.openfun(connection)
+        except Exception as e:  # pylint: disable=broad-except
+            log.exception('failed to open database %s:', self.path)
+            self._fail(e)
+            return
+        closers = []
+        running = True
+        while running:
+            batch = [self._jobs.get()]
+            while True:
+                try:
+                    batch.append(self._jobs.get_nowait())
+                except queue.Empty:
+                    break
+            self.batches += 1
+            results = {}
+            for func, args, schedule, resolve in batch:
+                if func is None:
+                    # resolved after the connection is closed
+                    closers.append((schedule, resolve))
+                    running = False
+                    continue
+                try:
+                    result = (resolve, True, func(connection, *args))
+                except Exception as e:  # pylint: disable=broad-except
+                    result = (resolve, False, e)
+                results.setdefault(schedule, []).append(result)
+            for schedule, resolved in results.items():
+                schedule(self._resolve, resolved)
+        connection.close()
+        for schedule, resolve in closers:
+            schedule(self._resolve, [(resolve, True, None)])
+
+    def _fail(self, error):
+        with self._lock:
+            self._error = error
+        while True:
+            try:
+                func, _, schedule, resolve = self._jobs.get_nowait()
+            except queue.Empty:
+                break
+            # there is nothing to close
+            schedule(self._resolve, [(resolve, func is None, None if func is None else error)])
+
+    @staticmethod
+    def _resolve(resolved):
+        for resolve, success, result in resolved:
+            resolve(success, result)
+
+    def _submit(self, schedule, resolve, func, *args):
+        with self._lock:
+            if self._error is None:
+                self._jobs.put((func, args, schedule, resolve))
+                if func is None:
+                    self._error = sqlite3.ProgrammingError('Cannot operate on a closed database.')
+                return
+            error = self._error
+        if func is None:
+            schedule(self._resolve, [(resolve, True, None)])
+        else:
+            schedule(self._resolve, [(resolve, False, error)])
+
+    # coroutine API, awaited from the asyncio event loop
+
+    def _submit_future(self, func, *args) -> asyncio.Future:
+        loop = asyncio.get_event_loop()
+        future = loop.create_future()
+
+        def resolve(success, result):
+            if future.cancelled():
+                return
+            if success:
+                future.set_result(result)
+            else:
+                future.set_exception(result)
+
+        self._submit(loop.call_soon_threadsafe, resolve, func, *args)
+        return future
+
+    async def run(self, func, *args):
+        """ Runs `func(cursor, *args)` in a transaction, committed when it returns. """
+        return await self._submit_future(_interaction, func, *args)
+
+    async def fetchall(self, sql, values=()):
+        return await self._submit_future(_query, sql, values)
+
+    async def execute(self, sql, values=()):
+        return await self._submit_future(_operation, sql, values)
+
+    async def aclose(self):
+        """ Closes the connection once the submitted jobs have finished. """
+        return await self._submit_future(None)
+
+    # adbapi.ConnectionPool compatible API, results are delivered through the reactor
+
+    def _submit_deferred(self, func, *args) -> defer.Deferred:
+        finished = defer.Deferred()
+
+        def resolve(success, result):
+            if success:
+                finished.callback(result)
+            else:
+                finished.errback(Failure(result))
+
+        self._submit(reactor.callFromThread, resolve, func, *args)
+        return finished
+
+    def runInteraction(self, func, *args):
+        return self._submit_deferred(_interaction, func, *args)
+
+    def runQuery(self, sql, values=()):
+        return self._submit_deferred(_query, sql, values)
+
+    def runOperation(self, sql, values=()):
+        return self._submit_deferred(_operation, sql, values)
+
+    def close(self) -> defer.Deferred:
+        """ Closes the connection once the submitted jobs have finished, without blocking. """
+        return self._submit_deferred(None)
@@ -5,6 +5,7 @@ from twisted.internet import defer
 from torba.mnemonic import Mnemonic
 from torba.bip32 import PrivateKey, PubKey, from_extended_key_string
 from torba.hash import double_sha256, aes_encrypt, aes_decrypt
+from torba.util import BloomFilter
 
 if typing.TYPE_CHECKING:
     from torba import baseledger
@@ -15,6 +16,9 @@ class AddressManager:
 
     name: str
 
+    # number of most recent addresses to subscribe, None subscribes all of them
+    window: Optional[int] = None
+
     __slots__ = 'account', 'public_key', 'chain_number'
 
     def __init__(self, account, public_key, chain_number):
@@ -59,6 +63,21 @@ class AddressManager:
     def ensure_address_gap(self) -> defer.Deferred:
         raise NotImplementedError
 
+    def discover_addresses(self, lookahead: int) -> defer.Deferred:  # pylint: disable=unused-argument
+        return defer.succeed([])
+
+    def load(self) -> defer.Deferred:
+        return defer.succeed(None)
+
+    def get_subscription_start(self) -> defer.Deferred:
+        """ Position of the first address which should be subscribed. """
+        return defer.succeed(0)
+
+    def might_own(self, hash160: bytes) -> bool:  # pylint: disable=unused-argument
+        """ Whether an output paying `hash160` might be for an address which is not
+            subscribed, a False is certain but a True has to be checked. """
+        return False
+
     def get_address_records(self, limit: int = None, only_usable: bool = False) -> defer.Deferred:
         raise NotImplementedError
 
@@ -101,14 +120,16 @@ class HierarchicalDeterministic(AddressManager):
     def get_private_key(self, index: int) -> PrivateKey:
         return self.account.private_key.child(self.chain_number).child(index)
 
+    def derive_keys(self, start: int, end: int):
+        return [(index, self.public_key.child(index)) for index in range(start, end+1)]
+
+    def _add_keys(self, keys):
+        return self.db.add_keys(self.account, self.chain_number, keys)
+
     @defer.inlineCallbacks
     def generate_keys(self, start: int, end: int) -> defer.Deferred:
-        new_keys = []
-        for index in range(start, end+1):
-            new_keys.append((index, self.public_key.child(index)))
-        yield self.db.add_keys(
-            self.account, self.chain_number, new_keys
-        )
+        new_keys = self.derive_keys(start, end)
+        yield self._add_keys(new_keys)
         defer.returnValue([key[1].address for key in new_keys])
 
     @defer.inlineCallbacks
@@ -143,6 +164,35 @@ class HierarchicalDeterministic(AddressManager):
         new_keys = yield self.generate_keys(start, end-1)
         defer.returnValue(new_keys)
 
+    @defer.inlineCallbacks
+    def discover_addresses(self, lookahead: int) -> defer.Deferred:
+        """ Recovers the addresses of a used chain in bulk, `lookahead` keys past the saved
+            ones are derived at a time and their histories are requested in one batch. Only
+            the keys up to `gap` past the last used one are saved, the used ones are synced
+            with the histories already downloaded. Saved addresses must be synced first. """
+        ledger = self.account.ledger
+        addresses = yield self._query_addresses(order_by="position ASC")
+        start = addresses[-1]['position']+1 if addresses else 0
+        last_used = max((a['position'] for a in addresses if a['used_times']), default=-1)
+
+        derived, used = [], []
+        while last_used + self.gap >= start:
+            keys = self.derive_keys(start, start+lookahead-1)
+            histories = yield ledger.get_remote_histories([key.address for _, key in keys])
+            for (position, key), history in zip(keys, histories):
+                if history:
+                    last_used = position
+                    used.append((key.address, history))
+            derived.extend(keys)
+            start += len(keys)
+
+        # trim the speculatively derived keys which are not needed to keep the gap
+        new_keys = [(position, key) for position, key in derived if position <= last_used + self.gap]
+        if new_keys:
+            yield self._add_keys(new_keys)
+        yield defer.DeferredList([ledger.update_history(address, history) for address, history in used])
+        defer.returnValue([key.address for _, key in new_keys])
+
     def get_address_records(self, limit: int = None, only_usable: bool = False):
         return self._query_addresses(
             limit, self.maximum_uses_per_address if only_usable else None,
@@ -150,6 +200,65 @@ class HierarchicalDeterministic(AddressManager):
         )
 
 
+class SlidingWindow(HierarchicalDeterministic):
+    """ Hierarchical Deterministic key management for watching very large numbers of
+        addresses, like the payment addresses derived from a merchant's xpub. Only the
+        `window` most recent addresses of the chain are subscribed, every derived key is
+        still saved. The server doesn't report payments to the older addresses, they are
+        only found when a transaction synchronized for a subscribed address also pays one
+        of them (checked against a compact filter of all of the derived hash160s) or when
+        they are scanned with `ledger.scan_retired_addresses()`. """
+
+    name = "sliding-window"
+
+    __slots__ = 'window', 'hash160_filter'
+
+    def __init__(self, account: 'BaseAccount', chain: int, gap: int,
+                 maximum_uses_per_address: int, window: int) -> None:
+        super().__init__(account, chain, gap, maximum_uses_per_address)
+        self.window = window
+        self.hash160_filter = BloomFilter()
+
+    @classmethod
+    def from_dict(cls, account: 'BaseAccount', d: dict) -> Tuple[AddressManager, AddressManager]:
+        return (
+            cls(account, 0, **d.get('receiving', {'gap': 20, 'maximum_uses_per_address': 1, 'window': 1000})),
+            cls(account, 1, **d.get('change', {'gap': 6, 'maximum_uses_per_address': 1, 'window': 100}))
+        )
+
+    def to_dict_instance(self):
+        d = super().to_dict_instance()
+        d['window'] = self.window
+        return d
+
+    @defer.inlineCallbacks
+    def load(self) -> defer.Deferred:
+        last = yield self._query_addresses(1, None, "position DESC")
+        hash160_filter = BloomFilter(max((last[0]['position'] + 1) * 2 if last else 0, 10000))
+
+        def add_page(records):
+            for record in records:
+                hash160_filter.add(self.account.ledger.address_to_hash160(record['address']))
+
+        # the addresses are read a page at a time, only their hash160s are kept
+        yield self.db.iterate_pages(self.db.get_addresses_page, add_page, self.account, self.chain_number)
+        self.hash160_filter = hash160_filter
+
+    @defer.inlineCallbacks
+    def _add_keys(self, keys):
+        yield super()._add_keys(keys)
+        for _, key in keys:
+            self.hash160_filter.add(key.identifier())
+
+    @defer.inlineCallbacks
+    def get_subscription_start(self) -> defer.Deferred:
+        last = yield self._query_addresses(1, None, "position DESC")
+        defer.returnValue(max(0, last[0]['position'] + 1 - self.window) if last else 0)
+
+    def might_own(self, hash160: bytes) -> bool:
+        return hash160 in self.hash160_filter
+
+
 class SingleKey(AddressManager):
     """ Single Key address manager always returns the same address for all operations. """
 
@@ -194,6 +303,7 @@ class BaseAccount:
     address_generators: Dict[str, Type[AddressManager]] = {
         SingleKey.name: SingleKey,
         HierarchicalDeterministic.name: HierarchicalDeterministic,
+        SlidingWindow.name: SlidingWindow,
     }
 
     def __init__(self, ledger: 'baseledger.BaseLedger', wallet: 'basewallet.Wallet', name: str,
@@ -293,6 +403,29 @@ class BaseAccount:
             addresses.extend(new_addresses)
         defer.returnValue(addresses)
 
+    @defer.inlineCallbacks
+    def load(self):
+        for address_manager in self.address_managers:
+            yield address_manager.load()
+
+    @defer.inlineCallbacks
+    def get_subscription_starts(self):
+        """ Maps the chains which only subscribe a window of their addresses
+            to the position of the first address to subscribe. """
+        starts = {}
+        for address_manager in self.address_managers:
+            if address_manager.window is not None:
+                starts[address_manager.chain_number] = yield address_manager.get_subscription_start()
+        defer.returnValue(starts)
+
+    @defer.inlineCallbacks
+    def discover_addresses(self, lookahead: int):
+        addresses = []
+        for address_manager in self.address_managers:
+            new_addresses = yield address_manager.discover_addresses(lookahead)
+            addresses.extend(new_addresses)
+        defer.returnValue(addresses)
+
     @defer.inlineCallbacks
     def get_addresses(self, limit: int = None, max_used_times: int = None) -> defer.Deferred:
         records = yield self.get_address_records(limit, max_used_times)
@@ -306,11 +439,15 @@ class BaseAccount:
         address_manager = {0: self.receiving, 1: self.change}[chain]
         return address_manager.get_private_key(index)
 
-    def get_balance(self, confirmations: int = 6, **constraints):
+    def get_balance(self, confirmations: int = 6, include_reserved=False, **constraints):
+        height = None
         if confirmations > 0:
             height = self.ledger.headers.height - (confirmations-1)
-            constraints.update({'height__lte': height, 'height__gt': 0})
-        return self.ledger.db.get_balance_for_account(self, **constraints)
+        if not constraints:
+            return self.ledger.db.get_cached_balance_for_account(self, height, include_reserved)
+        if height is not None:
+            constraints.update({'height__lte': height, 'height__gt': 0, 'is_verified': 1})
+        return self.ledger.db.get_balance_for_account(self, include_reserved, **constraints)
 
     @defer.inlineCallbacks
     def get_max_gap(self):
@@ -324,6 +461,9 @@ class BaseAccount:
     def get_unspent_outputs(self, **constraints):
         return self.ledger.db.get_utxos_for_account(self, **constraints)
 
+    def get_unspent_outputs_page(self, after=None, limit=1000, **constraints):
+        return self.ledger.db.get_utxos_page_for_account(self, after, limit, **constraints)
+
     @defer.inlineCallbacks
     def fund(self, to_account, amount=None, everything=False,
              outputs=1, broadcast=False, **constraints):
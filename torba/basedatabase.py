@@ -1,63 +1,248 @@
 import logging
-from typing import Tuple, List, Sequence
+import hashlib
+from binascii import hexlify, unhexlify
+from collections import namedtuple
+from functools import lru_cache
+from itertools import islice
+from typing import Tuple, List, Sequence, Iterable, Callable
 
 import sqlite3
 from twisted.internet import defer
 from twisted.enterprise import adbapi
 
-from torba.hash import TXRefImmutable
+from torba.basescript import BaseOutputScript
+from torba.hash import TXRefImmutable, hash160, sha256
+from torba.stream import StreamController
+from torba.asyncdb import AsyncSQLiteConnection
 
 log = logging.getLogger(__name__)
 
 
-def constraints_to_sql(constraints, joiner=' AND ', prepend_sql=' AND ', prepend_key=''):
-    if not constraints:
-        return ''
-    extras = []
-    for key in list(constraints):
-        col, op = key, '='
-        if key.endswith('__not'):
-            col, op = key[:-len('__not')], '!='
-        elif key.endswith('__lt'):
-            col, op = key[:-len('__lt')], '<'
-        elif key.endswith('__lte'):
-            col, op = key[:-len('__lte')], '<='
-        elif key.endswith('__gt'):
-            col, op = key[:-len('__gt')], '>'
-        elif key.endswith('__like'):
-            col, op = key[:-len('__like')], 'LIKE'
-        elif key.endswith('__any'):
-            subconstraints = constraints.pop(key)
-            extras.append('({})'.format(
-                constraints_to_sql(subconstraints, ' OR ', '', key+'_')
-            ))
-            for subkey, val in subconstraints.items():
-                constraints['{}_{}'.format(key, subkey)] = val
+MigrationProgressEvent = namedtuple('MigrationProgressEvent', ('version', 'name', 'done', 'total'))
+
+TransactionWrite = namedtuple('TransactionWrite', (
+    'tx', 'height', 'is_verified', 'address', 'txhash',
+    'history_position', 'history', 'status', 'merkle_proof'
+))
+
+
+CONSTRAINT_OPERATORS = (
+    ('__not', '!='),
+    ('__lt', '<'),
+    ('__lte', '<='),
+    ('__gt', '>'),
+    ('__like', 'LIKE'),
+)
+
+
+def _constraints_signature(constraints):
+    """ Shape of the constraints: their sorted keys, with the nested shape of `__any` keys. """
+    return tuple(
+        (key, _constraints_signature(value) if key.endswith('__any') else None)
+        for key, value in sorted(constraints.items())
+    )
+
+
+@lru_cache(maxsize=1000)
+def _compile_constraints(signature, joiner, prepend_sql, prepend_key):
+    """ Builds the SQL for a constraints signature once, along with the (key path, parameter name)
+        of every value so that constraints of the same shape only need their values mapped. """
+    extras, params = [], []
+    for key, subsignature in signature:
+        if subsignature is not None:
+            sql, subparams = _compile_constraints(subsignature, ' OR ', '', prepend_key+key+'_')
+            extras.append('({})'.format(sql))
+            params.extend(((key,)+path, name) for path, name in subparams)
             continue
+        col, op = key, '='
+        for suffix, suffix_op in CONSTRAINT_OPERATORS:
+            if key.endswith(suffix):
+                col, op = key[:-len(suffix)], suffix_op
+                break
         extras.append('{} {} :{}'.format(col, op, prepend_key+key))
-    return prepend_sql + joiner.join(extras) if extras else ''
+        params.append(((key,), prepend_key+key))
+    return prepend_sql + joiner.join(extras) if extras else '', tuple(params)
+
+
+def constraints_to_sql(constraints, joiner=' AND ', prepend_sql=' AND ', prepend_key=''):
+    """ Returns the SQL for `constraints` and a dict of the values of its named parameters,
+        `constraints` itself is left untouched. Constraints with the same keys always produce
+        the same SQL, regardless of their order, so SQLite's statement cache is reused. """
+    if not constraints:
+        return '', {}
+    sql, params = _compile_constraints(_constraints_signature(constraints), joiner, prepend_sql, prepend_key)
+    values = {}
+    for path, name in params:
+        value = constraints
+        for key in path:
+            value = value[key]
+        values[name] = value
+    return sql, values
+
+
+def hash_history(hasher, history):
+    for txid, height in history:
+        hasher.update('{}:{}:'.format(txid, height).encode())
+    return hasher
+
+
+def history_to_status(history):
+    """ Electrum status hash of a list of (txid, height), None for an empty history. """
+    if not history:
+        return None
+    return hash_history(hashlib.sha256(), history).hexdigest()
+
+
+def txid_to_bytes(txid: str) -> bytes:
+    """ Hex transaction id, as used outside of the database, to the 32 byte hash stored in it. """
+    return unhexlify(txid)[::-1]
+
+
+def bytes_to_txid(tx_hash: bytes) -> str:
+    return hexlify(tx_hash[::-1]).decode()
+
+
+class UnsupportedSchemaVersion(Exception):
+
+    def __init__(self, version, latest):
+        super().__init__("Database schema version {} is newer than the latest supported version {}.".format(
+            version, latest
+        ))
+        self.version = version
+        self.latest = latest
 
 
 class SQLiteMixin:
 
     CREATE_TABLES_QUERY: Sequence[str] = ()
 
-    def __init__(self, path):
+    # MIGRATIONS[n] upgrades a database from schema version n to n+1, the version is kept in
+    # "PRAGMA user_version". A migration is called as `migration(self, t, after)` and works
+    # on at most MIGRATION_CHUNK_SIZE rows, so that large databases are migrated without
+    # holding the write lock for long. It returns None once it's done, otherwise a tuple of
+    # how many rows it has left and the `after` to be passed to its next call, made in a new
+    # transaction. `after` is None on the first call, including when an interrupted migration
+    # is started again. New databases are created at the latest version.
+    MIGRATIONS: Sequence[Callable] = ()
+    MIGRATION_CHUNK_SIZE = 10000
+
+    def __init__(self, path, readers: int = 4, use_asyncio: bool = False):
         self._db_path = path
+        self._readers = readers
+        # with `use_asyncio` the writer and the readers are each a connection owned by a dedicated
+        # thread instead of an adbapi pool, see AsyncSQLiteConnection for its coroutine API
+        self._use_asyncio = use_asyncio
+        # all of the writes go through the single connection of `db`, on disk databases
+        # are in WAL mode and queries are spread over the read-only connections of `readers`
         self.db: adbapi.ConnectionPool = None
+        self.readers: adbapi.ConnectionPool = None
+        self._on_migration_progress_controller = StreamController()
+        self.on_migration_progress = self._on_migration_progress_controller.stream
+
+    @staticmethod
+    def _open_writer(connection):
+        connection.execute("PRAGMA journal_mode = WAL")
+        connection.execute("PRAGMA synchronous = NORMAL")
+
+    @staticmethod
+    def _open_reader(connection):
+        connection.execute("PRAGMA query_only = ON")
 
     def open(self):
         log.info("connecting to database: %s", self._db_path)
-        self.db = adbapi.ConnectionPool(
-            'sqlite3', self._db_path, cp_min=1, cp_max=1, check_same_thread=False
-        )
-        return self.db.runInteraction(
-            lambda t: t.executescript(self.CREATE_TABLES_QUERY)
-        )
+        if self._use_asyncio and self._db_path == ':memory:':
+            self.db = self.readers = AsyncSQLiteConnection(self._db_path)
+        elif self._use_asyncio:
+            self.db = AsyncSQLiteConnection(self._db_path, self._open_writer)
+            self.readers = AsyncSQLiteConnection(self._db_path, self._open_reader)
+        elif self._db_path == ':memory:':
+            # every connection would get its own in memory database
+            self.db = self.readers = adbapi.ConnectionPool(
+                'sqlite3', self._db_path, cp_min=1, cp_max=1, check_same_thread=False
+            )
+        else:
+            self.db = adbapi.ConnectionPool(
+                'sqlite3', self._db_path, cp_min=1, cp_max=1, check_same_thread=False,
+                cp_openfun=self._open_writer
+            )
+            self.readers = adbapi.ConnectionPool(
+                'sqlite3', self._db_path, cp_min=1, cp_max=self._readers, check_same_thread=False,
+                cp_openfun=self._open_reader
+            )
+        return self._initialize()
+
+    @property
+    def schema_version(self):
+        return len(self.MIGRATIONS)
+
+    @defer.inlineCallbacks
+    def _initialize(self):
+        version, is_new = yield self.db.runInteraction(self._get_schema_version)
+        if version > self.schema_version:
+            raise UnsupportedSchemaVersion(version, self.schema_version)
+        if not is_new:
+            yield self.migrate(version)
+        yield self.db.runInteraction(self._create_tables)
+
+    @staticmethod
+    def _get_schema_version(t):
+        version = t.execute("PRAGMA user_version").fetchone()[0]
+        tables = t.execute("SELECT COUNT(*) FROM sqlite_master WHERE type = 'table'").fetchone()[0]
+        return version, tables == 0
+
+    def _create_tables(self, t):
+        t.executescript(self.CREATE_TABLES_QUERY)
+        t.execute("PRAGMA user_version = {}".format(self.schema_version))
+
+    @defer.inlineCallbacks
+    def migrate(self, version):
+        """ Runs the migrations from schema `version` to the latest one,
+            each of their chunks is reported to `on_migration_progress`. """
+        for version in range(version, self.schema_version):
+            migration = self.MIGRATIONS[version]
+            name = migration.__name__.strip('_')
+            log.info("migrating database to version %s: %s", version+1, name)
+            total, after = 0, None
+            while True:
+                result = yield self.db.runInteraction(self._run_migration, migration, version, after)
+                remaining, after = result or (0, None)
+                total = max(total, remaining)
+                self._on_migration_progress_controller.add(
+                    MigrationProgressEvent(version+1, name, total-remaining, total)
+                )
+                if result is None:
+                    break
+
+    def _run_migration(self, t, migration, version, after):
+        result = migration(self, t, after)
+        if result is None:
+            t.execute("PRAGMA user_version = {}".format(version+1))
+        return result
+
+    def _next_chunk(self, t, table, rows):
+        """ Result of a migration which just went over `rows` of `table` in rowid order,
+            each row starting with its rowid. """
+        if len(rows) < self.MIGRATION_CHUNK_SIZE:
+            return None
+        after = rows[-1][0]
+        remaining = self.execute(t, "SELECT COUNT(*) FROM {} WHERE rowid > ?".format(table), (after,))
+        return remaining.fetchone()[0], after
+
+    @staticmethod
+    def _get_tables(t):
+        return {row[0] for row in t.execute("SELECT name FROM sqlite_master WHERE type = 'table'")}
+
+    @staticmethod
+    def _get_columns(t, table):
+        return [column[1] for column in t.execute("PRAGMA table_info({})".format(table))]
 
     def close(self):
-        self.db.close()
-        return defer.succeed(True)
+        closed = []
+        if self.readers is not self.db:
+            closed.append(self.readers.close())
+        closed.append(self.db.close())
+        # adbapi pools close right away, AsyncSQLiteConnection returns a deferred
+        return defer.gatherResults([d for d in closed if d is not None]).addCallback(lambda _: True)
 
     @staticmethod
     def _insert_sql(table: str, data: dict) -> Tuple[str, List]:
@@ -70,6 +255,25 @@ class SQLiteMixin:
         )
         return sql, values
 
+    @classmethod
+    def _insert_many(cls, t, table: str, columns: Sequence[str], rows: Iterable[Sequence], chunk_size=10000):
+        """ Inserts `rows`, each one a sequence of values in the order of `columns`, with
+            a single prepared statement executed over chunks of at most `chunk_size` rows. """
+        sql = "INSERT INTO {} ({}) VALUES ({})".format(
+            table, ', '.join(columns), ', '.join(['?'] * len(columns))
+        )
+        rows = iter(rows)
+        chunk = list(islice(rows, chunk_size))
+        while chunk:
+            t.executemany(sql, chunk)
+            chunk = list(islice(rows, chunk_size))
+
+    def insert_many(self, table: str, columns: Sequence[str], rows: Iterable[Sequence], chunk_size=10000):
+        """ Bulk insert of `rows` in one database transaction, see `_insert_many`. """
+        return self.db.runInteraction(
+            lambda t: self._insert_many(t, table, columns, rows, chunk_size)
+        )
+
     @staticmethod
     def _update_sql(table: str, data: dict, where: str, constraints: list) -> Tuple[str, list]:
         columns, values = [], []
@@ -98,6 +302,24 @@ class SQLiteMixin:
         else:
             defer.returnValue([])
 
+    @defer.inlineCallbacks
+    def query_dict_value_page(self, query, fields, key, params=None, after=None, limit=1000):
+        """ Keyset paginated `query_dict_value_list`, see `iterate_pages`. `query` has to end
+            with its WHERE clause, rows are ordered on the `key` columns, which are in `fields`.
+            Returns the records and the key to pass as `after` for the next page. """
+        params = dict(params or {})
+        if after is not None:
+            query += " AND ({}) > ({})".format(
+                ', '.join(key), ', '.join(':after_{}'.format(column) for column in key)
+            )
+            params.update(('after_{}'.format(column), value) for column, value in zip(key, after))
+        query += " ORDER BY {} LIMIT {}".format(', '.join(key), limit)
+        records = yield self.query_dict_value_list(query, fields, params)
+        next_after = None
+        if len(records) == limit:
+            next_after = tuple(records[-1][column] for column in key)
+        defer.returnValue((records, next_after))
+
     @defer.inlineCallbacks
     def query_dict_value(self, query, fields, params=None, default=None):
         result = yield self.query_dict_value_list(query, fields, params)
@@ -106,6 +328,20 @@ class SQLiteMixin:
         else:
             defer.returnValue(default)
 
+    @staticmethod
+    @defer.inlineCallbacks
+    def iterate_pages(get_page, on_page, *args, **kwargs):
+        """ Streams the pages of a keyset paginated query: `get_page(*args, after=key, **kwargs)`
+            returns a (rows, key) tuple where key is None on the last page, each page is passed
+            to `on_page`, which may return a deferred, before the next one is requested. """
+        after = None
+        while True:
+            rows, after = yield get_page(*args, after=after, **kwargs)
+            if rows:
+                yield on_page(rows)
+            if after is None:
+                break
+
     @staticmethod
     def execute(t, sql, values):
         log.debug(sql)
@@ -120,7 +356,35 @@ class SQLiteMixin:
     def run_query(self, sql, values):
         log.debug(sql)
         log.debug(values)
-        return self.db.runQuery(sql, values)
+        return self.readers.runQuery(sql, values)
+
+    # coroutine API, only available when opened with `use_asyncio`
+
+    def _check_asyncio(self):
+        if not self._use_asyncio:
+            raise RuntimeError("the coroutine API needs a database opened with use_asyncio=True")
+
+    async def run_interaction_async(self, func, *args):
+        self._check_asyncio()
+        return await self.db.run(func, *args)
+
+    async def run_operation_async(self, sql, values):
+        self._check_asyncio()
+        log.debug(sql)
+        log.debug(values)
+        return await self.db.execute(sql, values)
+
+    async def run_query_async(self, sql, values):
+        self._check_asyncio()
+        log.debug(sql)
+        log.debug(values)
+        return await self.readers.fetchall(sql, values)
+
+    async def query_one_value_async(self, query, params=None, default=None):
+        result = await self.run_query_async(query, params)
+        if result:
+            return result[0][0] or default
+        return default
 
 
 class BaseDatabase(SQLiteMixin):
@@ -128,149 +392,694 @@ class BaseDatabase(SQLiteMixin):
     CREATE_PUBKEY_ADDRESS_TABLE = """
         create table if not exists pubkey_address (
             address text primary key,
+            scripthash text not null,
             account text not null,
             chain integer not null,
             position integer not null,
             pubkey blob not null,
-            history text,
+            status text,
+            remote_status text,
             used_times integer not null default 0
         );
     """
 
+    CREATE_ADDRESS_HISTORY_TABLE = """
+        create table if not exists address_history (
+            address text references pubkey_address,
+            position integer not null,
+            txid blob not null,
+            height integer not null,
+            primary key (address, position)
+        );
+    """
+
     CREATE_TX_TABLE = """
         create table if not exists tx (
-            txid text primary key,
+            txid blob primary key,
             raw blob not null,
             height integer not null,
-            is_verified boolean not null default 0
+            is_verified boolean not null default 0,
+            merkle_branch blob,
+            merkle_pos integer,
+            verification_failures integer not null default 0
         );
     """
 
     CREATE_TXO_TABLE = """
         create table if not exists txo (
-            txid text references tx,
-            txoid text primary key,
-            address text references pubkey_address,
+            txid blob references tx,
             position integer not null,
+            address text references pubkey_address,
             amount integer not null,
             script blob not null,
-            is_reserved boolean not null default 0
+            is_reserved boolean not null default 0,
+            is_spent boolean not null default 0,
+            primary key (txid, position)
         );
     """
 
     CREATE_TXI_TABLE = """
         create table if not exists txi (
-            txid text references tx,
-            txoid text references txo,
-            address text references pubkey_address
+            txid blob references tx,
+            txo_txid blob not null,
+            txo_position integer not null,
+            address text references pubkey_address,
+            foreign key (txo_txid, txo_position) references txo
         );
     """
 
+    # indexes are created with "if not exists" when the database is opened,
+    # so wallets created before an index was added get it on their next start
+    CREATE_INDEXES = """
+        create index if not exists tx_height_idx on tx (height);
+        create index if not exists address_history_height_idx on address_history (height);
+        create index if not exists pubkey_address_account_idx
+            on pubkey_address (account, chain, position);
+        create index if not exists pubkey_address_used_times_idx
+            on pubkey_address (account, chain, used_times, position);
+        create index if not exists txo_address_idx on txo (address);
+        create index if not exists txi_txo_idx on txi (txo_txid, txo_position);
+        create index if not exists txi_txid_idx on txi (txid);
+        create index if not exists txo_unspent_idx on txo (address) where is_spent = 0;
+    """
+
+    # unspent totals of each account by height bucket, verification and reservation. Outputs
+    # confirmed at or below account_balance_cutoff are all kept in the height 1 bucket, the cutoff
+    # follows the chain tip BALANCE_SETTLED_DEPTH blocks behind (see settle_balances()), so an
+    # account has at most a few rows per recent block and balances are summed from those.
+    CREATE_ACCOUNT_BALANCE_TABLE = """
+        create table if not exists account_balance (
+            account text not null,
+            height integer not null,
+            is_verified boolean not null,
+            is_reserved boolean not null,
+            amount integer not null,
+            primary key (account, height, is_verified, is_reserved)
+        );
+        create table if not exists account_balance_cutoff (
+            height integer not null
+        );
+        insert into account_balance_cutoff (height)
+            select 0 where not exists (select * from account_balance_cutoff);
+    """
+
+    BALANCE_SETTLED_DEPTH = 100
+
+    _BALANCE_BUCKET = (
+        "(case when {height} > 0 and {height} <= (select height from account_balance_cutoff) "
+        "then 1 else {height} end)"
+    )
+
+    _UNSPENT_TXOS = """
+            from txo
+                join tx on tx.txid = txo.txid
+                join pubkey_address on pubkey_address.address = txo.address
+            where txo.is_spent = 0 and {}"""
+
+    # adds the unspent txos matching a condition, as they are now, to account_balance
+    _ADD_TO_BALANCE = """
+            insert or ignore into account_balance (account, height, is_verified, is_reserved, amount)
+                select pubkey_address.account, {bucket}, tx.is_verified, txo.is_reserved, 0 {unspent};
+            update account_balance set amount = amount + (
+                select coalesce(sum(txo.amount), 0) {unspent}
+                    and pubkey_address.account = account_balance.account
+                    and {bucket} = account_balance.height
+                    and tx.is_verified = account_balance.is_verified
+                    and txo.is_reserved = account_balance.is_reserved
+            ) where (account, height, is_verified, is_reserved) in (
+                select pubkey_address.account, {bucket}, tx.is_verified, txo.is_reserved {unspent}
+            );"""
+
+    # triggers keep account_balance up to date within every transaction which
+    # saves, spends, reserves, confirms, verifies or rewinds outputs
+    CREATE_ACCOUNT_BALANCE_TRIGGERS = """
+        create trigger if not exists txo_balance_insert after insert on txo
+        begin {add_txo}
+        end;
+
+        create trigger if not exists txo_balance_update after update of is_spent, is_reserved on txo
+        when old.is_spent != new.is_spent or old.is_reserved != new.is_reserved
+        begin
+            update account_balance set amount = amount - old.amount
+            where old.is_spent = 0
+              and account = (select account from pubkey_address where address = old.address)
+              and height = {old_txo_bucket}
+              and is_verified = (select is_verified from tx where txid = old.txid)
+              and is_reserved = old.is_reserved; {add_txo}
+            delete from account_balance where amount = 0
+              and account = (select account from pubkey_address where address = old.address);
+        end;
+
+        create trigger if not exists tx_balance_update after update of height, is_verified on tx
+        when old.height != new.height or old.is_verified != new.is_verified
+        begin
+            update account_balance set amount = amount - (
+                select coalesce(sum(txo.amount), 0)
+                from txo join pubkey_address on pubkey_address.address = txo.address
+                where txo.is_spent = 0 and txo.txid = old.txid
+                  and pubkey_address.account = account_balance.account
+                  and txo.is_reserved = account_balance.is_reserved
+            ) where height = {old_tx_bucket} and is_verified = old.is_verified and (account, is_reserved) in (
+                select pubkey_address.account, txo.is_reserved
+                from txo join pubkey_address on pubkey_address.address = txo.address
+                where txo.is_spent = 0 and txo.txid = old.txid
+            ); {add_tx}
+            delete from account_balance where amount = 0 and account in (
+                select pubkey_address.account
+                from txo join pubkey_address on pubkey_address.address = txo.address
+                where txo.txid = old.txid
+            );
+        end;
+    """.format(
+        add_txo=_ADD_TO_BALANCE.format(
+            unspent=_UNSPENT_TXOS.format("txo.txid = new.txid and txo.position = new.position"),
+            bucket=_BALANCE_BUCKET.format(height="tx.height")
+        ),
+        add_tx=_ADD_TO_BALANCE.format(
+            unspent=_UNSPENT_TXOS.format("txo.txid = new.txid"),
+            bucket=_BALANCE_BUCKET.format(height="tx.height")
+        ),
+        old_txo_bucket=_BALANCE_BUCKET.format(height="(select height from tx where txid = old.txid)"),
+        old_tx_bucket=_BALANCE_BUCKET.format(height="old.height"),
+    )
+
     CREATE_TABLES_QUERY = (
         CREATE_TX_TABLE +
         CREATE_PUBKEY_ADDRESS_TABLE +
+        CREATE_ADDRESS_HISTORY_TABLE +
         CREATE_TXO_TABLE +
-        CREATE_TXI_TABLE
+        CREATE_TXI_TABLE +
+        CREATE_ACCOUNT_BALANCE_TABLE +
+        CREATE_INDEXES +
+        CREATE_ACCOUNT_BALANCE_TRIGGERS
+    )
+
+    @staticmethod
+    def hash160_to_scripthash(h160: bytes) -> str:
+        """ Electrum scripthash, the reversed sha256 of the pay to pubkey hash script. """
+        return hexlify(sha256(BaseOutputScript.pay_pubkey_hash(h160).source)[::-1]).decode()
+
+    def _add_scripthash(self, t, after):
+        if 'scripthash' not in self._get_columns(t, 'pubkey_address'):
+            t.execute("ALTER TABLE pubkey_address ADD COLUMN scripthash text not null default ''")
+        keys = self.execute(
+            t, "SELECT rowid, pubkey FROM pubkey_address WHERE rowid > ? ORDER BY rowid LIMIT ?",
+            (after or 0, self.MIGRATION_CHUNK_SIZE)
+        ).fetchall()
+        t.executemany("UPDATE pubkey_address SET scripthash = ? WHERE rowid = ?", [
+            (self.hash160_to_scripthash(hash160(bytes(pubkey))), rowid) for rowid, pubkey in keys
+        ])
+        return self._next_chunk(t, 'pubkey_address', keys)
+
+    def _add_remote_status(self, t, after):
+        if 'remote_status' not in self._get_columns(t, 'pubkey_address'):
+            t.execute("ALTER TABLE pubkey_address ADD COLUMN remote_status text")
+
+    def _add_merkle_proofs(self, t, after):
+        if 'merkle_branch' not in self._get_columns(t, 'tx'):
+            t.execute("ALTER TABLE tx ADD COLUMN merkle_branch blob")
+            t.execute("ALTER TABLE tx ADD COLUMN merkle_pos integer")
+
+    def _add_status(self, t, after):
+        if 'status' not in self._get_columns(t, 'pubkey_address'):
+            t.execute("ALTER TABLE pubkey_address ADD COLUMN status text")
+
+    def _split_address_history(self, t, after):
+        """ Moves the "<txid>:<height>:" history strings of older versions into address_history
+            and stores the status hash of each address. pubkey_address is rebuilt without its
+            history column, its rows are moved to new_pubkey_address a chunk at a time. """
+        t.execute("""
+            create table if not exists address_history (
+                address text references pubkey_address,
+                position integer not null,
+                txid text not null,
+                height integer not null,
+                primary key (address, position)
+            )
+        """)
+        t.execute("""
+            create table if not exists new_pubkey_address (
+                address text primary key,
+                scripthash text not null,
+                account text not null,
+                chain integer not null,
+                position integer not null,
+                pubkey blob not null,
+                status text,
+                remote_status text,
+                used_times integer not null default 0
+            )
+        """)
+        columns = self._get_columns(t, 'new_pubkey_address')
+        rows = self.execute(
+            t, "SELECT rowid, history, {} FROM pubkey_address ORDER BY rowid LIMIT ?".format(
+                ', '.join(columns)
+            ), (self.MIGRATION_CHUNK_SIZE,)
+        ).fetchall()
+        addresses, history_rows = [], []
+        for _, history, *values in rows:
+            address = dict(zip(columns, values))
+            parts = (history or '').split(':')[:-1]
+            history = [(txid, int(height)) for txid, height in zip(parts[::2], parts[1::2])]
+            address['status'] = history_to_status(history)
+            addresses.append(tuple(address.values()))
+            history_rows.extend(
+                (address['address'], position, txid, height)
+                for position, (txid, height) in enumerate(history)
+            )
+        self._insert_many(t, 'new_pubkey_address', columns, addresses)
+        self._insert_many(t, 'address_history', ('address', 'position', 'txid', 'height'), history_rows)
+        if rows:
+            self.execute(t, "DELETE FROM pubkey_address WHERE rowid <= ?", (rows[-1][0],))
+        if len(rows) < self.MIGRATION_CHUNK_SIZE:
+            t.execute("DROP TABLE pubkey_address")
+            t.execute("ALTER TABLE new_pubkey_address RENAME TO pubkey_address")
+            return None
+        return t.execute("SELECT COUNT(*) FROM pubkey_address").fetchone()[0], None
+
+    def _add_spent_marker(self, t, after):
+        if 'is_spent' not in self._get_columns(t, 'txo'):
+            t.execute("ALTER TABLE txo ADD COLUMN is_spent boolean not null default 0")
+        spends = self.execute(
+            t, "SELECT rowid, txoid FROM txi WHERE rowid > ? ORDER BY rowid LIMIT ?",
+            (after or 0, self.MIGRATION_CHUNK_SIZE)
+        ).fetchall()
+        t.executemany("UPDATE txo SET is_spent = 1 WHERE txoid = ?", [(txoid,) for _, txoid in spends])
+        return self._next_chunk(t, 'txi', spends)
+
+    _TEXT_TXID_TABLES = ('tx', 'address_history', 'txo', 'txi')
+
+    def _store_binary_txids(self, t, after):
+        """ Converts the hex text txids and "<txid>:<position>" txoids of older versions to binary
+            txids. Tables are renamed to old_<table> and recreated, then their rows are moved
+            over a chunk at a time, deleting them from the old table as they are copied. """
+        tables = self._get_tables(t)
+        old_tables = [table for table in self._TEXT_TXID_TABLES if 'old_'+table in tables]
+        if not old_tables:
+            for table in self._TEXT_TXID_TABLES:
+                t.execute("ALTER TABLE {0} RENAME TO old_{0}".format(table))
+            for create_table in (self.CREATE_TX_TABLE, self.CREATE_ADDRESS_HISTORY_TABLE,
+                                 self.CREATE_TXO_TABLE, self.CREATE_TXI_TABLE):
+                t.execute(create_table)
+            old_tables = list(self._TEXT_TXID_TABLES)
+
+        table = old_tables[0]
+        columns = self._get_columns(t, table)
+        old_columns = self._get_columns(t, 'old_'+table)
+        converted = [column for column in old_columns if column != 'txoid']
+        if table == 'txi':
+            converted.extend(('txo_txid', 'txo_position'))
+        insert_columns = [column for column in converted if column in columns]
+        rows = self.execute(
+            t, "SELECT rowid, {} FROM old_{} ORDER BY rowid LIMIT ?".format(', '.join(old_columns), table),
+            (self.MIGRATION_CHUNK_SIZE,)
+        ).fetchall()
+        self._insert_many(t, table, insert_columns, [
+            tuple(row[column] for column in insert_columns)
+            for row in (self._convert_text_txids(dict(zip(old_columns, values))) for _, *values in rows)
+        ])
+        if rows:
+            self.execute(t, "DELETE FROM old_{} WHERE rowid <= ?".format(table), (rows[-1][0],))
+        if len(rows) < self.MIGRATION_CHUNK_SIZE:
+            t.execute("DROP TABLE old_{}".format(table))
+            old_tables.remove(table)
+        if not old_tables:
+            return None
+        return sum(
+            t.execute("SELECT COUNT(*) FROM old_{}".format(old_table)).fetchone()[0] + 1
+            for old_table in old_tables
+        ), None
+
+    @staticmethod
+    def _convert_text_txids(row):
+        row['txid'] = txid_to_bytes(row['txid'])
+        txoid = row.pop('txoid', None)
+        if txoid is not None:
+            txid, position = txoid.split(':')
+            row['txo_txid'], row['txo_position'] = txid_to_bytes(txid), int(position)
+        return row
+
+    def _add_account_balance(self, t, after):
+        """ Fills in account_balance from the unspent outputs, a chunk of txo rows at a time. """
+        if after is None:
+            for statement in self.CREATE_ACCOUNT_BALANCE_TABLE.split(';')[:-1]:
+                t.execute(statement)
+            t.execute("DELETE FROM account_balance")
+            after = 0
+        last = self.execute(
+            t, "SELECT rowid FROM txo WHERE rowid > ? ORDER BY rowid LIMIT 1 OFFSET ?",
+            (after, self.MIGRATION_CHUNK_SIZE-1)
+        ).fetchone()
+        chunk = "txo.rowid > :after" if last is None else "txo.rowid > :after and txo.rowid <= :last"
+        for statement in self._ADD_TO_BALANCE.format(
+                unspent=self._UNSPENT_TXOS.format(chunk),
+                bucket=self._BALANCE_BUCKET.format(height="tx.height")).split(';')[:-1]:
+            self.execute(t, statement, {'after': after, 'last': last and last[0]})
+        if last is None:
+            return None
+        return self.execute(t, "SELECT COUNT(*) FROM txo WHERE rowid > ?", last).fetchone()[0], last[0]
+
+    def _add_verification_failures(self, t, after):
+        if 'verification_failures' not in self._get_columns(t, 'tx'):
+            t.execute("ALTER TABLE tx ADD COLUMN verification_failures integer not null default 0")
+
+    MIGRATIONS = (
+        _add_scripthash,
+        _add_remote_status,
+        _add_merkle_proofs,
+        _add_status,
+        _split_address_history,
+        _add_spent_marker,
+        _store_binary_txids,
+        _add_account_balance,
+        _add_verification_failures,
     )
 
+    @classmethod
+    def _recompute_balances(cls, t):
+        bucket = cls._BALANCE_BUCKET.format(height="tx.height")
+        cls.execute(t, "DELETE FROM account_balance", ())
+        cls.execute(
+            t, "INSERT INTO account_balance (account, height, is_verified, is_reserved, amount) "
+               "SELECT pubkey_address.account, {0}, tx.is_verified, txo.is_reserved, SUM(txo.amount) {1} "
+               "GROUP BY pubkey_address.account, {0}, tx.is_verified, txo.is_reserved".format(
+                   bucket, cls._UNSPENT_TXOS.format("1")
+               ), ()
+        )
+
+    def recompute_balances(self):
+        """ Rebuilds the account_balance totals from scratch, they are otherwise
+            maintained incrementally by triggers. """
+        return self.db.runInteraction(self._recompute_balances)
+
+    def settle_balances(self, height):
+        """ Moves the account_balance cutoff to BALANCE_SETTLED_DEPTH blocks below `height`,
+            the chain tip, merging the totals of the blocks it passes into the height 1 bucket. """
+
+        def _steps(t):
+            cutoff = height - self.BALANCE_SETTLED_DEPTH
+            if cutoff <= t.execute("SELECT height FROM account_balance_cutoff").fetchone()[0]:
+                return
+            self.execute(
+                t, "INSERT OR IGNORE INTO account_balance "
+                   "(account, height, is_verified, is_reserved, amount) "
+                   "SELECT account, 1, is_verified, is_reserved, 0 FROM account_balance "
+                   "WHERE height > 1 AND height <= ?", (cutoff,)
+            )
+            self.execute(
+                t, "UPDATE account_balance SET amount = amount + ("
+                   "  SELECT coalesce(sum(settled.amount), 0) FROM account_balance AS settled"
+                   "  WHERE settled.account = account_balance.account AND settled.height > 1"
+                   "    AND settled.height <= :cutoff AND settled.is_verified = account_balance.is_verified"
+                   "    AND settled.is_reserved = account_balance.is_reserved"
+                   ") WHERE height = 1", {'cutoff': cutoff}
+            )
+            self.execute(t, "DELETE FROM account_balance WHERE height > 1 AND height <= ?", (cutoff,))
+            self.execute(t, "UPDATE account_balance_cutoff SET height = ?", (cutoff,))
+
+        return self.db.runInteraction(_steps)
+
     @staticmethod
     def txo_to_row(tx, address, txo):
         return {
-            'txid': tx.id,
-            'txoid': txo.id,
+            'txid': tx.hash,
             'address': address,
             'position': txo.position,
             'amount': txo.amount,
             'script': sqlite3.Binary(txo.script.source)
         }
 
-    def save_transaction_io(self, save_tx, tx, height, is_verified, address, txhash, history):
+    def save_transaction_io(self, save_tx, tx, height, is_verified, address, txhash,
+                            history_position, history, status, merkle_proof=None):
+        return self.db.runInteraction(lambda t: self._save_transactions_io(t, [(save_tx, TransactionWrite(
+            tx, height, is_verified, address, txhash, history_position, history, status, merkle_proof
+        ))]))
+
+    def save_transactions_io(self, writes):
+        """ Saves a batch of TransactionWrite in one database transaction, in order. Whether
+            each transaction needs to be inserted, updated or was already saved is decided
+            inside of the database transaction, writes with no `tx` only save the address
+            history. Returns a (save_tx, is_verified) tuple for each write. """
 
         def _steps(t):
+            stored = dict(self._select_in(
+                t, "SELECT txid, is_verified FROM tx WHERE txid IN ({})",
+                list({write.tx.hash for write in writes if write.tx is not None})
+            ))
+            resolved, results = [], []
+            for write in writes:
+                save_tx = None
+                if write.tx is None:
+                    pass
+                elif write.tx.hash not in stored:
+                    save_tx = 'insert'
+                elif write.height > 0 and not stored[write.tx.hash]:
+                    save_tx = 'update'
+                else:
+                    write = write._replace(is_verified=stored[write.tx.hash], merkle_proof=None)
+                if save_tx is not None:
+                    stored[write.tx.hash] = write.is_verified
+                resolved.append((save_tx, write))
+                results.append((save_tx, write.is_verified))
+            self._save_transactions_io(t, resolved)
+            return results
+
+        return self.db.runInteraction(_steps)
+
+    @classmethod
+    def _select_in(cls, t, sql, values, chunk_size=900):
+        """ Runs a query with an "IN ({})" clause over `values` in chunks which stay
+            under the SQLite limit on the number of query parameters. """
+        rows = []
+        for i in range(0, len(values), chunk_size):
+            chunk = values[i:i+chunk_size]
+            rows.extend(cls.execute(t, sql.format(', '.join(['?']*len(chunk))), chunk).fetchall())
+        return rows
+
+    def _save_transactions_io(self, t, writes):
+        txs = [write.tx for save_tx, write in writes if write.tx is not None]
+        tx_hashes = list({tx.hash for tx in txs})
+        existing_txos = set(self._select_in(
+            t, "SELECT txid, position FROM txo WHERE txid IN ({})", tx_hashes
+        ))
+        existing_txis = {
+            (txid, (txo_txid, txo_position)) for txid, txo_txid, txo_position in self._select_in(
+                t, "SELECT txid, txo_txid, txo_position FROM txi WHERE txid IN ({})", tx_hashes
+            )
+        }
+
+        # lookup the address associated with each TXI (via its TXO)
+        txo_to_address = {
+            (txid, position): address for txid, position, address in self._select_in(
+                t, "SELECT txid, position, address FROM txo WHERE txid IN ({})",
+                list({txi.txo_ref.tx_ref.hash for tx in txs for txi in tx.inputs})
+            )
+        }
+
+        tx_inserts, tx_updates, txo_rows, txi_rows = [], [], [], []
+        for save_tx, write in writes:
+            tx = write.tx
+            if tx is None:
+                continue
+
+            branch, pos = None, None
+            if write.merkle_proof is not None:
+                branch, pos = sqlite3.Binary(write.merkle_proof[0]), write.merkle_proof[1]
             if save_tx == 'insert':
-                self.execute(t, *self._insert_sql('tx', {
-                    'txid': tx.id,
-                    'raw': sqlite3.Binary(tx.raw),
-                    'height': height,
-                    'is_verified': is_verified
-                }))
+                tx_inserts.append((
+                    tx.hash, sqlite3.Binary(tx.raw), write.height, write.is_verified, branch, pos
+                ))
             elif save_tx == 'update':
-                self.execute(t, *self._update_sql("tx", {
-                    'height': height, 'is_verified': is_verified
-                }, 'txid = ?', (tx.id,)))
-
-            existing_txos = [r[0] for r in self.execute(
-                t, "SELECT position FROM txo WHERE txid = ?", (tx.id,)
-            ).fetchall()]
+                tx_updates.append((write.height, write.height, write.is_verified, branch, pos, tx.hash))
 
             for txo in tx.outputs:
-                if txo.position in existing_txos:
+                if (tx.hash, txo.position) in existing_txos:
                     continue
-                if txo.script.is_pay_pubkey_hash and txo.script.values['pubkey_hash'] == txhash:
-                    self.execute(t, *self._insert_sql("txo", self.txo_to_row(tx, address, txo)))
+                if txo.script.is_pay_pubkey_hash and txo.script.values['pubkey_hash'] == write.txhash:
+                    existing_txos.add((tx.hash, txo.position))
+                    txo_to_address[(tx.hash, txo.position)] = write.address
+                    txo_rows.append(self.txo_to_row(tx, write.address, txo))
                 elif txo.script.is_pay_script_hash:
                     # TODO: implement script hash payments
                     print('Database.save_transaction_io: pay script hash is not implemented!')
 
-            # lookup the address associated with each TXI (via its TXO)
-            txoids = [txi.txo_ref.id for txi in tx.inputs]
-            txoid_place_holders = ','.join(['?']*len(txoids))
-            txoid_to_address = {r[0]: r[1] for r in self.execute(
-                t, "SELECT txoid, address FROM txo WHERE txoid in ({})".format(txoid_place_holders), txoids
-            ).fetchall()}
-
-            # list of TXIs that have already been added
-            existing_txis = [r[0] for r in self.execute(
-                t, "SELECT txoid FROM txi WHERE txid = ?", (tx.id,)
-            ).fetchall()]
-
             for txi in tx.inputs:
-                txoid = txi.txo_ref.id
-                new_txi = txoid not in existing_txis
-                address_matches = txoid_to_address.get(txoid) == address
+                txo_key = (txi.txo_ref.tx_ref.hash, txi.txo_ref.position)
+                new_txi = (tx.hash, txo_key) not in existing_txis
+                address_matches = txo_to_address.get(txo_key) == write.address
                 if new_txi and address_matches:
-                    self.execute(t, *self._insert_sql("txi", {
-                        'txid': tx.id,
-                        'txoid': txoid,
-                        'address': address,
-                    }))
+                    existing_txis.add((tx.hash, txo_key))
+                    txi_rows.append((tx.hash, txo_key[0], txo_key[1], write.address))
 
-            self._set_address_history(t, address, history)
+        self._insert_many(
+            t, "tx", ("txid", "raw", "height", "is_verified", "merkle_branch", "merkle_pos"), tx_inserts
+        )
+        # failed verifications are only counted for the block the transaction is in
+        t.executemany(
+            "UPDATE tx SET "
+            "verification_failures = CASE WHEN height = ? THEN verification_failures ELSE 0 END, "
+            "height = ?, is_verified = ?, merkle_branch = coalesce(?, merkle_branch), "
+            "merkle_pos = coalesce(?, merkle_pos) WHERE txid = ?", tx_updates
+        )
+        # txo_to_row() may be extended with more columns, rows are grouped by their columns
+        txo_inserts = {}
+        for row in txo_rows:
+            txo_inserts.setdefault(tuple(row), []).append(tuple(row.values()))
+        for columns, values in txo_inserts.items():
+            self._insert_many(t, "txo", columns, values)
+        self._insert_many(t, "txi", ("txid", "txo_txid", "txo_position", "address"), txi_rows)
+        # txo.is_spent is kept in step with txi so that unspent outputs can be
+        # found with the partial index instead of an anti-join against txi
+        t.executemany(
+            "UPDATE txo SET is_spent = 1 WHERE txid = ? AND position = ?",
+            [(txo_txid, txo_position) for _, txo_txid, txo_position, _ in txi_rows]
+        )
 
-        return self.db.runInteraction(_steps)
+        for _, write in writes:
+            self._set_address_history(t, write.address, write.history_position, write.history, write.status)
 
     def reserve_outputs(self, txos, is_reserved=True):
-        txoids = [txo.id for txo in txos]
-        return self.run_operation(
-            "UPDATE txo SET is_reserved = ? WHERE txoid IN ({})".format(
-                ', '.join(['?']*len(txoids))
-            ), [is_reserved]+txoids
-        )
+        values = [(is_reserved, txo.tx_ref.hash, txo.position) for txo in txos]
+        return self.db.runInteraction(lambda t: t.executemany(
+            "UPDATE txo SET is_reserved = ? WHERE txid = ? AND position = ?", values
+        ))
 
     def release_outputs(self, txos):
         return self.reserve_outputs(txos, is_reserved=False)
 
-    def rewind_blockchain(self, above_height):  # pylint: disable=no-self-use
-        # TODO:
-        # 1. delete transactions above_height
-        # 2. update address histories removing deleted TXs
-        return defer.succeed(True)
+    def rewind_blockchain(self, above_height):
+        """ Undoes everything recorded about blocks above `above_height` in one transaction:
+            transactions confirmed in those blocks are demoted back to unconfirmed and
+            the histories of the addresses they touched are truncated right before the
+            first orphaned entry. Orphaned transactions keep their inputs, so the outputs
+            they spend stay marked as spent. Returns the touched addresses, which need to
+            be synced again, and the ids of the orphaned transactions, which are deleted by
+            delete_unreferenced_transactions() if no synced history includes them again. """
+
+        def _steps(t):
+            truncate_at = self.execute(
+                t, "SELECT address, MIN(position) FROM address_history "
+                   "WHERE height > ? GROUP BY address", (above_height,)
+            ).fetchall()
+            orphaned = [bytes_to_txid(txid) for txid, in self.execute(
+                t, "SELECT txid FROM tx WHERE height > ?", (above_height,)
+            )]
+            self.execute(
+                t, "UPDATE tx SET height = 0, is_verified = 0, merkle_branch = NULL, merkle_pos = NULL, "
+                   "verification_failures = 0 WHERE height > ?", (above_height,)
+            )
+            for address, position in truncate_at:
+                history = [(bytes_to_txid(txid), height) for txid, height in self.execute(
+                    t, "SELECT txid, height FROM address_history "
+                       "WHERE address = ? AND position < ? ORDER BY position", (address, position)
+                )]
+                self._set_address_history(t, address, position, [], history_to_status(history))
+            return [address for address, _ in truncate_at], orphaned
+
+        return self.db.runInteraction(_steps)
+
+    def delete_unreferenced_transactions(self, txids):
+        """ Deletes the transactions of `txids` which no address history includes, along with
+            their outputs and inputs. Outputs which were only spent by the deleted inputs are
+            unspent again. Returns the ids of the deleted transactions. """
+
+        def _steps(t):
+            unreferenced = [txid for txid, in self._select_in(
+                t, "SELECT txid FROM tx WHERE txid IN ({}) AND NOT EXISTS "
+                   "(SELECT 1 FROM address_history WHERE address_history.txid = tx.txid)",
+                [txid_to_bytes(txid) for txid in txids]
+            )]
+            deleting = [(txid,) for txid in unreferenced]
+            # marking the outputs spent takes them out of account_balance through its trigger
+            t.executemany("UPDATE txo SET is_spent = 1 WHERE txid = ?", deleting)
+            t.executemany("DELETE FROM txo WHERE txid = ?", deleting)
+            spent = self._select_in(
+                t, "SELECT txo_txid, txo_position FROM txi WHERE txid IN ({})", unreferenced
+            )
+            t.executemany("DELETE FROM txi WHERE txid = ?", deleting)
+            t.executemany(
+                "UPDATE txo SET is_spent = 0 WHERE txid = ? AND position = ? AND NOT EXISTS "
+                "(SELECT 1 FROM txi WHERE txi.txo_txid = txo.txid AND txi.txo_position = txo.position)",
+                spent
+            )
+            t.executemany("DELETE FROM tx WHERE txid = ?", deleting)
+            return [bytes_to_txid(txid) for txid in unreferenced]
+
+        return self.db.runInteraction(_steps)
+
+    @defer.inlineCallbacks
+    def get_unconfirmed_transactions(self):
+        rows = yield self.run_query("SELECT txid, raw FROM tx WHERE height <= 0", ())
+        defer.returnValue([(bytes_to_txid(txid), raw) for txid, raw in rows])
+
+    def confirm_transactions(self, confirmed):
+        """ Marks previously unconfirmed transactions as confirmed, `confirmed` is a list
+            of (txid, height, is_verified, merkle_proof), raw data is left untouched. """
+        return self.db.runInteraction(lambda t: t.executemany(
+            "UPDATE tx SET height = ?, is_verified = ?, merkle_branch = ?, merkle_pos = ?, "
+            "verification_failures = 0 WHERE txid = ?", [
+                (height, is_verified,
+                 sqlite3.Binary(proof[0]) if proof else None, proof[1] if proof else None,
+                 txid_to_bytes(txid))
+                for txid, height, is_verified, proof in confirmed
+            ]
+        ))
+
+    @defer.inlineCallbacks
+    def get_unverified_transactions(self, max_failures):
+        """ Confirmed transactions which aren't verified yet, leaving out the ones which
+            failed verification `max_failures` times in their current block. """
+        rows = yield self.run_query(
+            "SELECT txid, raw, height FROM tx WHERE height > 0 AND is_verified = 0 "
+            "AND verification_failures < ?", (max_failures,)
+        )
+        defer.returnValue([(bytes_to_txid(txid), raw, height) for txid, raw, height in rows])
+
+    @defer.inlineCallbacks
+    def get_verification_failures(self, txids):
+        """ Number of failed verifications of each stored transaction out of `txids`. """
+        result = yield self.readers.runInteraction(
+            self._select_in, "SELECT txid, verification_failures FROM tx WHERE txid IN ({})",
+            [txid_to_bytes(txid) for txid in txids]
+        )
+        defer.returnValue({bytes_to_txid(txid): failures for txid, failures in result})
+
+    def set_verified(self, verified):
+        """ Saves the results of merkle verification, `verified` is a list
+            of (txid, is_verified, merkle_proof). Failed verifications are counted. """
+        return self.db.runInteraction(lambda t: t.executemany(
+            "UPDATE tx SET is_verified = ?, merkle_branch = ?, merkle_pos = ?, "
+            "verification_failures = CASE WHEN ? THEN 0 ELSE verification_failures + 1 END WHERE txid = ?", [
+                (is_verified, sqlite3.Binary(proof[0]) if proof else None, proof[1] if proof else None,
+                 is_verified, txid_to_bytes(txid))
+                for txid, is_verified, proof in verified
+            ]
+        ))
 
     @defer.inlineCallbacks
     def get_transaction(self, txid):
         result = yield self.run_query(
-            "SELECT raw, height, is_verified FROM tx WHERE txid = ?", (txid,)
+            "SELECT raw, height, is_verified FROM tx WHERE txid = ?", (txid_to_bytes(txid),)
         )
         if result:
             defer.returnValue(result[0])
         else:
             defer.returnValue((None, None, False))
 
+    @defer.inlineCallbacks
+    def get_merkle_proofs(self, txids):
+        result = yield self.readers.runInteraction(
+            self._select_in, "SELECT txid, merkle_branch, merkle_pos FROM tx "
+                             "WHERE merkle_branch IS NOT NULL AND txid IN ({})",
+            [txid_to_bytes(txid) for txid in txids]
+        )
+        defer.returnValue({bytes_to_txid(txid): (bytes(branch), pos) for txid, branch, pos in result})
+
     def get_balance_for_account(self, account, include_reserved=False, **constraints):
         if not include_reserved:
             constraints['is_reserved'] = 0
-        values = {'account': account.public_key.address}
-        values.update(constraints)
+        sql, values = constraints_to_sql(constraints)
+        values['account'] = account.public_key.address
         return self.query_one_value(
             """
             SELECT SUM(amount)
@@ -279,54 +1088,133 @@ class BaseDatabase(SQLiteMixin):
                 JOIN pubkey_address ON pubkey_address.address=txo.address
             WHERE
               pubkey_address.account=:account AND
-              txoid NOT IN (SELECT txoid FROM txi)
-            """+constraints_to_sql(constraints), values, 0
+              txo.is_spent=0
+            """+sql, values, 0
         )
 
     @defer.inlineCallbacks
-    def get_utxos_for_account(self, account, **constraints):
-        constraints['account'] = account.public_key.address
-        utxos = yield self.run_query(
-            """
-            SELECT amount, script, txid, txo.position
-            FROM txo JOIN pubkey_address ON pubkey_address.address=txo.address
-            WHERE account=:account AND txo.is_reserved=0 AND txoid NOT IN (SELECT txoid FROM txi)
-            """+constraints_to_sql(constraints), constraints
+    def get_cached_balance_for_account(self, account, max_height=None, include_reserved=False):
+        """ Same as `get_balance_for_account` but summed from the account_balance totals,
+            when `max_height` is given only verified outputs confirmed at or below it count.
+            Heights below the settled cutoff can't be told apart in the totals, balances
+            for those are calculated with `get_balance_for_account` instead. """
+        sql = (
+            "SELECT (SELECT height FROM account_balance_cutoff), SUM(amount) "
+            "FROM account_balance WHERE account = ?"
         )
+        values = [account.public_key.address]
+        if not include_reserved:
+            sql += " AND is_reserved = 0"
+        if max_height is not None:
+            sql += " AND height > 0 AND height <= ? AND is_verified = 1"
+            values.append(max_height)
+        cutoff, balance = (yield self.run_query(sql, values))[0]
+        if max_height is not None and max_height < cutoff:
+            balance = yield self.get_balance_for_account(
+                account, include_reserved, height__lte=max_height, height__gt=0, is_verified=1
+            )
+        defer.returnValue(balance or 0)
+
+    UTXO_QUERY = """
+            SELECT amount, script, txo.txid, txo.position,
+                pubkey_address.chain, pubkey_address.position, txo.rowid
+            FROM txo JOIN pubkey_address ON pubkey_address.address=txo.address
+            WHERE account=:account AND txo.is_reserved=0 AND txo.is_spent=0
+    """
+
+    @staticmethod
+    def _rows_to_outputs(account, rows):
         output_class = account.ledger.transaction_class.output_class
-        defer.returnValue([
+        return [
             output_class(
                 values[0],
                 output_class.script_class(values[1]),
-                TXRefImmutable.from_id(values[2]),
+                TXRefImmutable.from_hash(bytes(values[2])),
                 position=values[3]
-            ) for values in utxos
-        ])
+            ) for values in rows
+        ]
+
+    @defer.inlineCallbacks
+    def get_utxos_for_account(self, account, **constraints):
+        sql, values = constraints_to_sql(constraints)
+        values['account'] = account.public_key.address
+        utxos = yield self.run_query(self.UTXO_QUERY+sql, values)
+        defer.returnValue(self._rows_to_outputs(account, utxos))
+
+    @defer.inlineCallbacks
+    def get_utxos_page_for_account(self, account, after=None, limit=1000, **constraints):
+        """ Page of `get_utxos_for_account` ordered by address and then output, see `iterate_pages`.
+            Returns the outputs and the key to pass as `after` for the next page. """
+        sql, values = constraints_to_sql(constraints)
+        values['account'] = account.public_key.address
+        if after is not None:
+            sql += (
+                " AND (pubkey_address.chain, pubkey_address.position, txo.rowid)"
+                " > (:after_chain, :after_position, :after_rowid)"
+            )
+            values.update(zip(('after_chain', 'after_position', 'after_rowid'), after))
+        sql += " ORDER BY pubkey_address.chain, pubkey_address.position, txo.rowid LIMIT {}".format(limit)
+        utxos = yield self.run_query(self.UTXO_QUERY+sql, values)
+        next_after = tuple(utxos[-1][4:]) if len(utxos) == limit else None
+        defer.returnValue((self._rows_to_outputs(account, utxos), next_after))
 
     def add_keys(self, account, chain, keys):
-        sql = (
-            "insert into pubkey_address "
-            "(address, account, chain, position, pubkey) "
-            "values "
-        ) + ', '.join(['(?, ?, ?, ?, ?)'] * len(keys))
-        values = []
-        for position, pubkey in keys:
-            values.append(pubkey.address)
-            values.append(account.public_key.address)
-            values.append(chain)
-            values.append(position)
-            values.append(sqlite3.Binary(pubkey.pubkey_bytes))
-        return self.run_operation(sql, values)
+        return self.insert_many(
+            "pubkey_address", ("address", "scripthash", "account", "chain", "position", "pubkey"), [(
+                pubkey.address,
+                self.hash160_to_scripthash(pubkey.identifier()),
+                account.public_key.address,
+                chain,
+                position,
+                sqlite3.Binary(pubkey.pubkey_bytes)
+            ) for position, pubkey in keys]
+        )
 
     @classmethod
-    def _set_address_history(cls, t, address, history):
+    def _set_address_history(cls, t, address, position, history, status):
+        """ Replaces the history of the address starting at `position` with the
+            (txid, height) entries in `history`, `status` is the Electrum status
+            hash of the resulting full history. """
         cls.execute(
-            t, "UPDATE pubkey_address SET history = ?, used_times = ? WHERE address = ?",
-            (history, history.count(':')//2, address)
+            t, "DELETE FROM address_history WHERE address = ? AND position >= ?", (address, position)
+        )
+        t.executemany(
+            "INSERT INTO address_history (address, position, txid, height) VALUES (?, ?, ?, ?)",
+            [(address, position+i, txid_to_bytes(txid), height) for i, (txid, height) in enumerate(history)]
         )
+        cls.execute(
+            t, "UPDATE pubkey_address SET used_times = ?, status = ? WHERE address = ?",
+            (position+len(history), status, address)
+        )
+
+    def set_address_history(self, address, history, status, position=0):
+        return self.db.runInteraction(
+            lambda t: self._set_address_history(t, address, position, history, status)
+        )
+
+    @defer.inlineCallbacks
+    def get_address_history(self, address):
+        rows = yield self.run_query(
+            "SELECT txid, height FROM address_history WHERE address = ? ORDER BY position",
+            (address,)
+        )
+        defer.returnValue([(bytes_to_txid(txid), height) for txid, height in rows])
+
+    def get_address_statuses(self, account, subscription_starts=None):
+        """ `subscription_starts` maps chains to the position of their first address to
+            return, addresses before it are outside of the chain's subscription window. """
+        sql = "SELECT address, scripthash, status, remote_status FROM pubkey_address WHERE account = ?"
+        values = [account.public_key.address]
+        for chain, start in (subscription_starts or {}).items():
+            sql += " AND NOT (chain = ? AND position < ?)"
+            values.extend((chain, start))
+        return self.run_query(sql, values)
 
-    def set_address_history(self, address, history):
-        return self.db.runInteraction(lambda t: self._set_address_history(t, address, history))
+    def set_remote_statuses(self, statuses):
+        return self.db.runInteraction(lambda t: t.executemany(
+            "UPDATE pubkey_address SET remote_status = ? WHERE address = ?",
+            [(status, address) for address, status in statuses]
+        ))
 
     def get_addresses(self, account, chain, limit=None, max_used_times=None, order_by=None):
         columns = ['account', 'chain', 'position', 'address', 'used_times']
@@ -358,9 +1246,29 @@ class BaseDatabase(SQLiteMixin):
 
         return self.query_dict_value_list(" ".join(sql), columns, params)
 
+    def get_addresses_page(self, account, chain=None, after=None, limit=1000, max_used_times=None,
+                           before_position=None):
+        """ Page of the account's addresses ordered by chain and position, see `iterate_pages`.
+            Returns the address records and the key to pass as `after` for the next page. """
+        sql = "SELECT {} FROM pubkey_address WHERE account = :account"
+        params = {'account': account.public_key.address}
+        if chain is not None:
+            sql += " AND chain = :chain"
+            params['chain'] = chain
+        if max_used_times is not None:
+            sql += " AND used_times <= :used_times"
+            params['used_times'] = max_used_times
+        if before_position is not None:
+            sql += " AND position < :before_position"
+            params['before_position'] = before_position
+        return self.query_dict_value_page(
+            sql, ('chain', 'position', 'address', 'used_times', 'status'), ('chain', 'position'),
+            params, after, limit
+        )
+
     def get_address(self, address):
         return self.query_dict_value(
             "SELECT {} FROM pubkey_address WHERE address = :address",
-            ('address', 'account', 'chain', 'position', 'pubkey', 'history', 'used_times'),
+            ('address', 'scripthash', 'account', 'chain', 'position', 'pubkey', 'status', 'used_times'),
             {'address': address}
         )
@@ -1,21 +1,26 @@
 import os
+import heapq
+import hashlib
 import logging
 from binascii import hexlify, unhexlify
-from typing import Dict, Type, Iterable
+from typing import Dict, Type, Iterable, Deque, Tuple, Any, Optional
 from operator import itemgetter
-from collections import namedtuple
+from collections import namedtuple, deque
 
-from twisted.internet import defer
+from twisted.internet import defer, reactor
 
 from torba import baseaccount
 from torba import basenetwork
 from torba import basetransaction
-from torba.basedatabase import BaseDatabase
+from torba.basedatabase import BaseDatabase, TransactionWrite, hash_history, history_to_status
 from torba.baseheader import BaseHeaders
 from torba.coinselection import CoinSelector
 from torba.constants import COIN, NULL_HASH32
 from torba.stream import StreamController
 from torba.hash import hash160, double_sha256, sha256, Base58
+from torba.util import LRUCache
+from torba.progress import SyncProgress
+from torba.mempool import MempoolTracker
 
 log = logging.getLogger(__name__)
 
@@ -44,6 +49,10 @@ class TransactionEvent(namedtuple('TransactionEvent', ('address', 'tx', 'height'
     pass
 
 
+class VerificationEvent(namedtuple('VerificationEvent', ('tx', 'height', 'is_verified'))):
+    pass
+
+
 class BlockHeightEvent(namedtuple('BlockHeightEvent', ('height', 'change'))):
     pass
 
@@ -67,6 +76,14 @@ class BaseLedger(metaclass=LedgerRegistry):
     extended_private_key_prefix: bytes
 
     default_fee_per_byte = 10
+    default_history_sync_window = 10
+    default_transaction_cache_size = 10000
+    default_sync_progress_interval = 1.0
+    default_write_batch_size = 100
+    default_write_batch_interval = 0.05
+    default_verification_batch_size = 100
+    default_max_verification_failures = 3
+    default_recovery_lookahead = 0
 
     def __init__(self, config=None):
         self.config = config or {}
@@ -79,8 +96,36 @@ class BaseLedger(metaclass=LedgerRegistry):
         self.network = self.config.get('network') or self.network_class(self)
         self.network.on_header.listen(self.receive_header)
         self.network.on_status.listen(self.receive_status)
+        self.network.on_scripthash_status.listen(self.receive_scripthash_status)
         self.accounts = []
         self.fee_per_byte: int = self.config.get('fee_per_byte', self.default_fee_per_byte)
+        self.history_sync_window: int = self.config.get(
+            'history_sync_window', self.default_history_sync_window
+        )
+        # parsed transactions shared by all code paths, they must not be modified
+        self.transaction_cache: LRUCache[basetransaction.BaseTransaction] = LRUCache(
+            self.config.get('transaction_cache_size', self.default_transaction_cache_size)
+        )
+        # synced transactions are written in batches, flushed when `write_batch_size`
+        # of them are waiting or `write_batch_interval` seconds after the first one
+        self.write_batch_size: int = self.config.get('write_batch_size', self.default_write_batch_size)
+        self.write_batch_interval: float = self.config.get(
+            'write_batch_interval', self.default_write_batch_interval
+        )
+        self.verification_batch_size: int = self.config.get(
+            'verification_batch_size', self.default_verification_batch_size
+        )
+        # transactions whose merkle proof didn't match this many times are no longer
+        # verified, until they are confirmed in another block
+        self.max_verification_failures: int = self.config.get(
+            'max_verification_failures', self.default_max_verification_failures
+        )
+        # when above zero, accounts which used up their address gap are recovered
+        # by checking this many addresses ahead at a time, see discover_addresses()
+        self.recovery_lookahead: int = self.config.get('recovery_lookahead', self.default_recovery_lookahead)
+        self.use_scripthash: bool = self.config.get('use_scripthash', False)
+        self._scripthash_to_address: Dict[str, str] = {}
+        self._address_to_scripthash: Dict[str, str] = {}
 
         self._on_transaction_controller = StreamController()
         self.on_transaction = self._on_transaction_controller.stream
@@ -91,6 +136,9 @@ class BaseLedger(metaclass=LedgerRegistry):
             )
         )
 
+        self._on_transaction_verified_controller = StreamController()
+        self.on_transaction_verified = self._on_transaction_verified_controller.stream
+
         self._on_header_controller = StreamController()
         self.on_header = self._on_header_controller.stream
         self.on_header.listen(
@@ -100,7 +148,25 @@ class BaseLedger(metaclass=LedgerRegistry):
             )
         )
 
-        self._transaction_processing_locks = {}
+        self.sync_progress = SyncProgress()
+        self.sync_progress_interval = self.config.get(
+            'sync_progress_interval', self.default_sync_progress_interval
+        )
+        self._sync_progress_reported = None
+        self._on_sync_progress_controller = StreamController()
+        self.on_sync_progress = self._on_sync_progress_controller.stream
+
+        self.mempool = MempoolTracker()
+        self._promotion_scheduled = False
+
+        self._reconnect_subscription = None
+        self._verification_batch = []
+        self._verification_queue = []
+        self._verifier_running = False
+        self._write_batch = []
+        self._write_flush_call = None
+        self._statuses: Dict[str, Optional[str]] = {}
+        self._status_hashes: Dict[str, Tuple[int, Any]] = {}
         self._utxo_reservation_lock = defer.DeferredLock()
         self._header_processing_lock = defer.DeferredLock()
 
@@ -117,6 +183,11 @@ class BaseLedger(metaclass=LedgerRegistry):
     def address_to_hash160(address):
         return Base58.decode(address)[1:21]
 
+    @classmethod
+    def hash160_to_scripthash(cls, h160):
+        script = cls.transaction_class.output_class.script_class.pay_pubkey_hash(h160)
+        return hexlify(sha256(script.source)[::-1]).decode()
+
     @classmethod
     def public_key_to_address(cls, public_key):
         return cls.hash160_to_address(hash160(public_key))
@@ -135,11 +206,24 @@ class BaseLedger(metaclass=LedgerRegistry):
         if self.network.is_connected:
             yield self.update_account(account)
 
+    def parse_transaction(self, raw, txid=None):
+        """ Parses a stored transaction, reusing the cached instance when available. """
+        if txid is not None:
+            tx = self.transaction_cache.get(txid)
+            if tx is not None:
+                return tx
+        tx = self.transaction_class(raw)
+        self.transaction_cache.set(tx.id, tx)
+        return tx
+
     @defer.inlineCallbacks
     def get_transaction(self, txhash):
+        tx = self.transaction_cache.get(txhash)
+        if tx is not None:
+            defer.returnValue(tx)
         raw, _, _ = yield self.db.get_transaction(txhash)
         if raw is not None:
-            defer.returnValue(self.transaction_class(raw))
+            defer.returnValue(self.parse_transaction(raw))
 
     @defer.inlineCallbacks
     def get_private_key_for_address(self, address):
@@ -183,24 +267,62 @@ class BaseLedger(metaclass=LedgerRegistry):
     def release_outputs(self, txos):
         return self.db.release_outputs(txos)
 
+    @staticmethod
+    def get_status_from_history(history):
+        return history_to_status(history)
+
+    def _extend_status_hash(self, address, position, history, full_history):
+        """ Returns the (length, hasher) status hash state of the address after its
+            history is replaced starting at `position`, appending to a history only
+            hashes the new entries. """
+        length, hasher = self._status_hashes.get(address, (None, None))
+        if length != position:
+            hasher = hash_history(hashlib.sha256(), full_history[:position])
+        else:
+            hasher = hasher.copy()
+        hash_history(hasher, history)
+        return position + len(history), hasher
+
+    @staticmethod
+    def _get_status_from_hash(status_hash):
+        length, hasher = status_hash
+        return hasher.hexdigest() if length else None
+
+    def _set_local_status(self, address, status, status_hash):
+        self._statuses[address] = status
+        self._status_hashes[address] = status_hash
+
     @defer.inlineCallbacks
     def get_local_status(self, address):
-        address_details = yield self.db.get_address(address)
-        history = address_details['history'] or ''
-        h = sha256(history.encode())
-        defer.returnValue(hexlify(h))
+        if address not in self._statuses:
+            address_details = yield self.db.get_address(address)
+            self._statuses[address] = address_details['status']
+        defer.returnValue(self._statuses[address])
+
+    def _remember_scripthash(self, address, scripthash):
+        self._address_to_scripthash[address] = scripthash
+        self._scripthash_to_address[scripthash] = address
+
+    def get_scripthash(self, address):
+        scripthash = self._address_to_scripthash.get(address)
+        if scripthash is None:
+            scripthash = self.hash160_to_scripthash(self.address_to_hash160(address))
+            self._remember_scripthash(address, scripthash)
+        return scripthash
 
-    @defer.inlineCallbacks
     def get_local_history(self, address):
-        address_details = yield self.db.get_address(address)
-        history = address_details['history'] or ''
-        parts = history.split(':')[:-1]
-        defer.returnValue(list(zip(parts[0::2], map(int, parts[1::2]))))
+        return self.db.get_address_history(address)
+
+    @staticmethod
+    def serialize_merkle_branch(branches):
+        """ Packs hex encoded merkle branches as returned by the server into
+            concatenated 32 byte hashes in internal byte order. """
+        return b''.join(unhexlify(branch)[::-1] for branch in branches)
 
     @staticmethod
-    def get_root_of_merkle_tree(branches, branch_positions, working_branch):
-        for i, branch in enumerate(branches):
-            other_branch = unhexlify(branch)[::-1]
+    def get_merkle_root_from_proof(branch, branch_positions, working_branch):
+        for i in range(len(branch) // 32):
+            other_branch = branch[i*32:(i+1)*32]
             other_branch_on_left = bool((branch_positions >> i) & 1)
             if other_branch_on_left:
                 combined = other_branch + working_branch
@@ -209,13 +331,164 @@ class BaseLedger(metaclass=LedgerRegistry):
             working_branch = double_sha256(combined)
         return hexlify(working_branch[::-1])
 
-    @defer.inlineCallbacks
+    @classmethod
+    def get_root_of_merkle_tree(cls, branches, branch_positions, working_branch):
+        return cls.get_merkle_root_from_proof(
+            cls.serialize_merkle_branch(branches), branch_positions, working_branch
+        )
+
     def is_valid_transaction(self, tx, height):
-        height <= len(self.headers) or defer.returnValue(False)
-        merkle = yield self.network.get_merkle(tx.id, height)
-        merkle_root = self.get_root_of_merkle_tree(merkle['merkle'], merkle['pos'], tx.hash)
-        header = self.headers[height]
-        defer.returnValue(merkle_root == header['merkle_root'])
+        return self.verify_transaction(tx, height).addCallback(itemgetter(0))
+
+    def verify_transaction(self, tx, height):
+        """ Queues the transaction for verification, all of the transactions queued
+            during the same reactor iteration are verified together as one batch.
+            Result is an (is_verified, merkle_proof) tuple. """
+        finished = defer.Deferred()
+        self._verification_batch.append((tx, height, finished))
+        if len(self._verification_batch) == 1:
+            reactor.callLater(0, self._verify_batch)
+        return finished
+
+    @defer.inlineCallbacks
+    def _verify_batch(self):
+        batch, self._verification_batch = self._verification_batch, []
+        try:
+            results = yield self.verify_transactions([(tx, height) for tx, height, _ in batch])
+        except Exception as e:  # pylint: disable=broad-except
+            for _, _, finished in batch:
+                finished.errback(e)
+        else:
+            for (_, _, finished), result in zip(batch, results):
+                finished.callback(result)
+
+    @defer.inlineCallbacks
+    def verify_transactions(self, txs):
+        """ Verifies (tx, height) pairs against the header store. Merkle proofs
+            stored in the database are checked without using the network, the
+            remaining proofs are requested from the server in one batch. Returns
+            an (is_verified, merkle_proof) tuple for each pair, fails when the
+            proofs couldn't be requested, none of the pairs were checked then. """
+        results = [(False, None)] * len(txs)
+        merkle_roots = {}
+
+        def check(tx, height, proof):
+            if height not in merkle_roots:
+                merkle_roots[height] = self.headers[height]['merkle_root']
+            return self.get_merkle_root_from_proof(proof[0], proof[1], tx.hash) == merkle_roots[height]
+
+        verifiable = [
+            (i, tx, height) for i, (tx, height) in enumerate(txs)
+            if 0 < height <= self.headers.height
+        ]
+        stored_proofs = yield self.db.get_merkle_proofs([tx.id for _, tx, _ in verifiable])
+
+        unproven = []
+        for i, tx, height in verifiable:
+            proof = stored_proofs.get(tx.id)
+            if proof is not None and check(tx, height, proof):
+                results[i] = (True, proof)
+            else:
+                unproven.append((i, tx, height))
+
+        if unproven:
+            responses = yield self.network.get_merkles([(tx.id, height) for _, tx, height in unproven])
+            for (i, tx, height), response in zip(unproven, responses):
+                proof = (self.serialize_merkle_branch(response['merkle']), response['pos'])
+                if check(tx, height, proof):
+                    results[i] = (True, proof)
+
+        defer.returnValue(results)
+
+    @defer.inlineCallbacks
+    def load_mempool(self):
+        for txid, raw in (yield self.db.get_unconfirmed_transactions()):
+            self.mempool.add(self.parse_transaction(raw, txid))
+
+    def promote_transaction(self, txid, height):
+        """ Queues an unconfirmed transaction from the mempool tracker for promotion,
+            all of the transactions confirmed by headers we already have are promoted
+            together on the next reactor iteration, the rest when their header arrives.
+            Result is a (tx, is_verified, merkle_proof) tuple. """
+        finished = self.mempool.confirm(txid, height)
+        if height <= self.headers.height and not self._promotion_scheduled:
+            self._promotion_scheduled = True
+            reactor.callLater(0, self._promote_confirmed)
+        return finished
+
+    @defer.inlineCallbacks
+    def _promote_confirmed(self):
+        self._promotion_scheduled = False
+        ready = self.mempool.pop_confirmed(self.headers.height)
+        if not ready:
+            return
+        try:
+            yield self.db.confirm_transactions([(tx.id, height, 0, None) for tx, height, _ in ready])
+        except Exception as e:  # pylint: disable=broad-except
+            for tx, _, waiting in ready:
+                self.mempool.add(tx)
+                for finished in waiting:
+                    finished.errback(e)
+        else:
+            for tx, height, waiting in ready:
+                self.queue_verification(tx, height)
+                for finished in waiting:
+                    finished.callback((tx, 0, None))
+
+    @defer.inlineCallbacks
+    def load_unverified(self):
+        for txid, raw, height in (yield self.db.get_unverified_transactions(self.max_verification_failures)):
+            self.queue_verification(self.parse_transaction(raw, txid), height)
+
+    def queue_verification(self, tx, height):
+        """ Queues a confirmed transaction for merkle verification in the background,
+            the most recently confirmed transactions are verified first. """
+        heapq.heappush(self._verification_queue, (-height, tx.id, tx))
+        self._start_verifier()
+
+    def _start_verifier(self):
+        if self._verification_queue and not self._verifier_running:
+            self._verifier_running = True
+            reactor.callLater(0, self._run_verifier)
+
+    @defer.inlineCallbacks
+    def _run_verifier(self):
+        try:
+            while True:
+                batch, waiting = [], []
+                while self._verification_queue and len(batch) < self.verification_batch_size:
+                    item = heapq.heappop(self._verification_queue)
+                    (batch if -item[0] <= self.headers.height else waiting).append(item)
+                for item in waiting:
+                    # verified once their headers arrive
+                    heapq.heappush(self._verification_queue, item)
+                if not batch:
+                    return
+                try:
+                    failures = yield self.db.get_verification_failures([txid for _, txid, _ in batch])
+                    # transactions deleted since they were queued are dropped as well
+                    batch = [
+                        item for item in batch
+                        if item[1] in failures and failures[item[1]] < self.max_verification_failures
+                    ]
+                    results = yield self.verify_transactions([(tx, -height) for height, _, tx in batch])
+                    yield self.db.set_verified([
+                        (txid, 1 if is_verified else 0, merkle_proof)
+                        for (_, txid, _), (is_verified, merkle_proof) in zip(batch, results)
+                    ])
+                except Exception:  # pylint: disable=broad-except
+                    log.exception('%s: failed to verify %s transactions:', self.get_id(), len(batch))
+                    for item in batch:
+                        heapq.heappush(self._verification_queue, item)
+                    return
+                for (height, _, tx), (is_verified, _) in zip(batch, results):
+                    if is_verified:
+                        self.sync_progress.transaction_verified(tx.id)
+                    self._on_transaction_verified_controller.add(
+                        VerificationEvent(tx, -height, 1 if is_verified else 0)
+                    )
+        finally:
+            self._verifier_running = False
 
     @defer.inlineCallbacks
     def start(self):
@@ -225,19 +498,64 @@ class BaseLedger(metaclass=LedgerRegistry):
             self.db.open(),
             self.headers.open()
         ])
+        self.sync_progress.set_headers_height(self.headers.height)
+        yield self.load_mempool()
+        yield self.load_unverified()
         first_connection = self.network.on_connected.first
         self.network.start()
         yield first_connection
         yield self.update_headers()
-        yield self.network.subscribe_headers()
+        yield self.subscribe_headers()
         yield self.update_accounts()
+        self._reconnect_subscription = self.network.on_connected.listen(self.receive_reconnect)
 
     @defer.inlineCallbacks
     def stop(self):
+        if self._reconnect_subscription is not None:
+            self._reconnect_subscription.cancel()
+            self._reconnect_subscription = None
         yield self.network.stop()
+        yield self.flush_writes()
         yield self.db.close()
         yield self.headers.close()
 
+    @defer.inlineCallbacks
+    def rewind_blockchain(self, above_height):
+        self.transaction_cache.clear()
+        yield self.flush_writes()
+        self._verification_queue = [item for item in self._verification_queue if -item[0] <= above_height]
+        heapq.heapify(self._verification_queue)
+        addresses, orphaned = yield self.db.rewind_blockchain(above_height)
+        for address in addresses:
+            # truncated histories no longer match the cached status hashes
+            self._statuses.pop(address, None)
+            self._status_hashes.pop(address, None)
+        if addresses:
+            log.info(
+                "Rewound %s addresses above height %s, syncing them again.", len(addresses), above_height
+            )
+        # not waiting for the syncs, update_headers runs under the header lock
+        # and the syncs need new headers to verify the re-mined transactions
+        syncs = defer.DeferredList(
+            [self.update_history(address) for address in addresses], consumeErrors=True
+        )
+        if orphaned:
+            # orphaned transactions which the synced histories no longer include were dropped
+            syncs.addCallback(lambda _: self._delete_orphaned_transactions(orphaned))
+        defer.returnValue(addresses)
+
+    @defer.inlineCallbacks
+    def _delete_orphaned_transactions(self, txids):
+        try:
+            deleted = yield self.db.delete_unreferenced_transactions(txids)
+        except Exception:  # pylint: disable=broad-except
+            log.exception('Failed to delete orphaned transactions:')
+        else:
+            for txid in deleted:
+                self.mempool.discard(txid)
+            if deleted:
+                log.info("Deleted %s orphaned transactions which weren't mined again.", len(deleted))
+
     @defer.inlineCallbacks
     def update_headers(self, height=None, headers=None, subscription_update=False):
         rewound = 0
@@ -260,15 +578,21 @@ class BaseLedger(metaclass=LedgerRegistry):
 
             added = yield self.headers.connect(height, unhexlify(headers))
             if added > 0:
+                connected_at = height
                 height += added
                 self._on_header_controller.add(
                     BlockHeightEvent(self.headers.height, added))
+                self.sync_progress.set_headers_height(self.headers.height)
+                self._report_sync_progress(force=self.sync_progress.headers_synced)
+                self._promote_confirmed()
+                self._start_verifier()
+                yield self.db.settle_balances(self.headers.height)
 
                 if rewound > 0:
                     # we started rewinding blocks and apparently found
                     # a new chain
                     rewound = 0
-                    yield self.db.rewind_blockchain(height)
+                    yield self.rewind_blockchain(connected_at - 1)
 
                 if subscription_update:
                     # subscription updates are for latest header already
@@ -315,12 +639,28 @@ class BaseLedger(metaclass=LedgerRegistry):
         yield self._header_processing_lock.acquire()
         try:
             header = response[0]
+            self.sync_progress.set_headers_target(header['height'])
             yield self.update_headers(
                 height=header['height'], headers=header['hex'], subscription_update=True
             )
         finally:
             self._header_processing_lock.release()
 
+    @defer.inlineCallbacks
+    def subscribe_headers(self):
+        header = yield self.network.subscribe_headers()
+        if isinstance(header, dict) and 'height' in header:
+            self.sync_progress.set_headers_target(header['height'])
+            self._report_sync_progress(force=True)
+        defer.returnValue(header)
+
+    def _report_sync_progress(self, force=False):
+        now = self.sync_progress.clock()
+        last = self._sync_progress_reported
+        if force or last is None or now - last >= self.sync_progress_interval:
+            self._sync_progress_reported = now
+            self._on_sync_progress_controller.add(self.sync_progress.get_event())
+
     def update_accounts(self):
         return defer.DeferredList([
             self.update_account(a) for a in self.accounts
@@ -332,27 +672,60 @@ class BaseLedger(metaclass=LedgerRegistry):
         # this avoids situation where we're getting status updates to addresses we know
         # need to update anyways. Continue to get history and create more addresses until
         # all missing addresses are created and history for them is fully restored.
+        yield account.load()
         yield account.ensure_address_gap()
         addresses = yield account.get_addresses(max_used_times=0)
         while addresses:
             yield defer.DeferredList([
                 self.update_history(a) for a in addresses
             ])
+            if self.recovery_lookahead > 0:
+                yield account.discover_addresses(self.recovery_lookahead)
             addresses = yield account.ensure_address_gap()
 
         # By this point all of the addresses should be restored and we
         # can now subscribe all of them to receive updates.
-        all_addresses = yield account.get_addresses()
-        yield defer.DeferredList(
-            list(map(self.subscribe_history, all_addresses))
-        )
+        yield self.subscribe_account(account)
+
+    def get_remote_history(self, address):
+        if self.use_scripthash:
+            return self.network.get_history_by_scripthash(self.get_scripthash(address))
+        return self.network.get_history(address)
+
+    def get_remote_histories(self, addresses):
+        if self.use_scripthash:
+            return self.network.get_histories_by_scripthash([self.get_scripthash(a) for a in addresses])
+        return self.network.get_histories(addresses)
+
+    def subscribe_address(self, address):
+        if self.use_scripthash:
+            return self.network.subscribe_scripthash(self.get_scripthash(address))
+        return self.network.subscribe_address(address)
+
+    def subscribe_addresses(self, addresses):
+        if self.use_scripthash:
+            return self.network.subscribe_scripthashes(list(map(self.get_scripthash, addresses)))
+        return self.network.subscribe_addresses(addresses)
 
     @defer.inlineCallbacks
-    def update_history(self, address):
-        remote_history = yield self.network.get_history(address)
+    def update_history(self, address, remote_history=None):
+        self.sync_progress.address_started()
+        self._report_sync_progress()
+        try:
+            yield self._update_history(address, remote_history)
+        finally:
+            self.sync_progress.address_finished()
+            self._report_sync_progress(force=self.sync_progress.history_synced)
+
+    @defer.inlineCallbacks
+    def _update_history(self, address, remote_history=None):
+        if remote_history is None:
+            remote_history = yield self.get_remote_history(address)
         local_history = yield self.get_local_history(address)
+        address_hash160 = self.address_to_hash160(address)
 
         synced_history = []
+        missing = []
         for i, (hex_id, remote_height) in enumerate(map(itemgetter('tx_hash', 'height'), remote_history)):
 
             synced_history.append((hex_id, remote_height))
@@ -360,62 +733,346 @@ class BaseLedger(metaclass=LedgerRegistry):
             if i < len(local_history) and local_history[i] == (hex_id, remote_height):
                 continue
 
-            lock = self._transaction_processing_locks.setdefault(hex_id, defer.DeferredLock())
+            missing.append((hex_id, remote_height, i))
+
+        # Local history is kept up to the first difference from the remote history,
+        # after that it's rewritten as each of the missing transactions is saved.
+        saved_length = missing[0][2] if missing else len(synced_history)
+        self.sync_progress.transactions_queued(len(missing))
+
+        # Transactions are downloaded and verified concurrently, up to `history_sync_window`
+        # ahead of the transaction being saved, but they are always saved in history order.
+        # Unconfirmed transactions this address already saved only need to be promoted.
+        local_unconfirmed = {hex_id for hex_id, height in local_history if height <= 0}
+        to_fetch = iter(missing)
+        in_flight: Deque = deque()
+
+        def fetch_more():
+            while len(in_flight) < self.history_sync_window:
+                item = next(to_fetch, None)
+                if item is None:
+                    break
+                hex_id, remote_height, _ = item
+                if remote_height > 0 and hex_id in local_unconfirmed and hex_id in self.mempool:
+                    in_flight.append((item, self.promote_transaction(hex_id, remote_height), True))
+                else:
+                    in_flight.append((item, self._fetch_transaction(hex_id, remote_height), False))
 
-            yield lock.acquire()
+        # saves are queued without waiting for them, they are written in order
+        pending_writes = []
+        fetch_more()
+        try:
+            while in_flight:
+                (hex_id, remote_height, position), fetching, promoted = in_flight.popleft()
+                tx, is_verified, merkle_proof = yield fetching
+                self.sync_progress.transaction_fetched(tx.id, is_verified)
+                self._report_sync_progress()
+                fetch_more()
+                history = synced_history[saved_length:position+1]
+                status_hash = self._extend_status_hash(address, saved_length, history, synced_history)
+                status = self._get_status_from_hash(status_hash)
+                if promoted:
+                    # inputs and outputs were saved while it was unconfirmed
+                    saving = self._save_history(address, saved_length, history, status)
+                    saving.addCallback(
+                        lambda _, tx=tx, height=remote_height, is_verified=is_verified:
+                        self._on_transaction_controller.add(
+                            TransactionEvent(address, tx, height, is_verified)
+                        )
+                    )
+                    pending_writes.append(saving)
+                else:
+                    pending_writes.append(self._save_transaction(
+                        address, address_hash160, tx, remote_height, is_verified,
+                        saved_length, history, status, merkle_proof
+                    ))
+                self._set_local_status(address, status, status_hash)
+                saved_length = position + 1
+            if saved_length < len(synced_history) or len(local_history) > len(synced_history):
+                # entries after the last missing transaction matched the old local history but
+                # were truncated along with it, also drops entries no longer on the server
+                history = synced_history[saved_length:]
+                status_hash = self._extend_status_hash(address, saved_length, history, synced_history)
+                status = self._get_status_from_hash(status_hash)
+                pending_writes.append(self._save_history(address, saved_length, history, status))
+                self._set_local_status(address, status, status_hash)
+            yield defer.gatherResults(pending_writes, consumeErrors=True)
+        except Exception:
+            for _, fetching, _ in in_flight:
+                fetching.addErrback(lambda _: None)
+            for writing in pending_writes:
+                writing.addErrback(lambda _: None)
+            # statuses were updated ahead of the writes, reload them from the database
+            self._statuses.pop(address, None)
+            self._status_hashes.pop(address, None)
+            log.exception('Failed to synchronize transaction:')
+            raise
 
-            try:
+    @defer.inlineCallbacks
+    def _fetch_transaction(self, hex_id, remote_height):
+        # see if we have a local copy of transaction, otherwise fetch it from server
+        raw, _, is_verified = yield self.db.get_transaction(hex_id)
+        if raw is None:
+            _raw = yield self.network.get_transaction(hex_id)
+            tx = self.transaction_class(unhexlify(_raw))
+        else:
+            tx = self.parse_transaction(raw, hex_id)
+
+        # confirmed transactions are verified in the background after they are saved
+        defer.returnValue((tx, is_verified or 0, None))
+
+    def _queue_write(self, write: TransactionWrite):
+        finished = defer.Deferred()
+        self._write_batch.append((write, finished))
+        if len(self._write_batch) >= self.write_batch_size:
+            self.flush_writes()
+        elif self._write_flush_call is None:
+            self._write_flush_call = reactor.callLater(self.write_batch_interval, self.flush_writes)
+        return finished
+
+    def flush_writes(self):
+        """ Writes all of the queued saves as one database transaction. """
+        if self._write_flush_call is not None:
+            if self._write_flush_call.active():
+                self._write_flush_call.cancel()
+            self._write_flush_call = None
+        batch, self._write_batch = self._write_batch, []
+        if not batch:
+            return defer.succeed(None)
+
+        def written(results):
+            for (_, finished), result in zip(batch, results):
+                finished.callback(result)
+
+        def failed(failure):
+            for _, finished in batch:
+                finished.errback(failure)
+
+        return self.db.save_transactions_io([write for write, _ in batch]).addCallbacks(written, failed)
+
+    def _save_history(self, address, position, history, status):
+        return self._queue_write(TransactionWrite(
+            None, None, None, address, None, position, history, status, None
+        ))
 
-                # see if we have a local copy of transaction, otherwise fetch it from server
-                raw, _, is_verified = yield self.db.get_transaction(hex_id)
-                save_tx = None
-                if raw is None:
-                    _raw = yield self.network.get_transaction(hex_id)
-                    tx = self.transaction_class(unhexlify(_raw))
-                    save_tx = 'insert'
-                else:
-                    tx = self.transaction_class(raw)
+    @defer.inlineCallbacks
+    def _save_transaction(self, address, address_hash160, tx, remote_height, is_verified,
+                          history_position, history, status, merkle_proof=None):
+        # whether the transaction is inserted, updated or was already saved by another
+        # address is decided when the batch is written
+        save_tx, is_verified = yield self._queue_write(TransactionWrite(
+            tx, remote_height, is_verified, address, address_hash160,
+            history_position, history, status, merkle_proof
+        ))
+        if save_tx == 'insert':
+            self.transaction_cache.set(tx.id, tx)
+        if remote_height > 0:
+            self.mempool.discard(tx.id)
+            if not is_verified:
+                self.queue_verification(tx, remote_height)
+        else:
+            self.mempool.add(tx)
+
+        if save_tx == 'insert':
+            self._detect_payments(tx, address_hash160)
+
+        log.debug(
+            "%s: sync'ed tx %s for address: %s, height: %s, verified: %s",
+            self.get_id(), tx.id, address, remote_height, is_verified
+        )
 
-                if remote_height > 0 and not is_verified:
-                    is_verified = yield self.is_valid_transaction(tx, remote_height)
-                    is_verified = 1 if is_verified else 0
-                    if save_tx is None:
-                        save_tx = 'update'
+        self._on_transaction_controller.add(TransactionEvent(address, tx, remote_height, is_verified))
 
-                yield self.db.save_transaction_io(
-                    save_tx, tx, remote_height, is_verified, address, self.address_to_hash160(address),
-                    ''.join('{}:{}:'.format(tx_id, tx_height) for tx_id, tx_height in synced_history)
-                )
+    @defer.inlineCallbacks
+    def subscribe_history(self, address):
+        remote_status = yield self.subscribe_address(address)
+        local_status = yield self.get_local_status(address)
+        if local_status != remote_status:
+            yield self._sync_address(address, remote_status)
 
-                log.debug(
-                    "%s: sync'ed tx %s for address: %s, height: %s, verified: %s",
-                    self.get_id(), hex_id, address, remote_height, is_verified
-                )
+    @defer.inlineCallbacks
+    def subscribe_account(self, account):
+        """ Subscribes all addresses of the account using batched requests and
+            synchronizes only the addresses whose status differs from ours. """
+        starts = yield account.get_subscription_starts()
+        records = yield self.db.get_address_statuses(account, starts)
+        local_statuses, snapshots = {}, {}
+        for address, scripthash, status, remote_status in records:
+            self._remember_scripthash(address, scripthash)
+            self._statuses[address] = local_statuses[address] = status
+            snapshots[address] = remote_status
+        yield self._subscribe_and_sync(local_statuses, snapshots)
 
-                self._on_transaction_controller.add(TransactionEvent(address, tx, remote_height, is_verified))
+    @defer.inlineCallbacks
+    def resubscribe_account(self, account):
+        """ Like subscribe_account() but compares the new server statuses against
+            the statuses persisted before the connection was lost, which avoids
+            loading and hashing the history of every address. """
+        starts = yield account.get_subscription_starts()
+        records = yield self.db.get_address_statuses(account, starts)
+        snapshots = {}
+        for address, scripthash, _, remote_status in records:
+            self._remember_scripthash(address, scripthash)
+            snapshots[address] = remote_status
+        yield self._subscribe_and_sync(snapshots, snapshots)
 
-            except Exception:
-                log.exception('Failed to synchronize transaction:')
-                raise
+    @defer.inlineCallbacks
+    def _subscribe_and_sync(self, expected_statuses, snapshots):
+        addresses = list(expected_statuses)
+        remote_statuses = yield self.subscribe_addresses(addresses)
+        changed, unchanged = [], []
+        for address, remote_status in zip(addresses, remote_statuses):
+            if expected_statuses[address] != remote_status:
+                changed.append((address, remote_status))
+            elif snapshots[address] != remote_status:
+                unchanged.append((address, remote_status))
+        if unchanged:
+            yield self.db.set_remote_statuses(unchanged)
+        yield defer.DeferredList([
+            self._sync_address(address, remote_status)
+            for address, remote_status in changed
+        ])
 
-            finally:
-                lock.release()
-                if not lock.locked and hex_id in self._transaction_processing_locks:
-                    del self._transaction_processing_locks[hex_id]
+    @defer.inlineCallbacks
+    def _sync_address(self, address, remote_status):
+        yield self.update_history(address)
+        yield self.db.set_remote_statuses([(address, remote_status)])
+        if any(m.window is not None for a in self.accounts for m in a.address_managers):
+            yield self._slide_window(address)
 
     @defer.inlineCallbacks
-    def subscribe_history(self, address):
-        remote_status = yield self.network.subscribe_address(address)
-        local_status = yield self.get_local_status(address)
-        if local_status != remote_status:
-            yield self.update_history(address)
+    def _slide_window(self, address):
+        """ Moves the subscription window of the chain the address belongs to once its
+            last addresses get used: new addresses are subscribed and the ones which fell
+            out of the window are forgotten. """
+        details = yield self.db.get_address(address)
+        manager = self._get_window_manager(details)
+        if manager is None:
+            return
+        start = yield manager.get_subscription_start()
+        new_addresses = yield manager.ensure_address_gap()
+        if not new_addresses:
+            return
+        new_start = yield manager.get_subscription_start()
+        for position in range(start, new_start):
+            retired = manager.public_key.child(position).address
+            self._statuses.pop(retired, None)
+            self._status_hashes.pop(retired, None)
+        statuses = {a: None for a in new_addresses}
+        yield self._subscribe_and_sync(statuses, statuses)
+
+    def _get_window_manager(self, details):
+        """ Address manager with a subscription window of the chain an address record belongs to. """
+        if details is None:
+            return None
+        for account in self.accounts:
+            if account.public_key.address != details['account']:
+                continue
+            for manager in account.address_managers:
+                if manager.window is not None and manager.chain_number == details['chain']:
+                    return manager
+        return None
+
+    @defer.inlineCallbacks
+    def _is_retired(self, address):
+        """ Whether the address slid out of the subscription window of its chain. """
+        details = yield self.db.get_address(address)
+        manager = self._get_window_manager(details)
+        if manager is None:
+            defer.returnValue(False)
+        start = yield manager.get_subscription_start()
+        defer.returnValue(details['position'] < start)
+
+    @defer.inlineCallbacks
+    def scan_retired_addresses(self, account, batch_size=1000):
+        """ Catches up on payments to the addresses which slid out of the subscription windows
+            of the account, the server doesn't report them. Their histories are requested in
+            batches of `batch_size` addresses and the ones which changed are synchronized.
+            Meant to be called periodically or on demand, returns the synchronized addresses. """
+        synced = []
+
+        @defer.inlineCallbacks
+        def scan_page(records):
+            histories = yield self.get_remote_histories([record['address'] for record in records])
+            changed = []
+            for record, history in zip(records, histories):
+                status = self.get_status_from_history([(h['tx_hash'], h['height']) for h in history])
+                if status != record['status']:
+                    changed.append(self._sync_unsubscribed(record['address'], history))
+                    synced.append(record['address'])
+            yield defer.DeferredList(changed)
+
+        starts = yield account.get_subscription_starts()
+        for chain, start in starts.items():
+            yield self.db.iterate_pages(
+                self.db.get_addresses_page, scan_page, account, chain, limit=batch_size, before_position=start
+            )
+        defer.returnValue(synced)
+
+    def _detect_payments(self, tx, address_hash160):
+        """ Syncs derived addresses outside of the subscription windows which are paid
+            by a synchronized transaction. A transaction which pays none of the subscribed
+            addresses is only found by scan_retired_addresses(). """
+        for txo in tx.outputs:
+            if not txo.script.is_pay_pubkey_hash:
+                continue
+            hash160 = txo.script.values['pubkey_hash']
+            if hash160 == address_hash160:
+                continue
+            if any(m.might_own(hash160) for a in self.accounts for m in a.address_managers):
+                address = self.hash160_to_address(hash160)
+                if address not in self._statuses:
+                    self._sync_unsubscribed(address)
+
+    @defer.inlineCallbacks
+    def _sync_unsubscribed(self, address, remote_history=None):
+        try:
+            # filter matches can be false positives, only addresses we have keys for are synced
+            details = yield self.db.get_address(address)
+            if details is not None:
+                yield self.update_history(address, remote_history)
+        except Exception:  # pylint: disable=broad-except
+            log.exception('%s: failed to synchronize address %s:', self.get_id(), address)
+        finally:
+            # not subscribed, nothing keeps the cached status current
+            self._statuses.pop(address, None)
+            self._status_hashes.pop(address, None)
+
+    @defer.inlineCallbacks
+    def receive_reconnect(self, _):
+        log.info("%s: reconnected, resynchronizing headers and addresses", self.get_id())
+        yield self._header_processing_lock.acquire()
+        try:
+            yield self.update_headers()
+        finally:
+            self._header_processing_lock.release()
+        yield self.subscribe_headers()
+        # the new connection has no subscriptions, addresses which slid out of the
+        # windows won't get status updates anymore and their scripthashes are forgotten
+        self._scripthash_to_address.clear()
+        self._address_to_scripthash.clear()
+        yield defer.DeferredList([
+            self.resubscribe_account(a) for a in self.accounts
+        ])
 
     @defer.inlineCallbacks
     def receive_status(self, response):
         address, remote_status = response
+        if address not in self._statuses and (yield self._is_retired(address)):
+            # still subscribed on the server until the next reconnect, its status isn't cached again
+            yield self._sync_unsubscribed(address)
+            return
         local_status = yield self.get_local_status(address)
         if local_status != remote_status:
-            yield self.update_history(address)
+            yield self._sync_address(address, remote_status)
+
+    def receive_scripthash_status(self, response):
+        scripthash, remote_status = response
+        address = self._scripthash_to_address.get(scripthash)
+        if address is None:
+            log.warning("%s: status update for unknown scripthash %s", self.get_id(), scripthash)
+            return defer.succeed(None)
+        return self.receive_status((address, remote_status))
 
     def broadcast(self, tx):
         return self.network.broadcast(hexlify(tx.raw).decode())
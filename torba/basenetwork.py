@@ -69,6 +69,14 @@ class StratumClientProtocol(LineOnlyReceiver):
         except (ValueError, TypeError):
             raise ValueError("Cannot decode message '{}'".format(line.strip()))
 
+        if isinstance(message, list):
+            # response to a batch request
+            for item in message:
+                self.messageReceived(item)
+        else:
+            self.messageReceived(message)
+
+    def messageReceived(self, message):
         if message.get('id'):
             try:
                 d = self.lookup_table.pop(message['id'])
@@ -83,20 +91,33 @@ class StratumClientProtocol(LineOnlyReceiver):
             controller = self.network.subscription_controllers[message['method']]
             controller.add(message.get('params'))
         else:
-            log.warning("Cannot handle message '%s'", line)
+            log.warning("Cannot handle message '%s'", message)
 
-    def rpc(self, method, *args):
+    def _prepare_message(self, method, args):
         message_id = self._get_id()
-        message = json.dumps({
-            'id': message_id,
-            'method': method,
-            'params': args
-        })
+        d = self.lookup_table[message_id] = defer.Deferred()
+        return {'id': message_id, 'method': method, 'params': args}, d
+
+    def rpc(self, method, *args):
+        message, d = self._prepare_message(method, args)
+        message = json.dumps(message)
         log.debug('sent: %s', message)
         self.sendLine(message.encode('latin-1'))
-        d = self.lookup_table[message_id] = defer.Deferred()
         return d
 
+    def rpc_batch(self, method, args_list):
+        """ Sends one JSON-RPC batch request calling `method` once for each
+            entry in `args_list`, results are returned in the same order. """
+        messages, deferreds = [], []
+        for args in args_list:
+            message, d = self._prepare_message(method, args)
+            messages.append(message)
+            deferreds.append(d)
+        batch = json.dumps(messages)
+        log.debug('sent: %s', batch)
+        self.sendLine(batch.encode('latin-1'))
+        return defer.gatherResults(deferreds, consumeErrors=True)
+
 
 class StratumClientFactory(protocol.ClientFactory):
 
@@ -116,6 +137,8 @@ class StratumClientFactory(protocol.ClientFactory):
 
 class BaseNetwork:
 
+    subscription_batch_size = 500
+
     def __init__(self, ledger):
         self.config = ledger.config
         self.client = None
@@ -131,13 +154,18 @@ class BaseNetwork:
         self._on_status_controller = StreamController()
         self.on_status = self._on_status_controller.stream
 
+        self._on_scripthash_status_controller = StreamController()
+        self.on_scripthash_status = self._on_scripthash_status_controller.stream
+
         self.subscription_controllers = {
             'blockchain.headers.subscribe': self._on_header_controller,
             'blockchain.address.subscribe': self._on_status_controller,
+            'blockchain.scripthash.subscribe': self._on_scripthash_status_controller,
         }
 
     @defer.inlineCallbacks
     def start(self):
+        self.running = True
         for server in cycle(self.config['default_servers']):
             connection_string = 'tcp:{}:{}'.format(*server)
             endpoint = clientFromString(reactor, connection_string)
@@ -158,6 +186,9 @@ class BaseNetwork:
                 self.client = None
             if not self.running:
                 return
+            # stop the service before moving on, otherwise it will keep
+            # reconnecting to this server alongside the next one
+            self.service.stopService()
 
     def stop(self):
         self.running = False
@@ -178,6 +209,12 @@ class BaseNetwork:
         else:
             raise ConnectionError("Attempting to send rpc request when connection is not available.")
 
+    def rpc_batch(self, method, args_list):
+        if self.is_connected:
+            return self.client.rpc_batch(method, args_list)
+        else:
+            raise ConnectionError("Attempting to send rpc request when connection is not available.")
+
     def ensure_server_version(self, required='1.2'):
         return self.rpc('server.version', __version__, required)
 
@@ -187,12 +224,26 @@ class BaseNetwork:
     def get_history(self, address):
         return self.rpc('blockchain.address.get_history', address)
 
+    def get_history_by_scripthash(self, scripthash):
+        return self.rpc('blockchain.scripthash.get_history', scripthash)
+
+    def get_histories(self, addresses):
+        return self.rpc_batch('blockchain.address.get_history', [(address,) for address in addresses])
+
+    def get_histories_by_scripthash(self, scripthashes):
+        return self.rpc_batch(
+            'blockchain.scripthash.get_history', [(scripthash,) for scripthash in scripthashes]
+        )
+
     def get_transaction(self, tx_hash):
         return self.rpc('blockchain.transaction.get', tx_hash)
 
     def get_merkle(self, tx_hash, height):
         return self.rpc('blockchain.transaction.get_merkle', tx_hash, height)
 
+    def get_merkles(self, tx_hashes_and_heights):
+        return self.rpc_batch('blockchain.transaction.get_merkle', tx_hashes_and_heights)
+
     def get_headers(self, height, count=10000):
         return self.rpc('blockchain.block.headers', height, count)
 
@@ -201,3 +252,21 @@ class BaseNetwork:
 
     def subscribe_address(self, address):
         return self.rpc('blockchain.address.subscribe', address)
+
+    def subscribe_addresses(self, addresses):
+        return self._subscribe_batched('blockchain.address.subscribe', addresses)
+
+    def subscribe_scripthash(self, scripthash):
+        return self.rpc('blockchain.scripthash.subscribe', scripthash)
+
+    def subscribe_scripthashes(self, scripthashes):
+        return self._subscribe_batched('blockchain.scripthash.subscribe', scripthashes)
+
+    @defer.inlineCallbacks
+    def _subscribe_batched(self, method, keys):
+        batch_size = self.config.get('subscription_batch_size', self.subscription_batch_size)
+        statuses = []
+        for i in range(0, len(keys), batch_size):
+            batch = yield self.rpc_batch(method, [(key,) for key in keys[i:i+batch_size]])
+            statuses.extend(batch)
+        defer.returnValue(statuses)
@@ -0,0 +1,51 @@
+from typing import Dict, List, Tuple
+
+from twisted.internet import defer
+
+from torba.basetransaction import BaseTransaction
+
+
+class MempoolTracker:
+    """ Unconfirmed transactions of the ledger's addresses. Once the server reports
+        them confirmed they are queued for promotion and the ledger marks them as
+        confirmed in batches, without downloading, parsing or saving their raw data
+        again, and queues them for verification. """
+
+    def __init__(self):
+        self._unconfirmed: Dict[str, BaseTransaction] = {}
+        self._confirmed: Dict[str, Tuple[BaseTransaction, int, List[defer.Deferred]]] = {}
+
+    def __len__(self):
+        return len(self._unconfirmed)
+
+    def __contains__(self, txid):
+        return txid in self._unconfirmed
+
+    def add(self, tx: BaseTransaction):
+        self._unconfirmed[tx.id] = tx
+
+    def discard(self, txid):
+        self._unconfirmed.pop(txid, None)
+
+    def confirm(self, txid, height) -> defer.Deferred:
+        """ Queues the transaction for promotion at `height`, returned deferred fires
+            with a (tx, is_verified, merkle_proof) tuple once it's been promoted. """
+        finished = defer.Deferred()
+        if txid in self._confirmed:
+            tx, _, waiting = self._confirmed[txid]
+        else:
+            tx, waiting = self._unconfirmed[txid], []
+        waiting.append(finished)
+        self._confirmed[txid] = (tx, height, waiting)
+        return finished
+
+    def pop_confirmed(self, max_height) -> List[Tuple[BaseTransaction, int, List[defer.Deferred]]]:
+        """ Removes and returns the transactions confirmed at or below `max_height`,
+            the headers needed to verify them are available. """
+        ready = []
+        for txid, (tx, height, waiting) in list(self._confirmed.items()):
+            if height <= max_height:
+                del self._confirmed[txid]
+                self._unconfirmed.pop(txid, None)
+                ready.append((tx, height, waiting))
+        return ready
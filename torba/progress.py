@@ -0,0 +1,112 @@
+import time
+from collections import namedtuple
+
+
+class SyncProgressEvent(namedtuple('SyncProgressEvent', (
+        'headers_height', 'headers_target', 'headers_rate',
+        'addresses_synced', 'addresses_total',
+        'transactions_fetched', 'transactions_verified', 'transactions_total',
+        'eta'))):
+
+    @property
+    def is_synced(self):
+        headers_synced = self.headers_target is None or self.headers_height >= self.headers_target
+        return headers_synced and self.addresses_synced == self.addresses_total
+
+
+class SyncProgress:
+    """ Counts headers, addresses and transactions as the ledger synchronizes
+        and estimates how much time is left until it catches up. """
+
+    def __init__(self, clock=time.time):
+        self.clock = clock
+        self.headers_height = -1
+        self.headers_target = None
+        self.headers_rate = None
+        self._headers_started = None
+        self.addresses_synced = 0
+        self.addresses_total = 0
+        self.transactions_fetched = 0
+        self.transactions_verified = 0
+        self.transactions_total = 0
+        # transactions fetched this round which are waiting for verification
+        self._unverified = set()
+        self._history_started = None
+
+    @property
+    def headers_synced(self):
+        return self.headers_target is None or self.headers_height >= self.headers_target
+
+    @property
+    def history_synced(self):
+        return self.addresses_synced == self.addresses_total
+
+    def set_headers_target(self, height):
+        self.headers_target = max(height, self.headers_target or -1)
+
+    def set_headers_height(self, height):
+        now = self.clock()
+        if self._headers_started is None:
+            self._headers_started = (now, height)
+        started_at, started_height = self._headers_started
+        if now > started_at:
+            self.headers_rate = (height - started_height) / (now - started_at)
+        self.headers_height = height
+        if self.headers_target is not None and self.headers_synced:
+            self._headers_started = None
+
+    def address_started(self):
+        if self.history_synced:
+            # previous round of synchronization is done, start counting from scratch
+            self._history_started = self.clock()
+            self.addresses_synced = self.addresses_total = 0
+            self.transactions_fetched = self.transactions_verified = self.transactions_total = 0
+            self._unverified.clear()
+        self.addresses_total += 1
+
+    def address_finished(self):
+        self.addresses_synced += 1
+
+    def transactions_queued(self, count):
+        self.transactions_total += count
+
+    def transaction_fetched(self, txid, is_verified):
+        self.transactions_fetched += 1
+        if is_verified:
+            self.transactions_verified += 1
+        else:
+            self._unverified.add(txid)
+
+    def transaction_verified(self, txid):
+        # transactions of earlier rounds are verified in the background as well
+        if txid in self._unverified:
+            self._unverified.remove(txid)
+            self.transactions_verified += 1
+
+    @property
+    def eta(self):
+        """ Estimated seconds until fully synchronized, None when it can't be estimated yet. """
+        estimates = [0.0]
+        if not self.headers_synced:
+            if not self.headers_rate:
+                return None
+            estimates.append((self.headers_target - self.headers_height) / self.headers_rate)
+        if not self.history_synced:
+            elapsed = self.clock() - self._history_started
+            if elapsed <= 0 or not (self.addresses_synced or self.transactions_fetched):
+                return None
+            if self.addresses_synced:
+                remaining = self.addresses_total - self.addresses_synced
+                estimates.append(remaining * elapsed / self.addresses_synced)
+            if self.transactions_fetched:
+                remaining = self.transactions_total - self.transactions_fetched
+                estimates.append(remaining * elapsed / self.transactions_fetched)
+        return max(estimates)
+
+    def get_event(self):
+        return SyncProgressEvent(
+            self.headers_height, self.headers_target, self.headers_rate,
+            self.addresses_synced, self.addresses_total,
+            self.transactions_fetched, self.transactions_verified, self.transactions_total,
+            self.eta
+        )
@@ -1,5 +1,7 @@
+from math import ceil, log
 from binascii import unhexlify, hexlify
-from typing import TypeVar, Sequence, Optional
+from collections import OrderedDict
+from typing import TypeVar, Sequence, Optional, Generic, Hashable
 
 
 T = TypeVar('T')
@@ -17,6 +19,89 @@ class ReadOnlyList(Sequence[T]):
         return len(self.lst)
 
 
+class LRUCache(Generic[T]):
+    """ Size bounded mapping which evicts the least recently used item first. """
+
+    def __init__(self, capacity: int) -> None:
+        self.capacity = capacity
+        self.hits = 0
+        self.misses = 0
+        self._items: OrderedDict = OrderedDict()
+
+    def get(self, key: Hashable) -> Optional[T]:
+        value = self._items.get(key)
+        if value is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+            self._items.move_to_end(key)
+        return value
+
+    def set(self, key: Hashable, value: T) -> None:
+        self._items[key] = value
+        self._items.move_to_end(key)
+        while len(self._items) > self.capacity:
+            self._items.popitem(last=False)
+
+    def pop(self, key: Hashable) -> Optional[T]:
+        return self._items.pop(key, None)
+
+    def clear(self) -> None:
+        self._items.clear()
+
+    def __contains__(self, key) -> bool:
+        return key in self._items
+
+    def __len__(self) -> int:
+        return len(self._items)
+
+
+class BloomFilter:
+    """ Compact set of hashes which can only answer whether it might contain an item:
+        there are no false negatives and about `error_rate` false positives. Items must
+        be uniformly distributed hashes of at least 16 bytes (eg. hash160s), their bytes
+        are used as the bit positions. When `capacity` items have been added another,
+        twice as large, filter is started so that the error rate stays bounded. """
+
+    def __init__(self, capacity: int = 10000, error_rate: float = 0.0001) -> None:
+        self.error_rate = error_rate
+        self.count = 0
+        self._filters: list = []
+        self._add_filter(capacity)
+
+    def _add_filter(self, capacity):
+        size = ceil(-capacity * log(self.error_rate) / log(2) ** 2)
+        hashes = max(1, round(size / capacity * log(2)))
+        self._filters.append((capacity, size, hashes, bytearray((size + 7) // 8)))
+
+    @staticmethod
+    def _positions(item: bytes, size: int, hashes: int):
+        first = int.from_bytes(item[:8], 'little')
+        step = int.from_bytes(item[8:16], 'little') | 1
+        return ((first + i * step) % size for i in range(hashes))
+
+    def add(self, item: bytes) -> None:
+        capacity, size, hashes, bits = self._filters[-1]
+        if self.count >= sum(f[0] for f in self._filters):
+            self._add_filter(capacity * 2)
+            capacity, size, hashes, bits = self._filters[-1]
+        for position in self._positions(item, size, hashes):
+            bits[position >> 3] |= 1 << (position & 7)
+        self.count += 1
+
+    def __contains__(self, item: bytes) -> bool:
+        return any(
+            all(
+                bits[position >> 3] & (1 << (position & 7))
+                for position in self._positions(item, size, hashes)
+            )
+            for _, size, hashes, bits in self._filters
+        )
+
+    def __len__(self) -> int:
+        return self.count
+
+
 def subclass_tuple(name, base):
     return type(name, (base,), {'__slots__': ()})
 